@@ -0,0 +1,107 @@
+"""
+    Case allowances kept in redis token buckets, used instead of CapUser.case_allowance_remaining and session values
+    when settings.CASE_ALLOWANCE_BACKEND is 'redis'. Each bucket holds up to a full daily allowance, refills
+    continuously over settings.API_CASE_EXPIRE_HOURS, and is updated by a single Lua script, so no locks or Postgres
+    writes are needed to check and spend an allowance. Users' remaining allowances are copied back to CapUser
+    periodically by capapi.tasks.write_back_case_allowances, for reporting.
+"""
+import math
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from capdb import storages
+
+
+# KEYS: bucket hash, set of buckets to write back
+# ARGV: capacity, refill per second, now, cases requested (negative to refund), initial tokens for a new bucket,
+#       seconds to keep an idle bucket, member to add to the write-back set (or '')
+# Returns {cases taken, tokens remaining}
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or tonumber(ARGV[5])
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * refill_rate)
+local taken = requested
+if requested > 0 then
+    taken = math.min(requested, math.floor(tokens))
+end
+tokens = math.min(capacity, tokens - taken)
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+if ARGV[7] ~= '' and taken ~= 0 then
+    redis.call('SADD', KEYS[2], ARGV[7])
+end
+return {taken, tostring(tokens)}
+"""
+
+
+class CaseAllowanceBucket:
+    key_prefix = 'case-allowance:'
+    write_back_key = 'case-allowance:write-back'
+
+    def __init__(self, key, capacity, initial=None, user_id=None):
+        self.key = self.key_prefix + key
+        self.capacity = max(capacity or 0, 0)
+        self.initial = self.capacity if initial is None else min(initial, self.capacity)
+        self.user_id = user_id
+
+    @classmethod
+    def for_user(cls, user):
+        """ Bucket for a CapUser, starting from their stored allowance the first time it's used. """
+        initial = user.case_allowance_remaining
+        if user.case_allowance_last_updated + timedelta(hours=settings.API_CASE_EXPIRE_HOURS) < timezone.now():
+            initial = user.total_case_allowance
+        return cls('user:%s' % user.pk, user.total_case_allowance, initial, user_id=user.pk)
+
+    @classmethod
+    def for_session(cls, session):
+        """ Bucket for a logged-out user's session, starting from any allowance stored in the session. """
+        return cls('session:%s' % session.session_key, settings.API_CASE_DAILY_ALLOWANCE, session.get('case_allowance_remaining'))
+
+    def refill_seconds(self):
+        return settings.API_CASE_EXPIRE_HOURS * 60 * 60
+
+    def take(self, case_count, now=None):
+        """
+            Take up to case_count cases from the bucket, or refund -case_count cases if negative. Returns a tuple of
+            (cases taken, whole cases remaining).
+        """
+        refill_seconds = self.refill_seconds()
+        script = storages.redis_client.register_script(TAKE_SCRIPT)
+        taken, tokens = script(keys=[self.key, self.write_back_key], args=[
+            self.capacity,
+            self.capacity / refill_seconds,
+            time.time() if now is None else now,
+            case_count,
+            self.initial,
+            refill_seconds,  # an idle bucket is full again by the time it expires
+            self.user_id or '',
+        ])
+        return int(taken), int(math.floor(float(tokens)))
+
+    def remaining(self, now=None):
+        return self.take(0, now)[1]
+
+    @classmethod
+    def write_back(cls, batch_size=1000):
+        """ Copy remaining allowances for users whose buckets have changed to CapUser.case_allowance_remaining. """
+        from capapi.models import CapUser  # import here to avoid circular import
+        client = storages.redis_client
+        updated = 0
+        while True:
+            user_ids = client.spop(cls.write_back_key, batch_size)
+            if not user_ids:
+                return updated
+            for user_id in user_ids:
+                tokens = client.hget(cls.key_prefix + 'user:%s' % user_id.decode(), 'tokens')
+                if tokens is not None:
+                    updated += CapUser.objects.filter(pk=int(user_id)).update(
+                        case_allowance_remaining=int(math.floor(float(tokens))),
+                        case_allowance_last_updated=timezone.now())
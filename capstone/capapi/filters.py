@@ -1,8 +1,8 @@
-from functools import lru_cache
+from collections.abc import Sequence
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError as DjangoValidationError
-from django.utils.functional import SimpleLazyObject
 from django.contrib.postgres.search import SearchQuery
 
 import rest_framework_filters as filters
@@ -13,12 +13,57 @@ from capdb import models
 
 ### HELPERS ###
 
-# lazy load and cache choices so we don't get an error if this file is imported when database tables don't exist yet
-def lazy_choices(queryset, id_attr, label_attr):
-    @lru_cache(None)
-    def get_choices():
-        return queryset.order_by(label_attr).values_list(id_attr, label_attr)
-    return SimpleLazyObject(get_choices)
+class LazyChoices(Sequence):
+    """
+        Choices for a filter, loaded lazily so we don't get an error if this file is imported when database tables don't
+        exist yet. Choices are shared through the cache under the model's lookup_version(), and reloaded when it changes,
+        so a new Court appears without restarting every process. extra_choices are listed first.
+
+        Iterating, len() and `in` each work from a single get_choices() call, and the shared version is checked at
+        most once per the model's version_check_interval.
+    """
+    def __init__(self, queryset, id_attr, label_attr, extra_choices=()):
+        self.queryset = queryset
+        self.id_attr = id_attr
+        self.label_attr = label_attr
+        self.extra_choices = list(extra_choices)
+        self._cached = (None, None)
+
+    def get_choices(self):
+        version = self.queryset.model.recent_lookup_version()
+        cached_version, choices = self._cached
+        if cached_version != version:
+            cache_key = 'choices:%s:%s:%s:%s' % (self.queryset.model._meta.label, self.id_attr, self.label_attr, version)
+            choices = cache.get(cache_key)
+            if choices is None:
+                choices = list(self.queryset.order_by(self.label_attr).values_list(self.id_attr, self.label_attr))
+                cache.set(cache_key, choices, settings.CACHED_LOOKUP_TIMEOUT)
+            choices = self.extra_choices + choices
+            self._cached = (version, choices)
+        return choices
+
+    def __getitem__(self, index):
+        return self.get_choices()[index]
+
+    def __iter__(self):
+        return iter(self.get_choices())
+
+    def __reversed__(self):
+        return reversed(self.get_choices())
+
+    def __contains__(self, value):
+        return value in self.get_choices()
+
+    def __len__(self):
+        return len(self.get_choices())
+
+    def __deepcopy__(self, memo):
+        # filtersets deepcopy their filters for each request; share one set of choices between them
+        return self
+
+
+def lazy_choices(queryset, id_attr, label_attr, extra_choices=()):
+    return LazyChoices(queryset, id_attr, label_attr, extra_choices)
 jur_choices = lazy_choices(models.Jurisdiction.objects.all(), 'slug', 'name_long')
 court_choices = lazy_choices(models.Court.objects.all(), 'slug', 'name')
 reporter_choices = lazy_choices(models.Reporter.objects.all(), 'id', 'short_name')
@@ -174,6 +219,11 @@ class CaseFilter(NoopMixin, filters.FilterSet):
         label='Format for case text (applies only if including case text)',
         choices=(('text', 'text only (default)'), ('html', 'HTML'), ('xml', 'XML'), ('tokens', 'debug tokens')),
     )
+    stream = filters.ChoiceFilter(
+        method='noop',
+        label='Stream the response? (applies only to JSON lists including case text)',
+        choices=(('', 'No (default)'), ('true', 'Stream cases as they are loaded')),
+    )
 
     def find_by_citation(self, qs, name, value):
         return qs.filter(citations__normalized_cite__exact=models.Citation.normalize_cite(value))
@@ -237,18 +287,35 @@ class CaseExportFilter(NoopMixin, filters.FilterSet):
 class NgramFilter(filters.FilterSet):
     q = filters.CharFilter(
         label='Words',
-        help_text='Up to three words separated by spaces',
+        help_text='Up to three words separated by spaces. Repeat to look up several terms at once.',
     )
     jurisdiction = filters.MultipleChoiceFilter(
         label='Jurisdiction',
-        choices=SimpleLazyObject(lambda: [['total', 'Total across jurisdictions (default)'], ['*', 'Select all jurisdictions']] + list(jur_choices)),
+        choices=lazy_choices(models.Jurisdiction.objects.all(), 'slug', 'name_long', extra_choices=[
+            ['total', 'Total across jurisdictions (default)'],
+            ['*', 'Select all jurisdictions'],
+        ]),
     )
     year = filters.CharFilter(
         label='Year filter',
     )
+    year_min = filters.NumberFilter(
+        label='Earliest year',
+    )
+    year_max = filters.NumberFilter(
+        label='Latest year',
+    )
+    bucket = filters.ChoiceFilter(
+        label='Group years',
+        choices=[['decade', 'Sum counts by decade']],
+    )
+    moving_average = filters.NumberFilter(
+        label='Moving average',
+        help_text='Average counts over this many years (or buckets)',
+    )
 
     class Meta:
-        fields = ['q', 'jurisdiction', 'year']
+        fields = ['q', 'jurisdiction', 'year', 'year_min', 'year_max', 'bucket', 'moving_average']
 
 
 def parse_phrase_search(search_term):
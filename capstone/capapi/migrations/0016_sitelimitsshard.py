@@ -0,0 +1,33 @@
+# Generated by Django 2.2.4 on 2019-09-20 15:12
+
+from django.db import migrations, models
+
+
+def move_daily_downloads(apps, schema_editor):
+    SiteLimits = apps.get_model('capapi', 'SiteLimits')
+    SiteLimitsShard = apps.get_model('capapi', 'SiteLimitsShard')
+    site_limits = SiteLimits.objects.filter(pk=1).first()
+    if site_limits and site_limits.daily_downloads:
+        SiteLimitsShard.objects.create(pk=0, daily_downloads=site_limits.daily_downloads)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capapi', '0015_auto_20190812_1452'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteLimitsShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('daily_downloads', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(move_daily_downloads, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='sitelimits',
+            name='daily_downloads',
+        ),
+    ]
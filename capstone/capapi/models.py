@@ -1,4 +1,5 @@
 from datetime import timedelta
+import random
 import uuid
 import logging
 
@@ -6,7 +7,10 @@ import email_normalize
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, AnonymousUser, PermissionsMixin
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.db import models, IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Least
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.conf import settings
 from netaddr import IPAddress, AddrFormatError, IPNetwork
 
@@ -115,13 +119,29 @@ class CapUser(PermissionsMixin, AbstractBaseUser):
                 self._is_harvard_ip = any(IPAddress(ip) in IPNetwork(ip_range) for ip_range in settings.HARVARD_IP_RANGES)
         return self._is_harvard_ip
 
+    def reset_expired_case_allowance(self):
+        if self.case_allowance_last_updated + timedelta(hours=settings.API_CASE_EXPIRE_HOURS) < timezone.now():
+            self.case_allowance_remaining = self.total_case_allowance
+            self.case_allowance_last_updated = timezone.now()
+
     def update_case_allowance(self, case_count=0, save=True):
         if self.unlimited_access_in_effect():
             return
 
-        if self.case_allowance_last_updated + timedelta(hours=settings.API_CASE_EXPIRE_HOURS) < timezone.now():
-            self.case_allowance_remaining = self.total_case_allowance
-            self.case_allowance_last_updated = timezone.now()
+        if save and settings.CASE_ALLOWANCE_BACKEND == 'redis':
+            # the stored allowance is kept in redis -- see capapi.allowance
+            from capapi.allowance import CaseAllowanceBucket  # import here to avoid circular import
+            bucket = CaseAllowanceBucket.for_user(self)
+            taken, self.case_allowance_remaining = bucket.take(case_count)
+            if taken < case_count:
+                self.case_allowance_remaining = bucket.take(-taken)[1]
+                raise AttributeError("Case allowance is too low.")
+            return
+
+        if save:
+            # with save=False, case_allowance_remaining counts down a reservation from reserve_case_allowance(),
+            # which was already checked for expiry
+            self.reset_expired_case_allowance()
 
         if case_count:
             if self.case_allowance_remaining < case_count:
@@ -131,6 +151,50 @@ class CapUser(PermissionsMixin, AbstractBaseUser):
         if save:
             self.save(update_fields=['case_allowance_remaining', 'case_allowance_last_updated'])
 
+    def reserve_case_allowance(self, case_count):
+        """
+            Take up to case_count cases from the stored case allowance, and return how many were taken. The user row is
+            only locked while the reservation is made. Afterward, self.case_allowance_remaining is the number reserved,
+            for update_case_allowance(save=False) to count down from; return what's left of it with
+            refund_case_allowance().
+
+            Reserving doesn't move case_allowance_last_updated, so the allowance still resets once a day for users who
+            make requests more often than that. self.case_allowance_last_updated is set to the start of the period
+            the reservation was taken from, so refund_case_allowance() can tell whether it has been reset since.
+        """
+        if settings.CASE_ALLOWANCE_BACKEND == 'redis':
+            from capapi.allowance import CaseAllowanceBucket  # import here to avoid circular import
+            reserved = CaseAllowanceBucket.for_user(self).take(case_count)[0]
+            self.case_allowance_remaining = reserved
+            self.case_allowance_last_updated = timezone.now()  # the bucket handles refills
+            return reserved
+
+        with transaction.atomic():
+            user = CapUser.objects.select_for_update().get(pk=self.pk)
+            user.reset_expired_case_allowance()
+            reserved = min(case_count, user.case_allowance_remaining)
+            user.case_allowance_remaining -= reserved
+            user.save(update_fields=['case_allowance_remaining', 'case_allowance_last_updated'])
+        self.case_allowance_remaining = reserved
+        self.case_allowance_last_updated = user.case_allowance_last_updated
+        return reserved
+
+    def refund_case_allowance(self, case_count):
+        """
+            Return case_count unused cases from reserve_case_allowance() to the stored case allowance, and reload the
+            stored values. If the allowance was reset since the reservation, the cases were reserved from the previous
+            period, so they aren't refunded on top of the new one.
+        """
+        if settings.CASE_ALLOWANCE_BACKEND == 'redis':
+            from capapi.allowance import CaseAllowanceBucket  # import here to avoid circular import
+            self.case_allowance_remaining = CaseAllowanceBucket.for_user(self).take(-case_count)[1]
+            return
+
+        if case_count:
+            CapUser.objects.filter(pk=self.pk, case_allowance_last_updated=self.case_allowance_last_updated).update(
+                case_allowance_remaining=Least(F('case_allowance_remaining') + case_count, F('total_case_allowance')))
+        self.refresh_from_db(fields=['case_allowance_remaining', 'case_allowance_last_updated'])
+
     def authenticate_user(self, activation_nonce):
         if self.activation_nonce == activation_nonce and self.nonce_expires + timedelta(hours=24) > timezone.now():
             Token.objects.create(user=self)
@@ -265,11 +329,22 @@ class SiteLimits(models.Model):
     daily_signup_limit = models.IntegerField(default=50)
     daily_signups = models.IntegerField(default=0)
     daily_download_limit = models.IntegerField(default=50000)
-    daily_downloads = models.IntegerField(default=0)
+
+    # values stored in SiteLimitsShard rows instead of this one -- see add_values()
+    sharded_fields = ('daily_downloads',)
 
     class Meta:
         verbose_name_plural = "Site limits"
 
+    @cached_property
+    def daily_downloads(self):
+        return SiteLimitsShard.objects.aggregate(total=Sum('daily_downloads'))['total'] or 0
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        for field in self.sharded_fields:
+            self.__dict__.pop(field, None)
+
     @classmethod
     def create(cls):
         """ Create and return the ID=1 row, or fetch the existing one. """
@@ -306,8 +381,17 @@ class SiteLimits(models.Model):
     def add_values(cls, **pairs):
         """
             Modify existing values.
-            E.g., SiteLimits.add_values(daily_downloads=1) increases daily_downloads by 1.
+            E.g., SiteLimits.add_values(daily_signups=1) increases daily_signups by 1.
+
+            Sharded fields, like daily_downloads, are added to a SiteLimitsShard row instead, so API requests counting
+            downloads don't all wait on a lock for the ID=1 row. Returns the ID=1 row, or None if only sharded fields
+            were given.
         """
+        sharded_pairs = {k: pairs.pop(k) for k in cls.sharded_fields if k in pairs}
+        if sharded_pairs:
+            SiteLimitsShard.add_values(**sharded_pairs)
+        if not pairs:
+            return None
         with transaction.atomic():
             site_limits = cls.get_for_update()
             for k, v in pairs.items():
@@ -321,8 +405,30 @@ class SiteLimits(models.Model):
         with transaction.atomic():
             site_limits = cls.get_for_update()
             site_limits.daily_signups = 0
-            site_limits.daily_downloads = 0
             site_limits.save()
+            SiteLimitsShard.objects.update(**{field: 0 for field in cls.sharded_fields})
+
+
+class SiteLimitsShard(models.Model):
+    """
+        Counters for SiteLimits.sharded_fields. Each SiteLimits value is the sum over these rows, and each addition goes
+        to a random row, so simultaneous additions rarely wait on each other. Rows are numbered from 0 to
+        settings.SITE_LIMITS_SHARD_COUNT - 1 and created as needed.
+    """
+    daily_downloads = models.IntegerField(default=0)
+
+    @classmethod
+    def add_values(cls, **pairs):
+        """ Add to the values in a random shard, with a single UPDATE. """
+        shard = random.randrange(settings.SITE_LIMITS_SHARD_COUNT)
+        updates = {k: F(k) + v for k, v in pairs.items()}
+        if not cls.objects.filter(pk=shard).update(**updates):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(pk=shard, **pairs)
+            except IntegrityError:
+                # created by another request in the meantime
+                cls.objects.filter(pk=shard).update(**updates)
 
 
 class MailingList(models.Model):
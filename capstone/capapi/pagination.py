@@ -2,6 +2,9 @@ import json
 import warnings
 from base64 import b64decode, b64encode
 from collections import OrderedDict
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
 from django_elasticsearch_dsl_drf.versions import ELASTICSEARCH_GTE_6_0
 
 from rest_framework.exceptions import NotFound
@@ -44,23 +47,38 @@ class FTSPagination(CursorPagination):
             queryset = queryset.order_by(*self.ordering)
 
         # If we have a cursor with a fixed position then filter by that.
+        querysets = [queryset]
         if current_position is not None:
-            order = 'case_text__metadata_id' if self.FTS_ORDER else self.ordering[0]
-            is_reversed = order.startswith('-')
-            order_attr = order.lstrip('-')
-
-            # Test for: (cursor reversed) XOR (queryset reversed)
-            if self.cursor.reverse != is_reversed:
-                kwargs = {order_attr + '__lt': current_position}
+            values = None if self.FTS_ORDER else self.decode_position(current_position, queryset.model)
+            if values is not None:
+                querysets = self.keyset_querysets(queryset, values, self.cursor.reverse)
             else:
-                kwargs = {order_attr + '__gt': current_position}
+                order = 'case_text__metadata_id' if self.FTS_ORDER else self.ordering[0]
+                is_reversed = order.startswith('-')
+                order_attr = order.lstrip('-')
+
+                # Test for: (cursor reversed) XOR (queryset reversed)
+                if self.cursor.reverse != is_reversed:
+                    kwargs = {order_attr + '__lt': current_position}
+                else:
+                    kwargs = {order_attr + '__gt': current_position}
 
-            queryset = queryset.filter(**kwargs)
+                querysets = [queryset.filter(**kwargs)]
 
         # If we have an offset cursor then offset the entire page by that amount.
         # We also always fetch an extra item in order to determine if there is a
         # page following on from this one.
-        results = list(queryset[offset:offset + self.page_size + 1])
+        if len(querysets) == 1:
+            results = list(querysets[0][offset:offset + self.page_size + 1])
+        else:
+            # keyset cursors can split the rows after them into several querysets; only query the later ones if the
+            # earlier ones come up short
+            results = []
+            for next_queryset in querysets:
+                results.extend(next_queryset[:offset + self.page_size + 1 - len(results)])
+                if len(results) > offset + self.page_size:
+                    break
+            results = results[offset:]
         self.page = list(results[:self.page_size])
 
         # Determine the position of the final item following the page.
@@ -100,6 +118,105 @@ class FTSPagination(CursorPagination):
 
         return self.page
 
+    def ordering_field(self, model, name):
+        """ Return the model field for an ordering name, or None if it's not a local field (an annotation or join). """
+        if name == 'pk':
+            return model._meta.pk
+        try:
+            return model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+    def _get_position_from_instance(self, instance, ordering):
+        """
+            Positions are a JSON list of the instance's values for every ordering field, so the next page can be found
+            with a keyset comparison instead of stepping past ties with OFFSET.
+        """
+        if self.FTS_ORDER:
+            return super()._get_position_from_instance(instance, ordering)
+        values = []
+        for name in ordering:
+            name = name.lstrip('-')
+            if isinstance(instance, dict):
+                value = instance[name]
+            else:
+                field = self.ordering_field(type(instance), name)
+                value = getattr(instance, field.attname if field else name)
+            values.append(value if value is None or isinstance(value, (int, float)) else str(value))
+        return json.dumps(values)
+
+    def decode_position(self, position, model):
+        """
+            Return a list of field values from a position made by _get_position_from_instance, or None if this is a
+            single-value position from an older cursor, or the ordering isn't all local fields.
+        """
+        try:
+            values = json.loads(position)
+        except ValueError:
+            return None
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            return None
+        fields = [self.ordering_field(model, name.lstrip('-')) for name in self.ordering]
+        if None in fields:
+            return None
+        try:
+            return [None if value is None else field.to_python(value) for field, value in zip(fields, values)]
+        except ValidationError:
+            raise NotFound(self.invalid_cursor_message)
+
+    def keyset_querysets(self, queryset, values, reverse):
+        """
+            Return a list of querysets that together return the rows after `values` in self.ordering, in order.
+
+            If every field sorts in the same direction and only the first can be NULL -- like the default
+            ('decision_date', 'id') -- the rows where the first field isn't NULL are a single row comparison, like
+            (decision_date, id) > (%s, %s), which postgres can answer by walking a matching (decision_date, id) index
+            from the cursor position. Postgres sorts NULL after every other value, so the rows where the first field is
+            NULL come after those going forward and before them going back. Row comparisons with NULL are never true,
+            so those rows get a queryset of their own, which paginate_queryset() only runs if the page comes up short
+            or the cursor is on a NULL. Other orderings fall back to a single OR of per-field comparisons.
+        """
+        model = queryset.model
+        names = [name.lstrip('-') for name in self.ordering]
+        fields = [self.ordering_field(model, name) for name in names]
+        descending = [name.startswith('-') != reverse for name in self.ordering]
+
+        if len(set(descending)) == 1 and not any(field.null for field in fields[1:]):
+            is_descending = descending[0]
+            if values[0] is not None:
+                querysets = [self.row_comparison(queryset, fields, values, is_descending)]
+                if fields[0].null and not is_descending:
+                    querysets.append(queryset.filter(**{names[0] + '__isnull': True}))
+            else:
+                nulls = queryset.filter(**{names[0] + '__isnull': True})
+                querysets = [self.row_comparison(nulls, fields[1:], values[1:], is_descending)] if len(fields) > 1 else []
+                if is_descending:
+                    querysets.append(queryset.filter(**{names[0] + '__isnull': False}))
+            return querysets or [queryset.none()]
+
+        condition = None
+        for i, (name, field, is_descending, value) in enumerate(zip(names, fields, descending, values)):
+            if value is None:
+                if not is_descending:
+                    continue  # nothing sorts after NULL in an ascending field
+                term = Q(**{name + '__isnull': False})
+            else:
+                term = Q(**{name + ('__lt' if is_descending else '__gt'): value})
+                if field.null and not is_descending:
+                    term |= Q(**{name + '__isnull': True})
+            for prev_name, prev_value in zip(names[:i], values[:i]):
+                term &= Q(**{prev_name + '__isnull': True} if prev_value is None else {prev_name: prev_value})
+            condition = term if condition is None else condition | term
+        return [queryset.filter(condition) if condition is not None else queryset.none()]
+
+    def row_comparison(self, queryset, fields, values, descending):
+        """ Filter queryset to rows where the given non-NULL fields compare after values, as one row comparison. """
+        quote_name = connections[queryset.db].ops.quote_name
+        columns = ['%s.%s' % (quote_name(queryset.model._meta.db_table), quote_name(field.column)) for field in fields]
+        return queryset.extra(
+            where=['(%s) %s (%s)' % (', '.join(columns), '<' if descending else '>', ', '.join(['%s'] * len(values)))],
+            params=values)
+
     def decode_cursor(self, request):
         """ Objects with FTS ordering come in with an fts_order value which is a float. We have to convert to int for the query. """
         cursor = super().decode_cursor(request)
@@ -109,7 +226,8 @@ class FTSPagination(CursorPagination):
 
 
 class CapPagination(FTSPagination):
-    # This should be larger than the max number of records that share the same ordering field, such as decision_date,
+    # Keyset cursors only need offsets for full text search and cursors from before positions included every ordering
+    # field. This should be larger than the max number of records that share the same fts_order or decision_date,
     # but not too much larger to avoid allowing needlessly expensive queries.
     offset_cutoff = 10000
 
@@ -141,6 +259,7 @@ class CapPagination(FTSPagination):
         # copied from LimitOffsetPagination to support 'count' field
         return Response(OrderedDict([
             ('count', self.count),
+            ('count_exact', self.count_exact),
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
             ('results', data)
@@ -148,6 +267,10 @@ class CapPagination(FTSPagination):
 
     def get_count(self, queryset):
         # copied from LimitOffsetPagination to support 'count' field
+        self.count_exact = True
+        if isinstance(queryset, CachedCountQuerySet):
+            count, self.count_exact = queryset.count_with_exactness()
+            return count
         try:
             return queryset.count()
         except (AttributeError, TypeError):
@@ -50,6 +50,16 @@ def get_single_casebody_permissions(request, case):
     return casebody
 
 
+def uses_case_allowance(case):
+    """
+        Whether the casebody of case, a CaseMetadata or CaseDocument, is charged to the user's case allowance by
+        get_single_casebody_permissions() or check_update_case_permissions().
+    """
+    if hasattr(case, 'jurisdiction_whitelisted'):
+        return bool(case.jurisdiction_id) and not case.jurisdiction_whitelisted
+    return 'id' in case.jurisdiction and not case.jurisdiction['whitelisted']
+
+
 def check_update_case_permissions(request, case):
     """
         checks permissions, returns a status, and if appropriate, updates allowance
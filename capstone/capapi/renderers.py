@@ -1,16 +1,110 @@
 import hashlib
 import json
+import re
+import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
 
 from django.conf import settings
 from django.http.response import HttpResponseBase
 from django.template import loader
 from rest_framework import renderers
+from rest_framework.compat import INDENT_SEPARATORS, LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.utils import encoders
 
+from capdb.models import Jurisdiction, Court, Reporter
 from capweb.helpers import cache_func
 from scripts.process_metadata import parse_decision_date
 
 
 
+class RawJSON(Mapping):
+    """
+        A JSON object that's already encoded, like jsonb text from Postgres or a cached serializer result, plus
+        optional extra keys to append to it. FastJSONRenderer copies the encoded text straight into its output.
+        Everything else sees a read-only mapping, decoded on first access.
+    """
+    def __init__(self, text, extra=None):
+        self.text = text
+        self.extra = extra
+        self._value = None
+
+    def value(self):
+        if self._value is None:
+            self._value = json.loads(self.text, object_pairs_hook=OrderedDict)
+            if self.extra:
+                self._value.update(self.extra)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value()[key]
+
+    def __iter__(self):
+        return iter(self.value())
+
+    def __len__(self):
+        return len(self.value())
+
+
+class RawJSONEncoder(encoders.JSONEncoder):
+    """
+        JSONEncoder that encodes each RawJSON value as a placeholder string, and keeps its text in `fragments` for
+        FastJSONRenderer to substitute back in. Placeholders include a random token so they can't collide with data.
+    """
+    def __init__(self, *args, fragments, token, **kwargs):
+        self.fragments = fragments
+        self.token = token
+        super().__init__(*args, **kwargs)
+
+    def default(self, obj):
+        if isinstance(obj, RawJSON):
+            fragment = obj.text
+            if obj.extra:
+                extra = self.encode(obj.extra)  # may contain placeholders of its own
+                fragment = fragment.rstrip()[:-1].rstrip()
+                fragment += (extra[1:] if fragment.endswith('{') else ',' + extra[1:])
+            self.fragments.append(fragment)
+            return '\0%s:%s\0' % (self.token, len(self.fragments) - 1)
+        return super().default(obj)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """
+        JSONRenderer that writes RawJSON values to the response without decoding and re-encoding them -- see
+        CaseViewSet, which uses it to send CaseBodyCache.json and cached case metadata as-is. Output for data without
+        RawJSON values is the same as JSONRenderer's.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        indent = self.get_indent(accepted_media_type, renderer_context)
+        if indent is None:
+            separators = SHORT_SEPARATORS if self.compact else LONG_SEPARATORS
+        else:
+            separators = INDENT_SEPARATORS
+
+        fragments = []
+        token = uuid.uuid4().hex
+        ret = json.dumps(
+            data, cls=RawJSONEncoder, fragments=fragments, token=token,
+            indent=indent, ensure_ascii=self.ensure_ascii,
+            allow_nan=not self.strict, separators=separators
+        )
+
+        if fragments:
+            placeholder = re.compile(r'"\\u0000%s:(\d+)\\u0000"' % token)
+            def fill(match):
+                return placeholder.sub(fill, fragments[int(match.group(1))])
+            ret = placeholder.sub(fill, ret)
+
+        # We always fully escape \u2028 and \u2029 to ensure we output JSON
+        # that is a strict javascript subset, as JSONRenderer does.
+        ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+        return ret.encode()
+
+
 class XMLRenderer(renderers.BaseRenderer):
     media_type = 'application/xml'
     format = 'xml'
@@ -105,10 +199,27 @@ class HTMLRenderer(renderers.StaticHTMLRenderer):
         return template.render(context, renderer_context['request'])
 
 
+def filter_form_cache_key(renderer, data, view, request):
+    """
+        Filter forms only change with the choices loaded from lookup tables and the filter values they display, so
+        cache them per path, lookup_version() and query params other than pagination and format -- not per page.
+    """
+    paginator = getattr(view, 'paginator', None)
+    ignored_params = {
+        'format',
+        getattr(paginator, 'cursor_query_param', None),
+        getattr(paginator, 'page_size_query_param', None),
+    }
+    params = sorted((k, v) for k, values in request.query_params.lists() if k not in ignored_params for v in values)
+    versions = [model.recent_lookup_version() for model in (Jurisdiction, Court, Reporter)]
+    key = json.dumps([request.path, params, versions])
+    return 'filter-form:' + hashlib.md5(key.encode('utf8')).hexdigest()
+
+
 class BrowsableAPIRenderer(renderers.BrowsableAPIRenderer):
     @cache_func(
-        key=lambda self, data, view, request: 'filter-form:'+hashlib.md5((request.get_full_path()).encode('utf8')).hexdigest(),
-        timeout=settings.CACHED_COUNT_TIMEOUT,
+        key=filter_form_cache_key,
+        timeout=settings.CACHED_LOOKUP_TIMEOUT,
     )
     def get_filter_form(self, data, view, request):
         return super().get_filter_form(data, view, request)
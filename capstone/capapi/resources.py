@@ -101,39 +101,70 @@ class CachedCountQuerySet(QuerySet):
         Queryset that caches counts based on generated SQL.
         Usage: queryset.__class__ = CachedCountQuerySet
 
-        We take a few seconds to attempt to fetch the count live. If it does not return in time, we return None.
-        We also cache a value of "IN_PROGRESS", and start a background job with cache_query_count.delay() to
-        determine the real value.
+        CaseMetadata queries that only filter on fields tracked by CaseCountRollup are counted exactly from rollups.
+        Otherwise, if the planner estimates fewer than settings.LIVE_COUNT_ESTIMATE_THRESHOLD rows, we take a few seconds to
+        attempt to fetch the count live. If the estimate is higher, or the live count does not return in time, we
+        return the estimate instead. We also cache the estimate as {'estimate': n} while a background job started with
+        cache_query_count.delay() determines the real value.
     """
     def count(self):
+        return self.count_with_exactness()[0]
+
+    def count_with_exactness(self):
+        """ Return (count, is_exact). count may be an estimate from the query planner, or None if there isn't one. """
         if self.query.is_empty():
-            return 0
+            return 0, True
+
+        from capdb.models import CaseCountRollup  # import here to avoid loading models before apps are ready
+        value = CaseCountRollup.count_for_query(self.query)
+        if value is not None:
+            return value, True
 
         cache_key = 'query-count:' + hashlib.md5(str(self.query).encode('utf8')).hexdigest()
 
         # return existing value if any
         value = cache.get(cache_key)
-        if value == "IN_PROGRESS":
-            return None
+        if isinstance(value, int):
+            return value, True
         elif value is not None:
-            return value
+            return (value.get('estimate') if isinstance(value, dict) else None), False
 
         # cache new value
-        conn = connections["capdb"]
-        queries = None
-        try:
-            with statement_timeout(settings.LIVE_COUNT_TIME_LIMIT, "capdb"), CaptureQueriesContext(conn) as queries:
-                value = super().count()
-                # for testing:
-                # conn.cursor().execute("SELECT pg_sleep(2);")
-        except StatementTimeout:
-            count_sql = queries.captured_queries[0]['sql']
-            cache.set(cache_key, "IN_PROGRESS", 60*10)
-            cache_query_count.delay(count_sql, cache_key)
-            return None
+        conn = connections[self.db]
+        query = self.query.chain()
+        query.clear_ordering(True)
+        query.select_related = False
+        sql, params = query.sql_with_params()
+        estimate = self.estimate_count(conn, sql, params)
+        if estimate is None or estimate < settings.LIVE_COUNT_ESTIMATE_THRESHOLD:
+            queries = None
+            try:
+                with statement_timeout(settings.LIVE_COUNT_TIME_LIMIT, self.db), CaptureQueriesContext(conn) as queries:
+                    value = super().count()
+                    # for testing:
+                    # conn.cursor().execute("SELECT pg_sleep(2);")
+            except StatementTimeout:
+                count_sql = queries.captured_queries[0]['sql']
+            else:
+                cache.set(cache_key, value, settings.CACHED_COUNT_TIMEOUT)
+                return value, True
         else:
-            cache.set(cache_key, value, settings.CACHED_COUNT_TIMEOUT)
-            return value
+            with conn.cursor() as cursor:
+                count_sql = cursor.mogrify('SELECT COUNT(*) FROM (%s) subquery' % sql, params).decode('utf8')
+
+        cache.set(cache_key, {'estimate': estimate}, 60*10)
+        cache_query_count.delay(count_sql, cache_key)
+        return estimate, False
+
+    @staticmethod
+    def estimate_count(conn, sql, params):
+        """ Return the query planner's row estimate for sql, which is quick but can be off by a lot. """
+        with conn.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan'].get('Plan Rows')
 
 
 class CachedCountDefaultQuerySet(CachedCountQuerySet):
@@ -1,19 +1,26 @@
+import hashlib
+import json
 import logging
 import re
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from django.db import transaction
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
 from rest_framework.reverse import reverse as api_reverse
 from rest_framework.serializers import ListSerializer
 
 from capapi.models import SiteLimits
-from capapi.renderers import HTMLRenderer, XMLRenderer
+from capapi.renderers import HTMLRenderer, XMLRenderer, FastJSONRenderer, RawJSON
 from capdb import models
 from capdb.models import CaseBodyCache
 from capweb.helpers import reverse
 from scripts import helpers
 from scripts.generate_case_html import generate_html
-from .permissions import get_single_casebody_permissions, check_update_case_permissions
+from .permissions import get_single_casebody_permissions, check_update_case_permissions, uses_case_allowance
 
 logger = logging.getLogger(__name__)
 
@@ -75,6 +82,18 @@ class CaseReporterSerializer(serializers.ModelSerializer):
         )
 
 
+class CaseListSerializer(ListSerializer):
+    """ ListSerializer for CaseSerializer that reads and writes cached metadata for the whole page in one call each. """
+    def to_representation(self, data):
+        cases = list(data.all() if hasattr(data, 'all') else data)
+        if not hasattr(self.child, 'prefetch_metadata'):
+            return super().to_representation(cases)
+        self.child.prefetch_metadata(cases)
+        ret = super().to_representation(cases)
+        self.child.save_metadata()
+        return ret
+
+
 class CaseSerializer(serializers.HyperlinkedModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name="casemetadata-detail", lookup_field="id")
@@ -104,12 +123,95 @@ class CaseSerializer(serializers.HyperlinkedModelSerializer):
             'court',
             'jurisdiction',
         )
+        list_serializer_class = CaseListSerializer
+
+    # The JSON for these fields is cached for each case, so list pages don't rebuild the nested dicts and hyperlinks
+    # every time -- see metadata_cache_key(). Set metadata_cache_prefix to None to disable caching in a subclass.
+    metadata_cache_prefix = 'case-metadata'
+    metadata_cache_fields = Meta.fields
 
     def get_frontend_url(self, obj):
         if not hasattr(self, '_frontend_url_base'):
             CaseSerializer._frontend_url_base = reverse('cite_home', host='cite').rstrip('/')
         return self._frontend_url_base + (obj.frontend_url or '')
 
+    def metadata_cache_key(self, case):
+        """
+            Return the cache key for a case's metadata fields, or None if it shouldn't be cached.
+
+            The key includes a version stamp hashed from every value the fields are built from, including the
+            denormalized jurisdiction and court fields kept up to date by database triggers, and the related volume,
+            reporter and citations. Any change to a case -- through save(), a trigger, or an edit to a related row --
+            produces a new key, so cached entries never need to be invalidated. (sys_period isn't used as the stamp,
+            because it doesn't change between writes in the same transaction, and citation edits don't touch the
+            case row.) The host is included because hyperlinks are absolute.
+        """
+        request = self.context.get('request')
+        if not self.metadata_cache_prefix or request is None:
+            return None
+        sources = (
+            case.id, case.frontend_url, case.name, case.name_abbreviation, case.decision_date_original,
+            case.docket_number, case.first_page, case.last_page,
+            case.jurisdiction_id, case.jurisdiction_slug, case.jurisdiction_name, case.jurisdiction_name_long,
+            case.jurisdiction_whitelisted, case.court_id, case.court_slug, case.court_name, case.court_name_abbreviation,
+            case.volume_id, case.volume.xml_volume_number, case.reporter_id, case.reporter.full_name,
+            [(citation.type, citation.cite) for citation in case.citations.all()],
+            request.build_absolute_uri('/'), getattr(request, 'version', None),
+        )
+        return '%s:%s:%s' % (self.metadata_cache_prefix, case.id, hashlib.md5(repr(sources).encode('utf8')).hexdigest())
+
+    def prefetch_metadata(self, cases):
+        """
+            Fetch cached metadata for all of cases in one call, for use by to_representation(). Metadata built for
+            cases that weren't cached is held until save_metadata() writes it in one call.
+        """
+        keys = [self.metadata_cache_key(case) for case in cases]
+        self._metadata = cache.get_many([k for k in keys if k])
+        self._new_metadata = {}
+
+    def save_metadata(self):
+        """ Cache the metadata built by to_representation() for cases that prefetch_metadata() didn't find. """
+        if getattr(self, '_new_metadata', None):
+            cache.set_many(self._new_metadata, settings.CASE_METADATA_CACHE_TIMEOUT)
+        self._new_metadata = {}
+
+    def represent_fields(self, instance, fields):
+        """ Serialize instance with the given fields, the same way Serializer.to_representation() does. """
+        ret = OrderedDict()
+        for field in fields:
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return ret
+
+    def to_representation(self, instance):
+        key = self.metadata_cache_key(instance)
+        if not key:
+            return super().to_representation(instance)
+
+        # after prefetch_metadata(), a case missing from the prefetched entries isn't cached, and its metadata is
+        # saved with the rest of the page's by save_metadata(); single cases are read and written directly
+        fields = list(self._readable_fields)
+        prefetched = hasattr(self, '_metadata')
+        metadata = self._metadata.get(key) if prefetched else cache.get(key)
+        if metadata is None:
+            metadata = json.dumps(self.represent_fields(instance, [f for f in fields if f.field_name in self.metadata_cache_fields]))
+            if prefetched:
+                self._new_metadata[key] = metadata
+            else:
+                cache.set(key, metadata, settings.CASE_METADATA_CACHE_TIMEOUT)
+
+        # add uncached fields, like casebody
+        extra = self.represent_fields(instance, [f for f in fields if f.field_name not in self.metadata_cache_fields])
+        if isinstance(getattr(self.context['request'], 'accepted_renderer', None), FastJSONRenderer):
+            return RawJSON(metadata, extra)
+        ret = json.loads(metadata, object_pairs_hook=OrderedDict)
+        ret.update(extra)
+        return ret
+
 # for elasticsearch
 class CaseDocumentSerializer(DocumentSerializer):
     url = serializers.SerializerMethodField()
@@ -191,53 +293,58 @@ class CaseDocumentSerializer(DocumentSerializer):
             CaseDocumentSerializer._url_base = api_reverse('cases-list')
         return self._url_base + (str(obj.id) or '')
 
+@contextmanager
+def case_allowance(request, case_count):
+    """
+        Check and update the case allowance for request.user, for up to case_count case bodies whose permissions are
+        checked with get_single_casebody_permissions() inside this block.
+
+        To stay race-condition-free without holding a lock on the user row while cases are serialized, case_count
+        cases are reserved from the user's allowance up front, and whatever isn't used is refunded afterward. Callers
+        count only the cases that uses_case_allowance(), so a concurrent request from the same user isn't refused
+        cases that were reserved for whitelisted ones.
+        Downloads are then added to the sitewide count, which doesn't lock the SiteLimits row either.
+    """
+    if request.user.is_anonymous:
+        # logged out users won't get any blacklisted case bodies, so nothing to update
+        yield
+        return
+
+    # set request.site_limits so it can be checked later in get_single_casebody_permissions()
+    request.site_limits = SiteLimits.get()
+
+    if request.user.unlimited_access_in_effect():
+        yield
+        return
+
+    reserved = request.user.reserve_case_allowance(case_count)
+    cases_sent = 0
+    try:
+        yield
+        cases_sent = max(reserved - request.user.case_allowance_remaining, 0)
+    finally:
+        request.user.refund_case_allowance(reserved - cases_sent)
+
+    # update site-wide limits
+    if cases_sent:
+        SiteLimits.add_values(daily_downloads=cases_sent)
+
 class CaseAllowanceMixin:
     """
         When we serialize case bodies for delivery to the client, we need to make sure, in a race-condition-free
         way, that the correct case allowance is checked and updated. That's handled here by overriding
-        serializer.data.
+        serializer.data to run inside case_allowance().
 
         Do this as a mixin because we have to apply it to the regular serializer and also the list serializer.
     """
     @property
     def data(self):
-        request = self.context.get('request')
-
-        if request.user.is_anonymous:
-            # logged out users won't get any blacklisted case bodies, so nothing to update
+        cases = self.instance if isinstance(self, ListSerializer) else [self.instance]
+        case_count = sum(1 for case in cases if uses_case_allowance(case))
+        with case_allowance(self.context.get('request'), case_count):
             return super().data
 
-        # set request.site_limits so it can be checked later in get_single_casebody_permissions()
-        request.site_limits = SiteLimits.get()
-
-        with transaction.atomic():
-            # for logged-in users, fetch the current user data here inside a transaction, using select_for_update
-            # to lock the row so we don't collide with any simultaneous requests
-            user = request.user.__class__.objects.select_for_update().get(pk=request.user.pk)
-
-            # update the info for the existing user model, in case it's changed since the request began
-            if not request.user.unlimited_access_in_effect():
-                request.user.case_allowance_remaining = user.case_allowance_remaining
-                request.user.case_allowance_last_updated = user.case_allowance_last_updated
-                request.user.update_case_allowance(save=False)  # for SiteLimits, make sure we start with up-to-date case_allowance_remaining
-                allowance_before = request.user.case_allowance_remaining
-
-            result = super().data
-
-            # if user's case allowance was updated, save
-            # (this works because it's part of the same transaction with the select_for_update --
-            # we don't have to use the same object)
-            if request.user.tracker.changed():
-                request.user.save()
-
-        # update site-wide limits
-        if not request.user.unlimited_access_in_effect():
-            cases_sent = allowance_before - request.user.case_allowance_remaining
-            SiteLimits.add_values(daily_downloads=cases_sent)
-
-        return result
-
-class ListSerializerWithCaseAllowance(CaseAllowanceMixin, ListSerializer):
+class ListSerializerWithCaseAllowance(CaseAllowanceMixin, CaseListSerializer):
     """ Custom ListSerializer for CaseSerializerWithCasebody that enforces CaseAllowance. """
     pass
 
@@ -304,7 +411,12 @@ class CaseSerializerWithCasebody(CaseAllowanceMixin, CaseSerializer):
         # check permissions for full-text access to this case
         request = self.context.get('request')
         if check_permissions:
-            casebody = get_single_casebody_permissions(request, case)
+            statuses = self.context.get('casebody_statuses')
+            if statuses is not None:
+                # permissions already checked, e.g. by CaseViewSet.stream_list()
+                casebody = {'status': statuses[case.id], 'data': None}
+            else:
+                casebody = get_single_casebody_permissions(request, case)
         else:
             casebody = {'status': 'ok', 'data': None}
 
@@ -354,6 +466,9 @@ class CaseSerializerWithCasebody(CaseAllowanceMixin, CaseSerializer):
                         data = re.sub(r"\s{2,}", " ", c.decode())
                 elif body_format == 'tokens':
                     data = case.get_hydrated_structure()
+                elif getattr(case, 'body_cache_json_text', None) is not None:
+                    # jsonb text fetched by CaseViewSet for FastJSONRenderer, so it doesn't have to be decoded and re-encoded
+                    data = RawJSON(case.body_cache_json_text)
                 else:
                     try:
                         data = case.body_cache.json
@@ -519,6 +634,7 @@ class NoLoginCaseDocumentSerializer(CaseDocumentSerializerWithCasebody):
 
 
 class BulkCaseSerializer(NoLoginCaseSerializer):
+    metadata_cache_prefix = None
     court = BulkCourtSerializer(source='denormalized_court')
     jurisdiction = BulkJurisdictionSerializer(source='denormalized_jurisdiction')
     volume = BulkCaseVolumeSerializer()
@@ -50,6 +50,14 @@ User emails:
     except KeyError:
         pass
 
+@shared_task
+def write_back_case_allowances():
+    """ Copy case allowances kept in redis back to CapUser, for reporting. """
+    if settings.CASE_ALLOWANCE_BACKEND != 'redis':
+        return
+    from capapi.allowance import CaseAllowanceBucket  # import here to avoid circular import
+    CaseAllowanceBucket.write_back()
+
 @shared_task
 def cache_query_count(sql, cache_key):
     """ Cache the result of a count() sql query, because it didn't return quickly enough the first time. """
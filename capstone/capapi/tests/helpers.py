@@ -21,4 +21,13 @@ def check_response(response, status_code=200, content_type=None, content_include
 
 def is_cached(response):
     cache_header = response['cache-control'] if response.has_header('cache-control') else ''
-    return 's-maxage=%d' % settings.CACHE_CONTROL_DEFAULT_MAX_AGE in cache_header
\ No newline at end of file
+    return 's-maxage=%d' % settings.CACHE_CONTROL_DEFAULT_MAX_AGE in cache_header
+
+def preload_filter_choices():
+    """
+        Load choices for capapi.filters, so reloading them after jurisdictions, courts or reporters are saved doesn't
+        get counted by django_assert_num_queries.
+    """
+    from capapi.filters import jur_choices, court_choices, reporter_choices
+    for choices in (jur_choices, court_choices, reporter_choices):
+        len(choices)
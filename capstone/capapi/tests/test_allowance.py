@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from capapi.allowance import CaseAllowanceBucket
+from capapi.models import CapUser
+from capapi.resources import api_reverse
+from capapi.tasks import write_back_case_allowances
+
+
+def test_case_allowance_bucket(settings):
+    settings.API_CASE_EXPIRE_HOURS = 1
+    bucket = CaseAllowanceBucket('test', capacity=10, initial=6)
+    now = 1000000
+
+    # takes what's available, starting from initial
+    assert bucket.take(4, now=now) == (4, 2)
+    assert bucket.take(4, now=now) == (2, 0)
+
+    # refills continuously, up to capacity
+    assert bucket.remaining(now=now + 60*60/2) == 5
+    assert bucket.remaining(now=now + 60*60*2) == 10
+
+    # refunds don't go over capacity
+    assert bucket.take(3, now=now + 60*60*2) == (3, 7)
+    assert bucket.take(-5, now=now + 60*60*2) == (-5, 10)
+
+
+@pytest.mark.django_db
+def test_redis_case_allowance(settings, auth_client, case):
+    settings.CASE_ALLOWANCE_BACKEND = 'redis'
+    case.jurisdiction.whitelisted = False
+    case.jurisdiction.save()
+    user = auth_client.auth_user
+
+    response = auth_client.get(api_reverse("casemetadata-detail", args=[case.id]), {"full_case": "true"})
+    assert response.json()['casebody']['status'] == 'ok'
+
+    # allowance is spent in redis, and copied back to the database later
+    assert CaseAllowanceBucket.for_user(user).remaining() == user.total_case_allowance - 1
+    user.refresh_from_db()
+    assert user.case_allowance_remaining == user.total_case_allowance
+    write_back_case_allowances.apply()
+    user.refresh_from_db()
+    assert user.case_allowance_remaining == user.total_case_allowance - 1
+
+    # used-up allowance is enforced
+    CaseAllowanceBucket.for_user(user).take(user.total_case_allowance)
+    response = auth_client.get(api_reverse("casemetadata-detail", args=[case.id]), {"full_case": "true"})
+    assert response.json()['casebody']['status'] == 'error_limit_exceeded'
+
+
+@pytest.mark.django_db
+def test_case_allowance_reservation_across_reset(cap_user, settings, monkeypatch):
+    # reserve most of the allowance shortly before the allowance period ends
+    now = timezone.now()
+    cap_user.total_case_allowance = cap_user.case_allowance_remaining = 10
+    cap_user.case_allowance_last_updated = now - timedelta(hours=settings.API_CASE_EXPIRE_HOURS) + timedelta(minutes=1)
+    cap_user.save()
+    assert cap_user.reserve_case_allowance(8) == 8
+
+    # another request resets the allowance after the period ends, while the reservation is out, and spends some
+    monkeypatch.setattr(timezone, 'now', lambda: now + timedelta(minutes=2))
+    other_request_user = CapUser.objects.get(pk=cap_user.pk)
+    other_request_user.update_case_allowance(4)
+    assert other_request_user.case_allowance_remaining == 6
+
+    # three cases are sent from the old reservation, and the rest isn't refunded on top of the new period
+    cap_user.update_case_allowance(3, save=False)
+    cap_user.refund_case_allowance(cap_user.case_allowance_remaining)
+    assert cap_user.case_allowance_remaining == 6
+
+
+@pytest.mark.django_db
+def test_case_allowance_resets_for_frequent_requests(cap_user, settings, monkeypatch):
+    # a request every six hours doesn't keep the allowance period from ending
+    start = timezone.now()
+    cap_user.total_case_allowance = cap_user.case_allowance_remaining = 10
+    cap_user.case_allowance_last_updated = start
+    cap_user.save()
+    for hours in range(0, settings.API_CASE_EXPIRE_HOURS + 1, 6):
+        monkeypatch.setattr(timezone, 'now', lambda: start + timedelta(hours=hours, minutes=1))
+        cap_user.reserve_case_allowance(3)
+        cap_user.update_case_allowance(1, save=False)
+        cap_user.refund_case_allowance(cap_user.case_allowance_remaining)
+    assert cap_user.case_allowance_remaining == 9
+    assert cap_user.case_allowance_last_updated > start + timedelta(hours=settings.API_CASE_EXPIRE_HOURS)
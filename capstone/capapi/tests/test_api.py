@@ -1,12 +1,15 @@
+import json
 import pytest
 from django.db import connections
 from flaky import flaky
 
 from capapi import api_reverse
+from capapi.models import CapUser
+from capdb.models import CaseBodyCache, Jurisdiction
 from scripts.set_up_postgres import extension_installed
 from test_data.test_fixtures.factories import *
 from scripts.process_metadata import parse_decision_date
-from capapi.tests.helpers import check_response
+from capapi.tests.helpers import check_response, preload_filter_choices
 
 @pytest.mark.django_db
 def test_flow(client, case):
@@ -75,13 +78,64 @@ def test_model_endpoint(request, client, fixture_name, detail_attr, comparison_a
 
 @pytest.mark.django_db
 def test_cases_count_cache(client, three_cases, django_assert_num_queries):
-    # fetching same endpoint a second time should have one less query, because queryset.count() is cached
-    with django_assert_num_queries(select=3):
-        response = client.get(api_reverse('casemetadata-list'))
+    # fetching same endpoint a second time should have fewer queries, because queryset.count() is cached
+    params = {'name_abbreviation': 'Foo'}
+    preload_filter_choices()
+    with django_assert_num_queries(select=3, explain=1):
+        response = client.get(api_reverse('casemetadata-list'), params)
         assert response.json()['count'] == 3
     with django_assert_num_queries(select=2):
+        response = client.get(api_reverse('casemetadata-list'), params)
+        assert response.json()['count'] == 3
+        assert response.json()['count_exact'] is True
+
+    # unfiltered counts come from CaseCountRollup instead
+    with django_assert_num_queries(select=3):
         response = client.get(api_reverse('casemetadata-list'))
         assert response.json()['count'] == 3
+        assert response.json()['count_exact'] is True
+
+
+@pytest.mark.django_db
+def test_filter_choices_refresh(client, jurisdiction):
+    # filter choices are shared between requests, but refresh when a jurisdiction is saved
+    response = client.get(api_reverse("casemetadata-list"), {"jurisdiction": "foo-bar"})
+    check_response(response, status_code=400)
+    jurisdiction.slug = "foo-bar"
+    jurisdiction.save()
+    response = client.get(api_reverse("casemetadata-list"), {"jurisdiction": "foo-bar"})
+    check_response(response)
+
+
+@pytest.mark.django_db
+def test_filter_choices_version_checks(jurisdiction, monkeypatch):
+    # iterating, len() and `in` check the shared lookup version at most once per version_check_interval
+    from capapi.filters import jur_choices
+    checks = []
+    lookup_version = Jurisdiction.lookup_version
+    monkeypatch.setattr(Jurisdiction, 'lookup_version', classmethod(lambda cls: checks.append(1) or lookup_version()))
+    Jurisdiction.bump_lookup_version()
+    assert (jurisdiction.slug, jurisdiction.name_long) in list(jur_choices)
+    assert (jurisdiction.slug, jurisdiction.name_long) in jur_choices
+    assert len(jur_choices) == len(list(jur_choices)) == Jurisdiction.objects.count()
+    assert len(checks) == 1
+
+    # once the interval has passed, the next access checks again
+    monkeypatch.setattr(Jurisdiction, 'version_check_interval', -1)
+    list(jur_choices)
+    assert len(checks) == 2
+
+
+@pytest.mark.django_db
+def test_cases_count_estimate(client, three_cases, settings):
+    # counts estimated above the threshold are returned as estimates, and counted exactly by cache_query_count
+    settings.LIVE_COUNT_ESTIMATE_THRESHOLD = 0
+    params = {'name_abbreviation': 'Foo'}
+    content = client.get(api_reverse('casemetadata-list'), params).json()
+    assert content['count_exact'] is False
+    content = client.get(api_reverse('casemetadata-list'), params).json()
+    assert content['count'] == 3
+    assert content['count_exact'] is True
 
 
 # REQUEST AUTHORIZATION
@@ -251,8 +305,19 @@ def test_harvard_access(request, case, client_fixture_name):
     assert result['casebody']['status'] != 'ok'
 
 
+def record_reservations(monkeypatch):
+    """ Record the case_count of each CapUser.reserve_case_allowance() call. """
+    reservations = []
+    reserve_case_allowance = CapUser.reserve_case_allowance
+    def reserve(user, case_count):
+        reservations.append(case_count)
+        return reserve_case_allowance(user, case_count)
+    monkeypatch.setattr(CapUser, 'reserve_case_allowance', reserve)
+    return reservations
+
+
 @pytest.mark.django_db
-def test_authenticated_multiple_full_cases(auth_user, auth_client, three_cases, jurisdiction, django_assert_num_queries):
+def test_authenticated_multiple_full_cases(auth_user, auth_client, three_cases, jurisdiction, django_assert_num_queries, monkeypatch):
     ### mixed requests should be counted only for blacklisted cases
 
     # one whitelisted case
@@ -265,9 +330,8 @@ def test_authenticated_multiple_full_cases(auth_user, auth_client, three_cases,
     for extra_case in three_cases[1:]:
         extra_case.jurisdiction = jurisdiction
         extra_case.save()
-    # preload capapi.filters.jur_choices so it doesn't sometimes get counted by django_assert_num_queries below
-    from capapi.filters import jur_choices
-    len(jur_choices)
+    preload_filter_choices()
+    reservations = record_reservations(monkeypatch)
 
     # fetch the two blacklisted cases and one whitelisted case
     with django_assert_num_queries(select=3):
@@ -276,6 +340,41 @@ def test_authenticated_multiple_full_cases(auth_user, auth_client, three_cases,
     # make sure the auth_user's case download number has gone down by 2
     auth_user.refresh_from_db()
     assert auth_user.case_allowance_remaining == auth_user.total_case_allowance - 2
+    # and that only the blacklisted cases were reserved, leaving the rest for concurrent requests
+    assert reservations == [2]
+
+
+@pytest.mark.django_db
+def test_streamed_full_cases(auth_user, auth_client, three_cases, jurisdiction, monkeypatch):
+    # one whitelisted case and two blacklisted cases, as in test_authenticated_multiple_full_cases
+    three_cases[0].jurisdiction.whitelisted = True
+    three_cases[0].jurisdiction.save()
+    jurisdiction.whitelisted = False
+    jurisdiction.save()
+    for extra_case in three_cases[1:]:
+        extra_case.jurisdiction = jurisdiction
+        extra_case.save()
+    url = api_reverse("casemetadata-list")
+
+    def get_streamed(*args):
+        response = auth_client.get(*args)
+        assert response.status_code == 200
+        assert response.streaming
+        return json.loads(b''.join(response.streaming_content).decode())
+
+    # allowance is charged once for the page's blacklisted cases, and the response matches an unstreamed one
+    reservations = record_reservations(monkeypatch)
+    streamed = get_streamed(url, {"full_case": "true", "stream": "true"})
+    assert reservations == [2]
+    auth_user.refresh_from_db()
+    assert auth_user.case_allowance_remaining == auth_user.total_case_allowance - 2
+    assert streamed == auth_client.get(url, {"full_case": "true"}).json()
+
+    # pagination links work the same way
+    first_page = get_streamed(url, {"full_case": "true", "stream": "true", "page_size": 2})
+    assert first_page['count'] == 3
+    second_page = get_streamed(first_page['next'])
+    assert [case['id'] for case in first_page['results'] + second_page['results']] == [case['id'] for case in streamed['results']]
 
 
 # CITATION REDIRECTS
@@ -356,6 +455,24 @@ def test_body_format_html(auth_client, case):
     data = get_casebody_data_with_format(auth_client, case, "html")
     assert "</h4>" in data
 
+@pytest.mark.django_db
+def test_body_format_default_body_cache(auth_client, three_cases):
+    # CaseBodyCache.json is passed through to the response without re-encoding
+    bodies = {}
+    for i, case in enumerate(three_cases):
+        bodies[case.id] = {'head_matter': 'Head \u2028 matter %s' % i, 'judges': [], 'attorneys': [], 'parties': ['"A" v. B'], 'opinions': []}
+        CaseBodyCache.objects.create(metadata=case, json=bodies[case.id])
+    response = auth_client.get(api_reverse("casemetadata-list"), {"full_case": "true"})
+    check_response(response)
+    assert '\u2028' not in response.content.decode()
+    results = response.json()['results']
+    assert {case['id']: case['casebody']['data'] for case in results} == bodies
+
+    # metadata is the same as for metadata-only requests
+    for case in results:
+        del case['casebody']
+    assert results == auth_client.get(api_reverse("casemetadata-list")).json()['results']
+
 @pytest.mark.django_db
 def test_full_text_search(client, ingest_case_xml):
     # the postgres rum extension isn't always available, which causes this view to fail with "operator does not exist"
@@ -374,7 +491,7 @@ def test_full_text_search(client, ingest_case_xml):
     assert [wrong_case.id] != [result['id'] for result in content['results']]
     response = client.get(api_reverse("casemetadata-list"), {"search": "Punk in Drublic"})
     content = response.json()
-    assert content == {'previous': None, 'count': 0, 'results': [], 'next': None}
+    assert content == {'previous': None, 'count': 0, 'count_exact': True, 'results': [], 'next': None}
 
 # FILTERING
 @pytest.mark.django_db
@@ -510,6 +627,61 @@ def test_ngrams_api(client, ngrammed_cases):
         "three don't": {
             'total': [{'year': '2000', 'count': [2, 9], 'doc_count': [2, 3]}]}}
 
+    # check batch lookup
+    json = client.get(api_reverse('ngrams-list'), {'q': ['one two', 'three *', 'not found']}).json()
+    assert json['count'] == 3
+    assert json['results'] == {
+        'one two': {
+            'total': [{'year': '2000', 'count': [2, 9], 'doc_count': [2, 3]}]},
+        'three four': {
+            'total': [{'year': '2000', 'count': [1, 9], 'doc_count': [1, 3]}]},
+        "three don't": {
+            'total': [{'year': '2000', 'count': [2, 9], 'doc_count': [2, 3]}]}}
+
+    # check year range
+    json = client.get(api_reverse('ngrams-list'), {'q': 'one two', 'year_min': '2000', 'year_max': '2000'}).json()
+    assert json['results'] == {
+        'one two': {
+            'total': [{'year': '2000', 'count': [2, 9], 'doc_count': [2, 3]}]}}
+    json = client.get(api_reverse('ngrams-list'), {'q': 'one two', 'year_min': '2001', 'jurisdiction': '*'}).json()
+    assert json['results'] == {'one two': {'total': [], 'jur0': [], 'jur1': []}}
+
+    # check decade buckets and moving averages
+    json = client.get(api_reverse('ngrams-list'), {'q': 'one two', 'bucket': 'decade'}).json()
+    assert json['results'] == {
+        'one two': {
+            'total': [{'year': '2000', 'count': [2, 9], 'doc_count': [2, 3]}]}}
+    json = client.get(api_reverse('ngrams-list'), {'q': 'one two', 'moving_average': '2'}).json()
+    assert json['results'] == {
+        'one two': {
+            'total': [{'year': '2000', 'count': [1, 4.5], 'doc_count': [1, 1.5]}]}}
+
+
+@flaky(max_runs=10)  # ngrammed_cases call to ngram_jurisdictions doesn't reliably work because it uses multiprocessing within pytest environment
+@pytest.mark.django_db
+def test_ngrams_totals_cache(client, ngrammed_cases):
+    from capapi.views.api_views import ngram_totals_cache
+    from capdb.storages import ngram_kv_store
+
+    # totals are loaded once and reused across requests
+    ngram_totals_cache.clear()
+    client.get(api_reverse('ngrams-list'), {'q': 'one two'})
+    misses = ngram_totals_cache.metrics['misses']
+    hits = ngram_totals_cache.metrics['hits']
+    index = ngram_totals_cache.index
+    client.get(api_reverse('ngrams-list'), {'q': 'one two'})
+    assert ngram_totals_cache.metrics['misses'] == misses
+    assert ngram_totals_cache.metrics['hits'] == hits + 1
+    assert ngram_totals_cache.index is index
+
+    # writing a new generation marker triggers a reload
+    reloads = ngram_totals_cache.metrics['reloads']
+    ngram_kv_store.bump_generation()
+    json = client.get(api_reverse('ngrams-list'), {'q': 'one two'}).json()
+    assert ngram_totals_cache.metrics['reloads'] == reloads + 1
+    assert ngram_totals_cache.index is not index
+    assert json['results']['one two']['total'][0]['count'] == [2, 9]
+
 
 # RESPONSE FORMATS
 @pytest.mark.django_db
@@ -570,3 +742,77 @@ def test_pagination(client, three_cases):
     assert content['next'] is None
 
     assert set(ids) == set(case.id for case in three_cases)
+
+
+@pytest.mark.django_db
+def test_pagination_keyset(client, three_cases):
+    # cases that share a decision_date can only be told apart by id, so cursors have to compare both
+    for case in three_cases:
+        case.decision_date = three_cases[0].decision_date
+        case.save()
+    expected_ids = sorted(case.id for case in three_cases)
+
+    ids = []
+    content = client.get(api_reverse("casemetadata-list"), {"page_size": 1}).json()
+    while True:
+        ids.extend(result['id'] for result in content['results'])
+        if not content['next']:
+            break
+        content = client.get(content['next']).json()
+    assert ids == expected_ids
+
+    # and back again
+    ids = []
+    while content['previous']:
+        content = client.get(content['previous']).json()
+        ids.extend(result['id'] for result in content['results'])
+    assert ids == list(reversed(expected_ids[:-1]))
+
+
+@pytest.mark.django_db
+def test_pagination_keyset_nulls(client, three_cases):
+    # decision_date is nullable, and NULLs sort last going forward and first going back, so cursors on either side of
+    # them have to include or exclude them explicitly
+    three_cases = sorted(three_cases, key=lambda case: case.id)
+    for case, decision_date in zip(three_cases, [None, three_cases[1].decision_date, None]):
+        case.decision_date = decision_date
+        case.save()
+    expected_ids = [three_cases[1].id, three_cases[0].id, three_cases[2].id]
+
+    ids = []
+    content = client.get(api_reverse("casemetadata-list"), {"page_size": 1}).json()
+    while True:
+        ids.extend(result['id'] for result in content['results'])
+        if not content['next']:
+            break
+        content = client.get(content['next']).json()
+    assert ids == expected_ids
+
+    # and back again
+    ids = []
+    while content['previous']:
+        content = client.get(content['previous']).json()
+        ids.extend(result['id'] for result in content['results'])
+    assert ids == list(reversed(expected_ids[:-1]))
+
+    # a page can run from the dated cases on into the NULL ones
+    content = client.get(api_reverse("casemetadata-list"), {"page_size": 1}).json()
+    content = client.get(content['next'].replace('page_size=1', 'page_size=2')).json()
+    assert [result['id'] for result in content['results']] == expected_ids[1:]
+
+
+@pytest.mark.django_db
+def test_pagination_keyset_row_comparison(case):
+    from capapi.pagination import CapPagination
+    from capapi.views.api_views import CaseViewSet
+
+    # forward pages from a dated cursor in the default ordering are a single row comparison, which postgres can answer
+    # by walking idx_in_scope from the cursor, and the NULL dates that sort after them are a separate query
+    paginator = CapPagination()
+    paginator.ordering = paginator.get_ordering(None, CaseViewSet.queryset, None)
+    assert paginator.ordering == ('decision_date', 'id')
+    dated, nulls = paginator.keyset_querysets(CaseViewSet.queryset, [case.decision_date, case.id], False)
+    sql = str(dated.query)
+    assert '("capdb_casemetadata"."decision_date", "capdb_casemetadata"."id") > (' in sql
+    assert 'IS NULL' not in sql
+    assert '"capdb_casemetadata"."decision_date" IS NULL' in str(nulls.query)
@@ -19,3 +19,54 @@ def test_CaseSerializerWithCasebody(api_request_factory, case, three_cases):
     assert len(serialized.data) == 3
     for case in serialized.data:
         assert 'casebody' in case.keys()
+
+
+class UncachedCaseSerializer(serializers.CaseSerializer):
+    metadata_cache_prefix = None
+
+
+@pytest.mark.django_db
+def test_CaseSerializer_metadata_cache(api_request_factory, three_cases):
+    request = api_request_factory.get(api_reverse("casemetadata-list"))
+    serializer_context = {'request': Request(request)}
+
+    def serialize(serializer_class=serializers.CaseSerializer):
+        return serializer_class(three_cases, many=True, context=serializer_context).data
+
+    # cached output matches uncached output, whether or not it was already cached
+    uncached = serialize(UncachedCaseSerializer)
+    assert serialize() == uncached
+    assert serialize() == uncached
+
+    # editing a case changes the cache key, so the edit shows up right away
+    case = three_cases[0]
+    case.name_abbreviation = 'Edited v. Edited'
+    case.save()
+    assert serialize()[0]['name_abbreviation'] == 'Edited v. Edited'
+    assert serialize() == serialize(UncachedCaseSerializer)
+
+
+class CacheCallRecorder:
+    """ Wrap a cache, recording the name of each method called on it. """
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.cache, name)
+
+
+@pytest.mark.django_db
+def test_CaseSerializer_metadata_cache_calls(api_request_factory, three_cases, monkeypatch):
+    request = api_request_factory.get(api_reverse("casemetadata-list"))
+    serializer_context = {'request': Request(request)}
+    recorder = CacheCallRecorder(serializers.cache)
+    monkeypatch.setattr(serializers, 'cache', recorder)
+
+    # a cold page is read with one call and written with one call, and a warm page is only read
+    serializers.CaseSerializer(three_cases, many=True, context=serializer_context).data
+    assert recorder.calls == ['get_many', 'set_many']
+    recorder.calls.clear()
+    serializers.CaseSerializer(three_cases, many=True, context=serializer_context).data
+    assert recorder.calls == ['get_many']
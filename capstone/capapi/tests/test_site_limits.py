@@ -1,13 +1,17 @@
 import re
+import threading
+from multiprocessing.pool import ThreadPool
 
 import pytest
 from django.core import mail
+from django.db import connections
 
 from capapi.resources import api_reverse
 from capapi.models import SiteLimits, CapUser
 from capapi.tasks import daily_site_limit_reset_and_report
 from capapi.tests.helpers import check_response
 from capweb.helpers import reverse
+from test_data.test_fixtures.fixtures import CapClient
 
 
 @pytest.mark.django_db
@@ -78,3 +82,41 @@ def test_site_limits(client, auth_client, case, mailoutbox):
     assert last_mail.subject == 'CAP daily usage: 1 registered users, 1 blacklisted downloads'
 
 
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_case_allowance(token_auth_client, three_cases, jurisdiction):
+    # 32 clients fetching the same three blacklisted cases at once, as the same user with an allowance of 50
+    client_count = 32
+    jurisdiction.whitelisted = False
+    jurisdiction.save()
+    for case in three_cases:
+        case.jurisdiction = jurisdiction
+        case.save()
+    user = token_auth_client.auth_user
+    user.total_case_allowance = user.case_allowance_remaining = 50
+    user.save()
+    url = api_reverse('casemetadata-list')
+    barrier = threading.Barrier(client_count)
+
+    def fetch(_):
+        client = CapClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + user.get_api_key())
+        barrier.wait()
+        try:
+            response = client.get(url, {'full_case': 'true'})
+            return [case['casebody']['status'] for case in response.json()['results']]
+        finally:
+            connections.close_all()
+
+    with ThreadPool(client_count) as pool:
+        results = pool.map(fetch, range(client_count))
+
+    # exactly the allowance was handed out and counted, with no lost or double-counted updates
+    statuses = [status for result in results for status in result]
+    assert len(statuses) == client_count * 3
+    assert statuses.count('ok') == 50
+    assert set(statuses) == {'ok', 'error_limit_exceeded'}
+    user.refresh_from_db()
+    assert user.case_allowance_remaining == 0
+    assert SiteLimits.get().daily_downloads == 50
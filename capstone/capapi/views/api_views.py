@@ -1,10 +1,13 @@
-import bisect
+import logging
 import re
+import threading
 import urllib
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 from pathlib import Path
 
-from django.http import HttpResponseRedirect, FileResponse
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.http import HttpResponseRedirect, FileResponse, StreamingHttpResponse
 from django.utils.text import slugify
 
 from rest_framework import viewsets, renderers, mixins
@@ -19,7 +22,7 @@ from capapi.serializers import CaseDocumentSerializer
 from capapi.middleware import add_cache_header
 from capdb import models
 from capdb.models import Citation
-from capdb.storages import ngram_kv_store_ro
+from capdb.storages import ngram_kv_store_ro, NgramRocksDB, NgramValue
 
 from django_elasticsearch_dsl_drf.constants import (
     LOOKUP_FILTER_RANGE,
@@ -36,6 +39,8 @@ from django_elasticsearch_dsl_drf.filter_backends import (
     SimpleQueryStringSearchFilterBackend)
 from django_elasticsearch_dsl_drf.viewsets import BaseDocumentViewSet
 
+logger = logging.getLogger(__name__)
+
 
 class BaseViewSet(viewsets.ReadOnlyModelViewSet):
     http_method_names = ['get']
@@ -86,7 +91,7 @@ class CaseViewSet(BaseViewSet):
     )
 
     renderer_classes = (
-        renderers.JSONRenderer,
+        capapi_renderers.FastJSONRenderer,
         capapi_renderers.BrowsableAPIRenderer,
         capapi_renderers.XMLRenderer,
         capapi_renderers.HTMLRenderer,
@@ -99,7 +104,15 @@ class CaseViewSet(BaseViewSet):
 
     def get_queryset(self):
         if self.is_full_case_request():
-            return self.queryset.select_related('case_xml', 'body_cache')
+            queryset = self.queryset.select_related('case_xml', 'body_cache')
+            if (
+                type(getattr(self.request, 'accepted_renderer', None)) == capapi_renderers.FastJSONRenderer and
+                self.request.query_params.get('body_format', None) not in ('html', 'xml', 'tokens')
+            ):
+                # fetch CaseBodyCache.json as text, for get_casebody() to pass through to the response as-is
+                queryset = queryset.defer('body_cache__json').annotate(
+                    body_cache_json_text=Cast('body_cache__json', TextField()))
+            return queryset
         else:
             return self.queryset
 
@@ -109,11 +122,63 @@ class CaseViewSet(BaseViewSet):
         else:
             return self.serializer_class
 
+    # number of full cases fetched and serialized at a time by stream_list()
+    stream_chunk_size = 10
+
+    def is_streaming_request(self):
+        return (
+            self.is_full_case_request() and
+            self.request.query_params.get('stream', 'false').lower() == 'true' and
+            type(self.request.accepted_renderer) == capapi_renderers.FastJSONRenderer
+        )
+
+    def stream_list(self):
+        """
+            Return a page of full cases as a StreamingHttpResponse, so the worker only holds stream_chunk_size case
+            bodies in memory at a time instead of the whole page.
+
+            The page is first paginated from metadata alone, which gives the count and next/previous links for the
+            envelope. Case allowance is reserved for the page's non-whitelisted cases up front, in one case_allowance()
+            block, so the allowance is settled before the response is sent -- as with unstreamed pages, cases are
+            counted once the page is prepared. Full cases are then fetched, serialized and sent a chunk at a time.
+        """
+        request = self.request
+        page = self.paginate_queryset(self.filter_queryset(self.queryset).select_related(None).prefetch_related(None))
+
+        with serializers.case_allowance(request, sum(1 for case in page if permissions.uses_case_allowance(case))):
+            casebody_statuses = {case.id: permissions.get_single_casebody_permissions(request, case)['status'] for case in page}
+
+        renderer = request.accepted_renderer
+        renderer_context = self.get_renderer_context()
+        serializer = self.get_serializer_class()(context=dict(self.get_serializer_context(), casebody_statuses=casebody_statuses))
+        full_queryset = self.get_queryset()
+
+        def stream():
+            # render the envelope with empty results, and send the cases between its brackets
+            envelope = renderer.render(self.paginator.get_paginated_response([]).data, renderer.media_type, renderer_context)
+            results_end = envelope.rindex(b'[]') + 1
+            yield envelope[:results_end]
+            separator = b''
+            for i in range(0, len(page), self.stream_chunk_size):
+                case_ids = [case.id for case in page[i:i+self.stream_chunk_size]]
+                cases = {case.id: case for case in full_queryset.filter(id__in=case_ids)}
+                cases = [cases[case_id] for case_id in case_ids if case_id in cases]
+                serializer.prefetch_metadata(cases)
+                for case in cases:
+                    yield separator + renderer.render(serializer.to_representation(case), renderer.media_type, renderer_context)
+                    separator = b','
+                serializer.save_metadata()
+            yield envelope[results_end:]
+
+        return StreamingHttpResponse(stream(), content_type=renderer.media_type)
+
     def list(self, *args, **kwargs):
         jur_value = self.request.query_params.get('jurisdiction', None)
         jur_slug = slugify(jur_value)
 
         if not jur_value or jur_slug == jur_value:
+            if self.is_streaming_request():
+                return self.stream_list()
             return super(CaseViewSet, self).list(*args, **kwargs)
 
         query_string = urllib.parse.urlencode(dict(self.request.query_params, jurisdiction=jur_slug), doseq=True)
@@ -320,26 +385,64 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         capapi_renderers.NgramBrowsableAPIRenderer,
     )
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # cache translation table between jurisdiction slug and ID
+    # most terms that can be looked up in one request
+    max_terms = 20
 
-        self.jurisdiction_id_to_slug = dict(models.Jurisdiction.objects.values_list('pk', 'slug'))
-        self.jurisdiction_id_to_slug[None] = 'total'
-        self.jurisdiction_slug_to_id = {v:k for k,v in self.jurisdiction_id_to_slug.items()}
-        self.totals_by_jurisdiction_year_length = self.load_totals()
+    # bucket= choices, and their sizes in years
+    bucket_sizes = {'decade': 10}
+    max_moving_average = 100
+
+    @staticmethod
+    def smooth_series(rows, totals, jur_id, q_len, year_included, bucket_size=None, window=None):
+        """
+            Given rows of (<year>, <count>, <doc_count>) sorted by year, return rows of
+            (<year>, <count>, <doc_count>, <total count>, <total doc_count>), with totals summed over the years that
+            year_included() accepts.
+
+            If bucket_size is set, years are grouped into buckets of that many years, labeled with their first year.
+            If window is set, each bucket's counts and totals are then replaced by their mean over the last `window`
+            buckets, including buckets where the gram wasn't observed, so ratios of count to total stay meaningful.
+        """
+        step = bucket_size or 1
+        counts = OrderedDict()
+        for year, count, doc_count in rows:
+            bucket = counts.setdefault(year - year % step, [0, 0])
+            bucket[0] += count
+            bucket[1] += doc_count
+        if not counts:
+            return []
+
+        def bucket_totals(start):
+            bucket = [0, 0]
+            for year in range(start, start + step):
+                if year_included(year):
+                    total = totals.get((jur_id, year, q_len), (0, 0))
+                    bucket[0] += total[0]
+                    bucket[1] += total[1]
+            return bucket
+
+        if not window:
+            return [(start,) + tuple(bucket) + tuple(bucket_totals(start)) for start, bucket in counts.items()]
+
+        starts = list(counts)
+        buckets = [
+            counts.get(start, [0, 0]) + bucket_totals(start)
+            for start in range(starts[0] - step * (window - 1), starts[-1] + step, step)]
+        return [
+            (starts[0] + step * i,) + tuple(sum(column) / window for column in zip(*buckets[i:i + window]))
+            for i in range(len(buckets) - window + 1)]
 
     @staticmethod
     def load_totals():
-        # populate self.totals_by_jurisdiction_year_length, a mapping of jurisdiction-year-length to counts, like:
+        # return a mapping of jurisdiction-year-length to counts, like:
         #   {
         #       (<jur_id>, <year>, <length>): (<word count>, <document count>),
         #   }
         if not Path(ngram_kv_store_ro.db_path()).exists():
             return {}
         totals_by_jurisdiction_year_length = defaultdict(lambda: [0,0])
-        for k, v in ngram_kv_store_ro.get_prefix(b'totals', packed=True):
-            jur, year, n = ngram_kv_store_ro.unpack(k[len(b'totals'):])
+        for k, v in ngram_kv_store_ro.get_prefix(NgramRocksDB.totals_key_prefix, packed=True):
+            jur, year, n = ngram_kv_store_ro.unpack(k[len(NgramRocksDB.totals_key_prefix):])
             totals_by_jurisdiction_year_length[(jur, year, n)] = v
             for total in (
                 totals_by_jurisdiction_year_length[(None, year, n)],
@@ -350,26 +453,36 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         return totals_by_jurisdiction_year_length
 
     def list(self, request, *args, **kwargs):
-        # without specific ngram search, return nothing
-        q = self.request.GET.get('q', '').strip().lower()
-        if not q:
+        # without specific ngram search, return nothing. Several terms can be looked up at once with q=...&q=...
+        terms = [q.strip().lower() for q in self.request.GET.getlist('q')]
+        terms = [q for q in terms if q][:self.max_terms]
+        if not terms:
             return Response({})
 
-        ## look up query in KV store
-        words = q.split(' ')[:3]  # use first 3 words
-        q_len = len(words)
-        # prepend word count as first byte
-        q = bytes([q_len]) + ' '.join(words).encode('utf8')
-        if q.endswith(b' *'):
-            # wildcard search
-            pairs = ngram_kv_store_ro.get_prefix(q[:-1], packed=True)
-        else:
-            # non-wildcard search
-            value = ngram_kv_store_ro.get(q, packed=True)
-            if value:
-                pairs = [(q, value)]
+        # shared per-process lookup tables -- see NgramTotalsCache
+        totals_index = ngram_totals_cache.get()
+
+        ## look up queries in KV store
+        keys = []
+        for q in terms:
+            words = q.split(' ')[:3]  # use first 3 words
+            # prepend word count as first byte
+            keys.append(bytes([len(words)]) + ' '.join(words).encode('utf8'))
+
+        # fetch all non-wildcard searches in one call
+        values = ngram_kv_store_ro.get_many(set(k for k in keys if not k.endswith(b' *')))
+
+        pairs = []
+        for q in keys:
+            if q.endswith(b' *'):
+                # wildcard search -- get top 10 matches by total count
+                pairs.extend(ngram_kv_store_ro.get_top_prefix(q[:-1], 10))
             else:
-                pairs = []
+                # non-wildcard search
+                value = values[q]
+                # a gram can be left with zero counts once incremental updates subtract all of its observations
+                if value and NgramValue.totals(value)[0] > 0:
+                    pairs.append((q, value))
 
         ## format results
         results = OrderedDict()
@@ -380,7 +493,7 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             if '*' in jurisdictions:
                 jurisdiction_filter = None
             else:
-                jurisdiction_filter = set(self.jurisdiction_slug_to_id[j] for j in jurisdictions if j in self.jurisdiction_slug_to_id)
+                jurisdiction_filter = set(totals_index.jurisdiction_slug_to_id[j] for j in jurisdictions if j in totals_index.jurisdiction_slug_to_id)
                 if not jurisdiction_filter:
                     jurisdiction_filter.add(None)
 
@@ -390,23 +503,32 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
                 if year.isdigit():
                     year_filter.add(int(year))
 
-            # get top 10 pairs
-            top_pairs = []
-            for gram, data in pairs:
-                total_jur = data[None]
-                sort_count = total_jur[None][0]
-                bisect.insort_right(top_pairs, (sort_count, gram, data))
-                top_pairs = top_pairs[-10:]
+            # prepare year range from year_min= and year_max= query params, to be pushed down into NgramValue.select()
+            year_min, year_max = (
+                int(year) if year.isdigit() else None
+                for year in (request.GET.get('year_min', ''), request.GET.get('year_max', '')))
+
+            def year_included(year):
+                return (
+                    (not year_filter or year in year_filter)
+                    and (year_min is None or year >= year_min)
+                    and (year_max is None or year <= year_max))
+
+            # prepare smoothing from bucket= and moving_average= query params
+            bucket_size = self.bucket_sizes.get(request.GET.get('bucket'))
+            window = request.GET.get('moving_average', '')
+            window = min(int(window), self.max_moving_average) if window.isdigit() and int(window) > 1 else None
 
             # Reformat stored gram data for delivery.
-            # top_pairs will look like:
+            # pairs will look like:
             #   [
-            #     (<sort_count>, b'<wordcount><gram>', {
-            #       <jur_id>: [
-            #         <year - 1900>, <instance_count>, <document_count>,
-            #         <year - 1900>, <instance_count>, <document_count>, ...
-            #     ]),
-            #  ]
+            #     (b'<wordcount><gram>', <NgramValue-encoded counts>),
+            #   ]
+            # The requested jurisdictions and years are sliced out of each value by NgramValue.select() as:
+            #   {
+            #     <jurisdiction_id>: [(<year - 1900>, <instance_count>, <document_count>), ...]
+            #   }
+            # with the 'total' pseudo-jurisdiction, ID None, summed across jurisdictions.
             # this reformats to:
             #  {
             #    <jurisdiction slug>: [
@@ -417,41 +539,25 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             #      }
             #    ]
             #  }
-            for _, gram, data in reversed(top_pairs):
+            storage_year_min = None if year_min is None else year_min - 1900
+            storage_year_max = None if year_max is None else year_max - 1900
+            for gram, data in pairs:
                 out = {}
-                for jur_id, years in data.items():
+                selected = NgramValue.select(data, jurisdiction_filter, storage_year_min, storage_year_max)
+                for jur_id, years in selected.items():
+                    jur_slug = totals_index.jurisdiction_id_to_slug[jur_id]
 
-                    # apply jurisdiction_filter
-                    if jurisdiction_filter and jur_id not in jurisdiction_filter:
-                        continue
+                    # years will be -1900 for compression -- add 1900 back in
+                    rows = [(year + 1900, count, doc_count) for year, count, doc_count in years if year_included(year + 1900)]
 
-                    years_out = []
-                    jur_slug = self.jurisdiction_id_to_slug[jur_id]
-                    if jur_id is None:
-                        years = [i for k, v in years.items() for i in [k]+v]
-                    for i in range(0, len(years), 3):
-                        year, count, doc_count = years[i:i+3]
-
-                        # filter out total
-                        if year is None:
-                            continue
-
-                        # years will be -1900 for msgpack compression -- add 1900 back in
-                        year += 1900
-
-                        # apply year filter
-                        if year_filter and year not in year_filter:
-                            continue
-
-                        totals = self.totals_by_jurisdiction_year_length[(jur_id, year, q_len)]
-                        years_out.append(OrderedDict((
+                    out[jur_slug] = [
+                        OrderedDict((
                             ("year", str(year) if year else "total"),
-                            ("count", [count, totals[0]]),
-                            ("doc_count", [doc_count, totals[1]]),
-                        )))
-
-                    years_out.sort(key=lambda y: y["year"])
-                    out[jur_slug] = years_out
+                            ("count", [count, total_count]),
+                            ("doc_count", [doc_count, total_doc_count]),
+                        ))
+                        for year, count, doc_count, total_count, total_doc_count
+                        in self.smooth_series(rows, totals_index.totals, jur_id, gram[0], year_included, bucket_size, window)]
 
                 if out:
                     results[gram[1:].decode('utf8')] = out
@@ -465,3 +571,67 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
         return Response(paginated)
 
+
+
+NgramTotalsIndex = namedtuple('NgramTotalsIndex', ['generation', 'totals', 'jurisdiction_id_to_slug', 'jurisdiction_slug_to_id'])
+
+
+class NgramTotalsCache:
+    """
+        Process-wide cache of the lookup tables NgramViewSet needs for every request: the totals for each
+        jurisdiction-year-length, and translation tables between jurisdiction ID and slug.
+
+        DRF instantiates a new viewset for every request, so these are kept here instead, loaded lazily on first use
+        and shared by all threads. Each get() checks the generation marker written by ngram_jurisdictions(), and
+        reopens the read-only database and reloads the index if the ngram database has changed.
+
+        self.metrics counts hits, misses (loads) and reloads (loads caused by a generation change). Counters are
+        updated without locking, so may undercount slightly under heavy concurrency.
+    """
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'reloads': 0}
+
+    @staticmethod
+    def get_generation():
+        return ngram_kv_store_ro.db_path(), ngram_kv_store_ro.get_generation()
+
+    def get(self):
+        """ Return the current NgramTotalsIndex, loading it if it is missing or stale. """
+        generation = self.get_generation()
+        index = self.index
+        if index is None or index.generation != generation:
+            with self.lock:
+                # check again in case another thread loaded while we waited for the lock
+                index = self.index
+                if index is None or index.generation != generation:
+                    return self.load(generation)
+        self.metrics['hits'] += 1
+        return index
+
+    def load(self, generation):
+        self.metrics['misses'] += 1
+        if self.index is not None:
+            self.metrics['reloads'] += 1
+            logger.info("Reloading ngram totals for generation %s" % (generation,))
+            # read-only handles don't see writes made after they were opened
+            if self.index.generation[0] == generation[0] and Path(ngram_kv_store_ro.db_path()).exists():
+                ngram_kv_store_ro.open()
+
+        jurisdiction_id_to_slug = dict(models.Jurisdiction.objects.values_list('pk', 'slug'))
+        jurisdiction_id_to_slug[None] = 'total'
+        self.index = NgramTotalsIndex(
+            generation=generation,
+            totals=dict(NgramViewSet.load_totals()),
+            jurisdiction_id_to_slug=jurisdiction_id_to_slug,
+            jurisdiction_slug_to_id={v: k for k, v in jurisdiction_id_to_slug.items()},
+        )
+        return self.index
+
+    def clear(self):
+        """ Drop the cached index so the next get() loads from scratch. """
+        with self.lock:
+            self.index = None
+
+ngram_totals_cache = NgramTotalsCache()
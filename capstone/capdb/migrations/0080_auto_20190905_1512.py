@@ -0,0 +1,17 @@
+# Generated by Django 2.2.4 on 2019-09-05 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capdb', '0079_auto_20190829_1749'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='casemetadata',
+            index=models.Index(condition=models.Q(in_scope=True), fields=['court', 'decision_date', 'id'], name='idx_in_scope_court_id'),
+        ),
+    ]
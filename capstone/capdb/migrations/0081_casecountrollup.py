@@ -0,0 +1,34 @@
+# Generated by Django 2.2.4 on 2019-09-09 14:21
+
+from django.db import migrations, models
+from scripts.set_up_postgres import set_case_count_rollup_trigger, rebuild_case_count_rollups
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capdb', '0080_auto_20190905_1512'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseCountRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jurisdiction_id', models.IntegerField(default=0)),
+                ('court_id', models.IntegerField(default=0)),
+                ('reporter_id', models.IntegerField(default=0)),
+                ('volume_id', models.CharField(default='', max_length=64)),
+                ('year', models.IntegerField(default=0)),
+                ('in_scope', models.BooleanField(default=False)),
+                ('duplicative', models.BooleanField(default=False)),
+                ('case_count', models.IntegerField(default=0)),
+                ('page_count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('jurisdiction_id', 'court_id', 'reporter_id', 'volume_id', 'year', 'in_scope', 'duplicative')},
+            },
+        ),
+        migrations.RunPython(set_case_count_rollup_trigger, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_case_count_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.4 on 2019-09-12 11:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capdb', '0081_casecountrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='casebodycache',
+            name='render_digest',
+            field=models.CharField(blank=True, help_text='VolumeRenderer.input_digest() of the inputs these renditions were made from', max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='casebodycache',
+            name='render_version',
+            field=models.SmallIntegerField(blank=True, help_text='render_case.RENDER_VERSION these renditions were made with', null=True),
+        ),
+    ]
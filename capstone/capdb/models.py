@@ -4,15 +4,21 @@ import math
 import re
 from contextlib import contextmanager
 import struct
+import time
 import base64
+import billiard
 import nacl
 
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField, ArrayField
+from django.core.cache import cache as django_cache
 import django.contrib.postgres.search as pg_search
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, IntegrityError, transaction
+from django.db import models, IntegrityError, transaction, connections
 from django.db.models import Q
+from django.db.models.expressions import Col
+from django.db.models.lookups import Exact
+from django.db.models.sql.where import WhereNode
 from django.utils.text import slugify
 from django.utils.encoding import force_bytes, force_str
 from django.core.files.base import ContentFile
@@ -25,7 +31,7 @@ from bs4 import BeautifulSoup
 
 from capdb.storages import bulk_export_storage, case_image_storage
 from capdb.versioning import TemporalHistoricalRecords, TemporalQuerySet
-from capweb.helpers import reverse, transaction_safe_exceptions
+from capweb.helpers import reverse, transaction_safe_exceptions, cache_version, bump_cache_version
 from scripts import render_case
 from scripts.generate_case_html import generate_html
 from scripts.fix_court_tag.fix_court_tag import fix_court_tag
@@ -141,6 +147,17 @@ def fetch_relations(instance, select_relations=None, prefetch_relations=None):
             sub_instance._prefetched_objects_cache[sub_field_name] = sub_new_instance._prefetched_objects_cache[sub_field_name]
 
 
+# Arguments shared by every case rendered in a process pool by CaseMetadata.bulk_sync_case_body_cache(). This is set
+# before the pool is forked, so each worker inherits the volume's block maps once instead of receiving them with each
+# case.
+_render_pool_args = None
+
+def _render_pool_case(case):
+    """ Process pool worker for CaseMetadata.bulk_sync_case_body_cache(). """
+    blocks_by_id, fonts_by_id, labels_by_block_id, rerender, force = _render_pool_args
+    return case.get_case_body_cache_values(blocks_by_id, fonts_by_id, labels_by_block_id, rerender=rerender, force=force)
+
+
 class TransactionTimestampDateTimeField(models.DateTimeField):
     """ Postgres timestamp field that defaults to current_timestamp, the timestamp at the start of the transaction """
     def db_type(self, connection):
@@ -203,14 +220,67 @@ class AutoSlugMixin:
             "Either define a get_slug() method for %s, or pass slug_base to save()." % self.__class__.__name__)
 
 
-class CachedLookupMixin:
+class LookupVersionMixin:
+    """
+        Mixin for small lookup tables whose contents are cached across processes, like filter choices. Saving or
+        deleting an instance starts a new lookup_version(), so cache keys that include it are refreshed.
+    """
+
+    # Seconds between checks of the shared version in recent_lookup_version(). Saves in this process are noticed
+    # immediately.
+    version_check_interval = 1
+
+    # last value returned by lookup_version(), and when it was fetched:
+    _recent_version = None
+    _recent_version_checked_at = 0
+
+    @classmethod
+    def lookup_version(cls):
+        return cache_version('lookup:%s' % cls._meta.label)
+
+    @classmethod
+    def recent_lookup_version(cls):
+        """ lookup_version(), fetched from the shared cache at most once per version_check_interval. """
+        if time.time() - cls._recent_version_checked_at > cls.version_check_interval:
+            cls._recent_version = cls.lookup_version()
+            cls._recent_version_checked_at = time.time()
+        return cls._recent_version
+
+    @classmethod
+    def bump_lookup_version(cls):
+        # bump again on commit, in case another process cached the old rows under the new version in the meantime
+        name = 'lookup:%s' % cls._meta.label
+        def bump():
+            bump_cache_version(name)
+            cls._recent_version_checked_at = 0
+        bump()
+        transaction.on_commit(bump, using='capdb')
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        self.bump_lookup_version()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.bump_lookup_version()
+        return result
+
+
+class CachedLookupMixin(LookupVersionMixin):
     """
         Mixin for models that have a small number of items that get queried over and over but rarely change.
+        Each process keeps a copy of every item, warmed in bulk from the shared cache when another process has already
+        loaded the current lookup_version(), and reloaded when a save in any process starts a new version.
     """
 
     # Store all objects from the database here:
     _cached_objects = None
 
+    # lookup_version() that _cached_objects was loaded for, and when we last checked for a newer one:
+    _cached_version = None
+    _version_checked_at = 0
+
     # Store objects indexed by a given set of keys here. For example,
     #   _lookup_tables[(name, jurisdiction_id)] = {('Foo', 7): obj}
     # This is populated on demand the first time a particular combination of keys is queried.
@@ -223,17 +293,37 @@ class CachedLookupMixin:
         """
         return tuple(getattr(self, key) for key in keys)
 
+    @classmethod
+    def load_cache(cls):
+        """ Load all objects for the current lookup_version(), from the shared cache if possible. """
+        version = cls.lookup_version()
+        cache_key = 'lookup-objects:%s:%s' % (cls._meta.label, version)
+        objects = django_cache.get(cache_key)
+        if objects is None:
+            objects = list(cls.objects.all())
+            # don't share rows that other processes can't see yet
+            if not transaction.get_connection('capdb').in_atomic_block:
+                django_cache.set(cache_key, objects, settings.CACHED_LOOKUP_TIMEOUT)
+        cls._cached_objects = objects
+        cls._lookup_tables = {}
+        cls._cached_version = version
+        cls._version_checked_at = time.time()
+
     @classmethod
     def get_from_cache(cls, **kwargs):
         """
             Get a single item like `Court.get_from_cache(name='Foo', jurisdiction_id=7)`.
-            Database will be hit only if that item isn't already in the thread-local cache.
-            Entire cache is pre-filled on first call.
+            Database will be hit only if that item isn't already in the process-local cache.
+            Entire cache is pre-filled on first call, and refilled when the shared version changes.
         """
 
         # prefill cache if necessary:
         if cls._cached_objects is None:
-            cls._cached_objects = list(cls.objects.all())
+            cls.load_cache()
+        elif time.time() - cls._version_checked_at > cls.version_check_interval:
+            cls._version_checked_at = time.time()
+            if cls.lookup_version() != cls._cached_version:
+                cls.load_cache()
 
         # get sorted list of keys and values to fetch requested object from cache:
         sorted_pairs = sorted(kwargs.items(), key=lambda i: i[0])
@@ -260,14 +350,18 @@ class CachedLookupMixin:
 
         return obj
 
+    @classmethod
+    def bump_lookup_version(cls):
+        super().bump_lookup_version()
+        cls._version_checked_at = 0
+
     @classmethod
     def reset_cache(cls):
         cls._cached_objects = None
+        cls._cached_version = None
         cls._lookup_tables = {}
 
 
-### Helpers for XML handling ###
-
 class XMLField(models.TextField):
     """ Column type for Postgres XML columns. """
 
@@ -486,7 +580,7 @@ class Jurisdiction(CachedLookupMixin, AutoSlugMixin, models.Model):
     def get_absolute_url(self):
         return reverse('jurisdiction-detail', args=[self.slug], scheme="https")
 
-class Reporter(models.Model):
+class Reporter(LookupVersionMixin, models.Model):
     jurisdictions = models.ManyToManyField(Jurisdiction)
     full_name = models.CharField(max_length=1024, db_index=True)
     short_name = models.CharField(max_length=64)
@@ -898,12 +992,14 @@ class CaseMetadata(models.Model):
         return self.case_id
 
     class Meta:
-        # partial indexes to allow fetching in_scope cases, with optional filter by reporter/jurisdiction/court
+        # partial indexes to allow fetching in_scope cases, with optional filter by reporter/jurisdiction/court, in
+        # the (decision_date, id) order that CapPagination's keyset cursors compare against
         indexes = [
             models.Index(name='idx_in_scope', fields=('decision_date', 'id'), condition=Q(in_scope=True)),
             models.Index(name='idx_in_scope_reporter', fields=('reporter', 'decision_date', 'id'), condition=Q(in_scope=True)),
             models.Index(name='idx_in_scope_jurisdiction', fields=('jurisdiction_slug', 'decision_date', 'id'), condition=Q(in_scope=True)),
             models.Index(name='idx_in_scope_court', fields=('court_slug', 'decision_date', 'id'), condition=Q(in_scope=True)),
+            models.Index(name='idx_in_scope_court_id', fields=('court', 'decision_date', 'id'), condition=Q(in_scope=True)),
         ]
 
     def save(self, *args, **kwargs):
@@ -982,50 +1078,151 @@ class CaseMetadata(models.Model):
         renderer = render_case.VolumeRenderer(blocks_by_id, {}, {})
         return renderer.hydrate_opinions(structure.opinions, blocks_by_id)
 
-    def sync_case_body_cache(self, blocks_by_id=None, fonts_by_id=None, labels_by_block_id=None, rerender=True):
+    def sync_case_body_cache(self, blocks_by_id=None, fonts_by_id=None, labels_by_block_id=None, rerender=True, force=False):
         """
             Update self.body_cache with new values based on the current value of self.structure.
             blocks_by_id and fonts_by_id can be provided for efficiency if updating a bunch of cases from the same volume.
+            See bulk_sync_case_body_cache() to update all cases in a volume at once.
+            Cases whose render inputs haven't changed since they were last rendered are skipped, unless force=True.
         """
-        # if rerender is false, just regenerate json and text attributes from existing html
-        if not rerender:
-            try:
-                body_cache = self.body_cache
-            except CaseBodyCache.DoesNotExist:
-                return
-            json, text = self.get_json_from_html(body_cache.html)
-            CaseBodyCache.objects.filter(id=body_cache.id).update(json=json, text=text)
+        values = self.get_case_body_cache_values(blocks_by_id, fonts_by_id, labels_by_block_id, rerender=rerender, force=force)
+        if values is None:
             return
 
-        structure = self.structure
-        if not blocks_by_id or not labels_by_block_id:
-            pages = list(structure.pages.all())
-        blocks_by_id = blocks_by_id or PageStructure.blocks_by_id(pages)
-        fonts_by_id = fonts_by_id or CaseFont.fonts_by_id(blocks_by_id)
-        labels_by_block_id = labels_by_block_id or PageStructure.labels_by_block_id(pages)
-
-        renderer = render_case.VolumeRenderer(blocks_by_id, fonts_by_id, labels_by_block_id)
-        html = renderer.render_html(self)
-        xml = renderer.render_xml(self)
-        json, text = self.get_json_from_html(html)
-
         ## save
 
-        params = {'text': text, 'html': html, 'xml': xml, 'json': json}
         # use this approach, instead of update_or_create, to reduce sql traffic:
         #   - avoid causing a select (if the body_cache has already been populated with select_related)
         #   - avoid hydrating the params via save(), if they were loaded with defer()
         try:
             body_cache = self.body_cache
         except CaseBodyCache.DoesNotExist:
-            CaseBodyCache(metadata=self, **params).save()
+            CaseBodyCache(metadata=self, **values).save()
         else:
-            CaseBodyCache.objects.filter(id=body_cache.id).update(**params)
+            CaseBodyCache.objects.filter(id=body_cache.id).update(**values)
 
-        if settings.MAINTAIN_ELASTICSEARCH_INDEX:
+        if rerender and settings.MAINTAIN_ELASTICSEARCH_INDEX:
             self.update_search_index()
 
+    def get_case_body_cache_values(self, blocks_by_id=None, fonts_by_id=None, labels_by_block_id=None, rerender=True, force=False):
+        """
+            Render new values for self.body_cache, based on the current value of self.structure, without saving them.
+            Returns a dict of field values, or None if there is nothing to update -- including if self.body_cache was
+            rendered from the same inputs and RENDER_VERSION, unless force=True.
+        """
+        # if rerender is false, just regenerate json and text attributes of an existing body_cache
+        if not rerender:
+            try:
+                self.body_cache
+            except CaseBodyCache.DoesNotExist:
+                return None
+
+        structure = self.structure
+        if blocks_by_id is None or labels_by_block_id is None:
+            pages = list(structure.pages.all())
+        if blocks_by_id is None:
+            blocks_by_id = PageStructure.blocks_by_id(pages)
+        if fonts_by_id is None:
+            fonts_by_id = CaseFont.fonts_by_id(blocks_by_id)
+        if labels_by_block_id is None:
+            labels_by_block_id = PageStructure.labels_by_block_id(pages)
+
+        renderer = render_case.VolumeRenderer(blocks_by_id, fonts_by_id, labels_by_block_id)
+
+        if not rerender:
+            json, text = renderer.render_json_and_text(self)
+            return {'json': json, 'text': text}
+
+        render_digest = renderer.input_digest(self)
+        if not force:
+            try:
+                if self.body_cache.render_digest == render_digest:
+                    return None
+            except CaseBodyCache.DoesNotExist:
+                pass
+
+        values = renderer.render_all(self)
+        values['render_digest'] = render_digest
+        values['render_version'] = render_case.RENDER_VERSION
+        return values
+
+    @classmethod
+    def bulk_sync_case_body_cache(cls, cases, blocks_by_id, fonts_by_id, labels_by_block_id, rerender=True, force=False, processes=None):
+        """
+            Call sync_case_body_cache() for a list of cases from the same volume, but save the results with
+            bulk_save_case_body_cache() instead of one case at a time. cases should be fetched with
+            select_related('structure', 'body_cache').
+            If processes is set, cases are rendered by a pool of that many forked worker processes, and the results are
+            saved by this process. The pool comes from billiard, so it can be started from a daemonic celery worker.
+            Database connections are closed before forking, so this can't be called inside a transaction.
+        """
+        global _render_pool_args
+        cases = list(cases)
+        pool_values = {}
+        if processes and len(cases) > 1:
+            # forked workers would share this process's database connections, so close them first
+            if any(connection.in_atomic_block for connection in connections.all()):
+                raise ValueError("Can't render cases in a process pool inside a transaction.")
+            connections.close_all()
+
+            # withdrawn cases are rendered here, because they may need to query for replaced_by, and they're quick
+            pool_cases = [case for case in cases if not case.withdrawn]
+            _render_pool_args = (blocks_by_id, fonts_by_id, labels_by_block_id, rerender, force)
+            try:
+                with billiard.get_context('fork').Pool(processes) as pool:
+                    chunksize = max(1, len(pool_cases) // (processes * 4))
+                    pool_values = dict(zip((case.pk for case in pool_cases), pool.map(_render_pool_case, pool_cases, chunksize)))
+            finally:
+                _render_pool_args = None
+
+        values_by_case = []
+        for case in cases:
+            if case.pk in pool_values:
+                values = pool_values[case.pk]
+            else:
+                values = case.get_case_body_cache_values(blocks_by_id, fonts_by_id, labels_by_block_id, rerender=rerender, force=force)
+            if values is not None:
+                values_by_case.append((case, values))
+        cls.bulk_save_case_body_cache(values_by_case, update_search_index=rerender)
+
+    @staticmethod
+    def bulk_save_case_body_cache(values_by_case, update_search_index=True, batch_size=100):
+        """
+            Save a list of (case, values) pairs, where values come from get_case_body_cache_values(), to each case's
+            body_cache. New rows are written with one bulk_create and existing rows with bulk_update, and if
+            settings.MAINTAIN_ELASTICSEARCH_INDEX is set the cases are sent to the search index in one bulk request.
+        """
+        to_create = []
+        to_update = []
+        update_fields = set()
+        for case, values in values_by_case:
+            try:
+                body_cache = case.body_cache
+            except CaseBodyCache.DoesNotExist:
+                case.body_cache = CaseBodyCache(metadata=case, **values)
+                to_create.append(case.body_cache)
+            else:
+                # setting deferred fields here means bulk_update() and the search index don't have to fetch them
+                for k, v in values.items():
+                    setattr(body_cache, k, v)
+                to_update.append(body_cache)
+                update_fields.update(values)
+
+        with transaction.atomic(using='capdb'):
+            if to_create:
+                CaseBodyCache.objects.bulk_create(to_create, batch_size=batch_size)
+            if to_update:
+                CaseBodyCache.objects.bulk_update(to_update, sorted(update_fields), batch_size=batch_size)
+
+        if update_search_index and values_by_case and settings.MAINTAIN_ELASTICSEARCH_INDEX:
+            from capapi.documents import CaseDocument  # local to avoid circular import
+            CaseDocument().update([case for case, values in values_by_case])
+
     def get_json_from_html(self, html):
+        """
+            Extract json and text from rendered HTML. sync_case_body_cache() gets the same values directly from the
+            structure, with VolumeRenderer.json_and_text_from_html_el().
+        """
         casebody_pq = PyQuery(html)
         casebody_pq.remove('.page-label,.footnotemark,.bracketnum')  # remove page numbers and references from text/json
 
@@ -1721,6 +1918,63 @@ class CaseExport(models.Model):
             instance._filter_item_cache = lookups[instance.filter_type][instance.filter_id]
 
 
+class CaseCountRollup(models.Model):
+    """
+        Case and page counts for each combination of jurisdiction, court, reporter, volume, decision year, in_scope and
+        duplicative, kept in sync with CaseMetadata by the case_count_rollup trigger (see
+        set_up_postgres.set_case_count_rollup_trigger). Summing these rows is much cheaper than a GROUP BY over
+        CaseMetadata. Missing values are stored as 0, or '' for volume_id, so the grouping columns can be unique.
+    """
+    jurisdiction_id = models.IntegerField(default=0)
+    court_id = models.IntegerField(default=0)
+    reporter_id = models.IntegerField(default=0)
+    volume_id = models.CharField(max_length=64, default='')
+    year = models.IntegerField(default=0)
+    in_scope = models.BooleanField(default=False)
+    duplicative = models.BooleanField(default=False)
+    case_count = models.IntegerField(default=0)
+    page_count = models.BigIntegerField(default=0)
+
+    # CaseMetadata fields that can be counted from rollups, and the matching rollup filter for a single value.
+    # Filtering on denormalized slugs becomes a subquery on the small Jurisdiction or Court table.
+    case_filters = {
+        'in_scope': lambda value: Q(in_scope=value),
+        'duplicative': lambda value: Q(duplicative=value),
+        'jurisdiction': lambda value: Q(jurisdiction_id=value),
+        'court': lambda value: Q(court_id=value),
+        'reporter': lambda value: Q(reporter_id=value),
+        'volume': lambda value: Q(volume_id=value),
+        'jurisdiction_slug': lambda value: Q(jurisdiction_id__in=Jurisdiction.objects.filter(slug=value).values('id')),
+        'court_slug': lambda value: Q(court_id__in=Court.objects.filter(slug=value).values('id')),
+    }
+
+    class Meta:
+        unique_together = ('jurisdiction_id', 'court_id', 'reporter_id', 'volume_id', 'year', 'in_scope', 'duplicative')
+
+    @classmethod
+    def count_for_query(cls, query):
+        """
+            Return the number of rows a CaseMetadata query would match, if it filters only on exact values of
+            case_filters fields, or None if it can't be answered from rollups.
+        """
+        if query.model is not CaseMetadata or query.distinct or query.low_mark or query.high_mark is not None or query.combinator or query.group_by:
+            return None
+        filters = Q()
+        nodes = [query.where]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, WhereNode):
+                if node.connector != 'AND' or node.negated:
+                    return None
+                nodes.extend(node.children)
+            elif (isinstance(node, Exact) and isinstance(node.lhs, Col) and node.lhs.alias == query.base_table
+                    and node.lhs.target.name in cls.case_filters and not hasattr(node.rhs, 'resolve_expression')):
+                filters &= cls.case_filters[node.lhs.target.name](node.rhs)
+            else:
+                return None
+        return cls.objects.filter(filters).aggregate(count=models.Sum('case_count'))['count'] or 0
+
+
 class Snippet(models.Model):
     """
         Data snippets for use on the website. It's just a cache for data that is both static enough, and resource-
@@ -1928,6 +2182,10 @@ class CaseBodyCache(models.Model):
     html = models.TextField(blank=True, null=True)
     xml = models.TextField(blank=True, null=True)
     json = JSONField(blank=True, null=True)
+    render_digest = models.CharField(max_length=32, blank=True, null=True,
+                                     help_text="VolumeRenderer.input_digest() of the inputs these renditions were made from")
+    render_version = models.SmallIntegerField(blank=True, null=True,
+                                              help_text="render_case.RENDER_VERSION these renditions were made with")
 
 
 class EditLog(models.Model):
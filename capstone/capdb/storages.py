@@ -1,7 +1,14 @@
 import csv
 import gzip
 import hashlib
+import heapq
+import struct
+import time
 import traceback
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from contextlib import contextmanager
 
 import msgpack
@@ -16,7 +23,7 @@ from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage, Storage
 from django.utils.functional import SimpleLazyObject
-from rocksdb.interfaces import MergeOperator
+from rocksdb.interfaces import MergeOperator, SliceTransform
 from storages.backends.s3boto3 import S3Boto3Storage
 
 
@@ -364,17 +371,391 @@ class KVDB:
         return self._db
 
 
+NgramColumns = namedtuple('NgramColumns', ['jurisdiction_ids', 'jurisdiction_ends', 'years', 'instance_counts', 'document_counts'])
+
+
+class NgramValue:
+    """
+        Binary encoding for the value of a b'<n><gram>' key in NgramRocksDB. Counts are stored as columns of
+        fixed-width integers, so readers can fetch the totals or slice out one jurisdiction without unpacking the rest
+        of the value:
+
+            header:             <version:B> <year typecode:c> <instance count typecode:c> <document count typecode:c>
+                                <jurisdiction count:H> <record count:I> <base year:h>
+                                <total instances:q> <total documents:q>
+            jurisdiction index: array('H') of sorted jurisdiction ids
+                                array('I') of where each jurisdiction's records end
+            records:            array(<year typecode>) of year - 1900 - <base year>, sorted within each jurisdiction
+                                array(<instance count typecode>)
+                                array(<document count typecode>)
+
+        Years are delta-encoded against the earliest year in the value, and each of the year and count columns uses the
+        narrowest typecode in `typecodes` that fits its largest value, so most records take four or five bytes.
+        Arrays use native byte order (little-endian on all of our hosts).
+
+        Merge operands are single `record` structs: (jurisdiction id, year - 1900, instance count, document count).
+        Merging copies the columns into arrays, binary-searches the sorted index and years, and inserts or adds in
+        place. Counts are signed, so operands can also subtract observations.
+
+        Values written before this format are msgpack dicts (see legacy_to_records()); every reader here accepts
+        either format, and scripts.ngrams.migrate_values() rewrites them.
+    """
+    version = 1
+    header = struct.Struct('=BcccHIhqq')
+    record = struct.Struct('=Hhii')
+    typecodes = 'BHIQ'
+
+    ## helpers
+
+    @classmethod
+    def is_legacy(cls, value):
+        return value[0] != cls.version
+
+    @classmethod
+    def upgrade(cls, value):
+        """ Return value in the current format, converting from msgpack if necessary. """
+        return cls.encode(cls.legacy_to_records(value)) if cls.is_legacy(value) else value
+
+    @staticmethod
+    def legacy_to_records(value):
+        """
+            Convert a legacy value to a list of records. Legacy values looked like this:
+                value == KVDB.pack({
+                    <jurisdiction_id>: [
+                        <year>, <instance_count>, <document_count>,
+                        <year>, <instance_count>, <document_count>,
+                        ...
+                    ],
+                    None: {
+                        <year>: [<instance_count>, <document_count>],
+                        ...,
+                        None: [<instance_count>, <document_count>],
+                    }
+                })
+        """
+        records = []
+        for jurisdiction_id, years in KVDB.unpack(value).items():
+            # None holds derived totals, which we recalculate
+            if jurisdiction_id is not None:
+                records.extend((jurisdiction_id,) + tuple(years[i:i+3]) for i in range(0, len(years), 3))
+        return records
+
+    @classmethod
+    def fit_typecode(cls, largest):
+        return next(t for t in cls.typecodes if largest < 2 ** (8 * array(t).itemsize))
+
+    @classmethod
+    def fit(cls, column, largest):
+        """ Return column, widened if necessary to hold largest. """
+        if largest < 2 ** (8 * column.itemsize):
+            return column
+        return array(cls.fit_typecode(largest), column)
+
+    @classmethod
+    def columns(cls, value):
+        """ Return (NgramColumns of zero-copy memoryviews, base year, [total instances, total documents]). """
+        _, year_typecode, instance_typecode, document_typecode, jurisdiction_count, record_count, base_year, \
+            total_instances, total_documents = cls.header.unpack_from(value)
+        view = memoryview(value)
+        offset = cls.header.size
+        columns = []
+        for typecode, length in (
+            ('H', jurisdiction_count),
+            ('I', jurisdiction_count),
+            (year_typecode.decode(), record_count),
+            (instance_typecode.decode(), record_count),
+            (document_typecode.decode(), record_count),
+        ):
+            size = length * array(typecode).itemsize
+            columns.append(view[offset:offset + size].cast(typecode))
+            offset += size
+        return NgramColumns(*columns), base_year, [total_instances, total_documents]
+
+    @staticmethod
+    def jurisdiction_range(columns, jurisdiction_id):
+        """ Return (index in jurisdiction index, start record, end record), or None if jurisdiction_id isn't present. """
+        i = bisect_left(columns.jurisdiction_ids, jurisdiction_id)
+        if i == len(columns.jurisdiction_ids) or columns.jurisdiction_ids[i] != jurisdiction_id:
+            return None
+        return i, columns.jurisdiction_ends[i - 1] if i else 0, columns.jurisdiction_ends[i]
+
+    ## writers
+
+    @classmethod
+    def serialize(cls, columns, base_year, totals):
+        return b''.join([
+            cls.header.pack(
+                cls.version, columns.years.typecode.encode(), columns.instance_counts.typecode.encode(),
+                columns.document_counts.typecode.encode(), len(columns.jurisdiction_ids), len(columns.years),
+                base_year, totals[0], totals[1]),
+        ] + [column.tobytes() for column in columns])
+
+    @classmethod
+    def encode(cls, records):
+        """ Encode (jurisdiction_id, storage_year, instance_count, document_count) records in any order. """
+        counts = {}
+        for jurisdiction_id, storage_year, instance_count, document_count in records:
+            count = counts.setdefault((jurisdiction_id, storage_year), [0, 0])
+            count[0] += instance_count
+            count[1] += document_count
+        keys = sorted(k for k, v in counts.items() if v[0] > 0)
+
+        jurisdiction_ids = array('H')
+        jurisdiction_ends = array('I')
+        for i, (jurisdiction_id, _) in enumerate(keys):
+            if not jurisdiction_ids or jurisdiction_ids[-1] != jurisdiction_id:
+                jurisdiction_ids.append(jurisdiction_id)
+                jurisdiction_ends.append(i)
+            jurisdiction_ends[-1] = i + 1
+        base_year = min((k[1] for k in keys), default=0)
+        years = [k[1] - base_year for k in keys]
+        instance_counts = [counts[k][0] for k in keys]
+        document_counts = [counts[k][1] for k in keys]
+        columns = NgramColumns(
+            jurisdiction_ids, jurisdiction_ends,
+            array(cls.fit_typecode(max(years, default=0)), years),
+            array(cls.fit_typecode(max(instance_counts, default=0)), instance_counts),
+            array(cls.fit_typecode(max(document_counts, default=0)), document_counts))
+        return cls.serialize(columns, base_year, [sum(instance_counts), sum(document_counts)])
+
+    @classmethod
+    def merge(cls, value, operands):
+        """ Merge packed `record` operands into value (which may be None), returning the new value. """
+        if value is None:
+            return cls.encode(cls.record.unpack(op) for op in operands)
+
+        views, base_year, totals = cls.columns(cls.upgrade(value))
+        columns = []
+        for view in views:
+            column = array(view.format)
+            column.frombytes(view.cast('B'))
+            columns.append(column)
+        jurisdiction_ids, jurisdiction_ends, years, instance_counts, document_counts = columns
+
+        for op in operands:
+            jurisdiction_id, storage_year, instance_count, document_count = cls.record.unpack(op)
+            totals[0] += instance_count
+            totals[1] += document_count
+
+            # rebase year column if this year is out of range -- rare, as most grams are seen in early years first
+            if not years:
+                base_year = storage_year
+            elif storage_year < base_year or storage_year - base_year >= 2 ** (8 * years.itemsize):
+                new_base_year = min(base_year, storage_year)
+                new_years = [year + base_year - new_base_year for year in years]
+                years = array(cls.fit_typecode(max(new_years + [storage_year - new_base_year])), new_years)
+                base_year = new_base_year
+            year = storage_year - base_year
+
+            # find or insert jurisdiction
+            i = bisect_left(jurisdiction_ids, jurisdiction_id)
+            if i == len(jurisdiction_ids) or jurisdiction_ids[i] != jurisdiction_id:
+                if instance_count <= 0:
+                    continue
+                jurisdiction_ids.insert(i, jurisdiction_id)
+                jurisdiction_ends.insert(i, jurisdiction_ends[i - 1] if i else 0)
+            start = jurisdiction_ends[i - 1] if i else 0
+            end = jurisdiction_ends[i]
+
+            # find or insert jurisdiction-year
+            j = bisect_left(years, year, start, end)
+            if j < end and years[j] == year:
+                instance_count += instance_counts[j]
+                document_count += document_counts[j]
+                if instance_count <= 0:
+                    for column in (years, instance_counts, document_counts):
+                        del column[j]
+                    for k in range(i, len(jurisdiction_ends)):
+                        jurisdiction_ends[k] -= 1
+                    if end - start == 1:
+                        del jurisdiction_ids[i]
+                        del jurisdiction_ends[i]
+                    continue
+            elif instance_count <= 0:
+                continue
+            else:
+                for column in (years, instance_counts, document_counts):
+                    column.insert(j, 0)
+                years[j] = year
+                for k in range(i, len(jurisdiction_ends)):
+                    jurisdiction_ends[k] += 1
+
+            instance_counts = cls.fit(instance_counts, instance_count)
+            document_counts = cls.fit(document_counts, document_count)
+            instance_counts[j] = instance_count
+            document_counts[j] = document_count
+
+        columns = NgramColumns(jurisdiction_ids, jurisdiction_ends, years, instance_counts, document_counts)
+        return cls.serialize(columns, base_year, totals)
+
+    ## readers
+
+    @classmethod
+    def totals(cls, value):
+        """ Return [total instances, total documents] across all jurisdiction-years, reading only the header. """
+        if cls.is_legacy(value):
+            return KVDB.unpack(value)[None][None]
+        return list(cls.header.unpack_from(value)[-2:])
+
+    @classmethod
+    def jurisdiction_ids(cls, value):
+        """ Return sorted list of jurisdiction ids with observations of this gram. """
+        return cls.columns(cls.upgrade(value))[0].jurisdiction_ids.tolist()
+
+    @classmethod
+    def jurisdiction_years(cls, value, jurisdiction_id):
+        """ Return [(storage_year, instance_count, document_count), ...] for one jurisdiction, sorted by year. """
+        columns, base_year, _ = cls.columns(cls.upgrade(value))
+        found = cls.jurisdiction_range(columns, jurisdiction_id)
+        if not found:
+            return []
+        _, start, end = found
+        return [(base_year + year, instance_count, document_count) for year, instance_count, document_count in zip(
+            columns.years[start:end], columns.instance_counts[start:end], columns.document_counts[start:end])]
+
+    @classmethod
+    def select(cls, value, jurisdiction_ids=None, year_min=None, year_max=None):
+        """
+            Return {<jurisdiction_id>: [(storage_year, instance_count, document_count), ...]} for each of
+            jurisdiction_ids (default all), sorted by year and limited to storage years between year_min and year_max
+            inclusive. Jurisdiction id None sums across all jurisdictions, and is always included; other jurisdictions
+            are left out if the gram was never observed there.
+
+            The columns are decoded once, and each jurisdiction's year range is found by binary search, so this only
+            reads the records it returns.
+        """
+        columns, base_year, _ = cls.columns(cls.upgrade(value))
+        if jurisdiction_ids is None:
+            jurisdiction_ids = [None] + columns.jurisdiction_ids.tolist()
+        low = None if year_min is None else year_min - base_year
+        high = None if year_max is None else year_max - base_year
+
+        def jurisdiction_records(index):
+            start = columns.jurisdiction_ends[index - 1] if index else 0
+            end = columns.jurisdiction_ends[index]
+            if low is not None:
+                start = bisect_left(columns.years, low, start, end)
+            if high is not None:
+                end = bisect_right(columns.years, high, start, end)
+            return zip(columns.years[start:end], columns.instance_counts[start:end], columns.document_counts[start:end])
+
+        out = {}
+        for jurisdiction_id in jurisdiction_ids:
+            if jurisdiction_id is None:
+                totals = {}
+                for index in range(len(columns.jurisdiction_ids)):
+                    for year, instance_count, document_count in jurisdiction_records(index):
+                        total = totals.setdefault(year, [0, 0])
+                        total[0] += instance_count
+                        total[1] += document_count
+                out[None] = [(base_year + year,) + tuple(totals[year]) for year in sorted(totals)]
+            else:
+                found = cls.jurisdiction_range(columns, jurisdiction_id)
+                if found:
+                    out[jurisdiction_id] = [(base_year + year, instance_count, document_count) for year, instance_count, document_count in jurisdiction_records(found[0])]
+        return out
+
+    @classmethod
+    def year_totals(cls, value):
+        """ Return [(storage_year, instance_count, document_count), ...] summed across jurisdictions, sorted by year. """
+        columns, base_year, _ = cls.columns(cls.upgrade(value))
+        totals = {}
+        for year, instance_count, document_count in zip(columns.years, columns.instance_counts, columns.document_counts):
+            total = totals.setdefault(year, [0, 0])
+            total[0] += instance_count
+            total[1] += document_count
+        return [(base_year + year,) + tuple(totals[year]) for year in sorted(totals)]
+
+    @classmethod
+    def to_dict(cls, value):
+        """ Return value decoded to the legacy dict layout documented in legacy_to_records(). """
+        out = {None: {year: [instance_count, document_count] for year, instance_count, document_count in cls.year_totals(value)}}
+        out[None][None] = cls.totals(value)
+        for jurisdiction_id in cls.jurisdiction_ids(value):
+            out[jurisdiction_id] = [i for year in cls.jurisdiction_years(value, jurisdiction_id) for i in year]
+        return out
+
+
 class NgramRocksDB(KVDB):
     """ Wrapper for RocksDB. """
     name = 'rocksdb'
     batch = None
+    compacting = False  # set by compact()
+
+    # Each b'<n><gram>' key has a companion b'count<n><gram>' key storing just its total instance count, so wildcard
+    # queries can rank candidates without decoding full values. Gram keys always start with a byte from 1 to 3, so
+    # this can't collide with them.
+    count_key_prefix = b'count'
+
+    # b'totals' + KVDB.pack((<jurisdiction_id>, <year>, <n>)) keys contain [<gram count>, <document count>] for each
+    # jurisdiction-year-length, and are merged with packed lists of differences.
+    totals_key_prefix = b'totals'
+
+    # If settings.NGRAM_INCREMENTAL_UPDATES is set, each case counted into the database has a b'digest' key storing
+    # the md5 of the text that was counted, and a b'tokens' key storing its space-separated tokens, so incremental
+    # updates can tell which cases changed and subtract what was counted before. Ids in these keys are packed big-endian so each jurisdiction-year's cases
+    # can be read with a prefix scan.
+    digest_key_prefix = b'digest'
+    tokens_key_prefix = b'tokens'
+    jurisdiction_year_struct = struct.Struct('>IH')
+    case_id_struct = struct.Struct('>I')
+
+    def __init__(self, *args, prefix_seek=False, **kwargs):
+        """
+            If prefix_seek is True, the database is opened with GramPrefix as its prefix extractor, so tables written
+            through it get prefix bloom filters, and prefix scans of gram and count keys can skip tables that don't
+            contain the prefix. Readers opened this way see the same results as without it.
+        """
+        super().__init__(*args, **kwargs)
+        self.prefix_seek = prefix_seek
 
     ## helpers
 
+    @classmethod
+    def count_key(cls, key):
+        return cls.count_key_prefix + key
+
+    @classmethod
+    def case_key(cls, key_prefix, jurisdiction_id, year, case_id=None):
+        """
+            Return the b'digest' or b'tokens' key for a case, or the prefix of those keys for all cases in a
+            jurisdiction-year if case_id is None.
+        """
+        key = key_prefix + cls.jurisdiction_year_struct.pack(jurisdiction_id, year)
+        if case_id is not None:
+            key += cls.case_id_struct.pack(case_id)
+        return key
+
+    @classmethod
+    def case_key_id(cls, key):
+        """ Return the case_id from a key returned by case_key(). """
+        return cls.case_id_struct.unpack(key[-cls.case_id_struct.size:])[0]
+
     def db_path(self):
         return os.path.join(self.path, self.name+".db")
 
-    def open(self):
+    def generation_path(self):
+        return os.path.join(self.path, self.name+".generation")
+
+    def get_generation(self):
+        """
+            Return the generation marker last written by bump_generation(), or None if there isn't one.
+            Long-running readers compare this value to know when to reopen the database and reload cached data.
+        """
+        try:
+            return Path(self.generation_path()).read_text()
+        except FileNotFoundError:
+            return None
+
+    def bump_generation(self):
+        """ Write a new generation marker to signal to readers that the database contents have changed. """
+        Path(self.generation_path()).write_text(uuid.uuid4().hex)
+
+    def db_size(self):
+        """ Total size in bytes of the database files on disk. """
+        return sum(f.stat().st_size for f in Path(self.db_path()).iterdir() if f.is_file())
+
+    def options(self):
         # initial "production ready" settings via https://python-rocksdb.readthedocs.io/en/latest/tutorial/index.html
         opts = rocksdb.Options()
         opts.create_if_missing = True
@@ -384,12 +765,14 @@ class NgramRocksDB(KVDB):
         opts.target_file_size_base = 64 * 2**20  # 64MB
         opts.merge_operator = self.NgramMergeOperator()
         opts.compression = rocksdb.CompressionType.lz4_compression
+        if self.prefix_seek:
+            opts.prefix_extractor = self.GramPrefix()
 
         # fast ingest stuff
         # via https://github.com/facebook/rocksdb/wiki/RocksDB-FAQ -- "Q: What's the fastest way to load data into RocksDB?"
-        # these settings require manual compaction after ingest
+        # these settings require manual compaction after ingest -- see compact()
         opts.max_background_flushes = 8
-        opts.level0_file_num_compaction_trigger = -1
+        opts.level0_file_num_compaction_trigger = 4 if self.compacting else -1  # 4 is the rocksdb default
         opts.level0_slowdown_writes_trigger = -1
         opts.level0_stop_writes_trigger = 2 ** 16  # default is 24 -- we want to avoid hitting this until it's done
         opts.write_buffer_size = 32 * 2**20  # default is 4 * 2 ** 20
@@ -400,7 +783,28 @@ class NgramRocksDB(KVDB):
             block_cache=rocksdb.LRUCache(2 * 2 ** 30),  # 2GB
             block_cache_compressed=rocksdb.LRUCache(500 * 2 ** 20))  # 500MB
 
-        self._db = rocksdb.DB(self.db_path(), opts, read_only=self.read_only)
+        return opts
+
+    def open(self):
+        self._db = rocksdb.DB(self.db_path(), self.options(), read_only=self.read_only)
+
+    def compact(self, poll_interval=1):
+        """
+            Compact the database after loading, and wait for compaction to finish.
+
+            python-rocksdb's compact_range() holds the GIL while it waits, and compaction calls back into
+            NgramMergeOperator and GramPrefix, so it would deadlock. Instead the database is reopened with automatic
+            compaction turned on, and this thread sleeps, releasing the GIL, until rocksdb's background compactions
+            are done. Reopening also flushes anything left in the write-ahead log to table files.
+        """
+        self._db = None
+        self.compacting = True
+        try:
+            while any(self.db.get_property(p) != b'0' for p in (b'rocksdb.compaction-pending', b'rocksdb.num-running-compactions')):
+                time.sleep(poll_interval)
+        finally:
+            self._db = None
+            self.compacting = False
 
     def db_or_batch(self, batch=None):
         return batch or self.batch or self.db
@@ -423,51 +827,36 @@ class NgramRocksDB(KVDB):
     def put(self, k, v, packed=False, batch=None):
         self.db_or_batch(batch).put(k, self.pack(v, packed))
 
+    def delete(self, k, batch=None):
+        self.db_or_batch(batch).delete(k)
+
     class NgramMergeOperator(MergeOperator):
         def full_merge(self, key, existing_value, ops):
             """
-                Our mergable keys contain the counts for all jurisdiction-years and totals for an ngram, like this:
-                    existing_value == self.pack({
-                        <jurisdiction_id>: [
-                            <year>, <instance_count>, <document_count>,
-                            <year>, <instance_count>, <document_count>,
-                            ...
-                        ],
-                        None: {
-                            <year>: [<instance_count>, <document_count>],
-                            ...,
-                            None: [<instance_count>, <document_count>],
-                        }
-                    })
-                This function merges in new observations, in the form:
+                Keys starting with NgramRocksDB.count_key_prefix contain a single packed instance count, and ops
+                are packed counts to add to it. Keys starting with NgramRocksDB.totals_key_prefix work the same way,
+                with packed [<gram count>, <document count>] lists.
+
+                All other mergable keys are b'<n><gram>' keys containing the counts for every jurisdiction-year
+                an ngram was observed in, encoded as documented in NgramValue. ops are observations to add (or, with
+                negative counts, to subtract), in the form:
                     ops == [
-                        self.pack((<jurisdiction_id>, <year>, <instance_count>, <document_count>)),
+                        NgramValue.record.pack(<jurisdiction_id>, <year - 1900>, <instance_count>, <document_count>),
                         ...
                     ]
             """
             try:
-                # get target for merge
-                value = KVDB.unpack(existing_value) if existing_value else {
-                    None: {
-                        None: [0, 0],
-                    }
-                }
-                for new_value in ops:
-                    # get values to merge
-                    new_value = KVDB.unpack(new_value)
-                    jurisdiction_id, storage_year, instance_count, document_count = new_value
-                    # merge in individual jurisdiction-year value
-                    value.setdefault(jurisdiction_id, []).extend((storage_year, instance_count, document_count))
-                    # merge in running total for year
-                    totals = value[None]
-                    totals_year = totals.setdefault(storage_year, [0,0])
-                    totals_year[0] += instance_count
-                    totals_year[1] += document_count
-                    # merge in running total for all years combined
-                    total = totals[None]
-                    total[0] += instance_count
-                    total[1] += document_count
-                return (True, KVDB.pack(value))
+                if key.startswith(NgramRocksDB.count_key_prefix):
+                    count = KVDB.unpack(existing_value) if existing_value else 0
+                    return (True, KVDB.pack(count + sum(KVDB.unpack(op) for op in ops)))
+
+                if key.startswith(NgramRocksDB.totals_key_prefix):
+                    totals = KVDB.unpack(existing_value) if existing_value else [0, 0]
+                    for op in ops:
+                        totals = [total + difference for total, difference in zip(totals, KVDB.unpack(op))]
+                    return (True, KVDB.pack(totals))
+
+                return (True, NgramValue.merge(existing_value, ops))
             except Exception:
                 # rocksdb swallows this stack trace, so print before raising
                 traceback.print_exc()
@@ -476,6 +865,34 @@ class NgramRocksDB(KVDB):
         def name(self):
             return b'ngram_merge'
 
+    class GramPrefix(SliceTransform):
+        """
+            Prefix extractor for prefix_seek mode. The prefix of a b'<n><gram>' or b'count<n><gram>' key is everything
+            up to and including the first space after <n>, i.e. the first word of a multi-word gram. Wildcard searches
+            always scan a prefix ending in a space, which is at least this long, so their seeks can use prefix
+            bloom filters and never cross into another prefix.
+
+            Other keys -- unigrams, totals, and case keys, whose packed ids can contain spaces -- are out of domain, so
+            their scans run in total order as usual.
+        """
+        count_key_prefix_length = 5  # len(NgramRocksDB.count_key_prefix)
+
+        def prefix_start(self, src):
+            return self.count_key_prefix_length + 1 if src[:self.count_key_prefix_length] == b'count' else 1
+
+        def name(self):
+            return b'ngram_gram_prefix'
+
+        def transform(self, src):
+            return (0, src.index(b' ', self.prefix_start(src)) + 1)
+
+        def in_domain(self, src):
+            start = self.prefix_start(src)
+            return len(src) >= start and 1 <= src[start - 1] <= 3 and b' ' in src[start:]
+
+        def in_range(self, dst):
+            return self.in_domain(dst) and dst.endswith(b' ') and dst.index(b' ', self.prefix_start(dst)) == len(dst) - 1
+
     def merge(self, k, v, packed=False, batch=None):
         self.db_or_batch(batch).merge(k, self.pack(v, packed))
 
@@ -484,14 +901,68 @@ class NgramRocksDB(KVDB):
     def get(self, k, packed=False):
         return self.unpack(self.db.get(k), packed)
 
-    def get_prefix(self, prefix, packed=False):
-        it = self.db.iteritems()
+    def get_many(self, keys, packed=False):
+        """ Fetch several keys in one call. Returns a dict of key: value, with None for missing keys. """
+        return {k: self.unpack(v, packed) for k, v in self.db.multi_get(list(keys)).items()}
+
+    def prefix_iterator(self, prefix, keys_only=False, fill_cache=True):
+        """
+            Return an iterator seeked to prefix. Callers stop at the first key that doesn't start with prefix
+            (python-rocksdb doesn't expose iterate_upper_bound). Set fill_cache=False for one-off scans, so they
+            don't evict the blocks that serving lookups keep hot in the block cache.
+        """
+        it = self.db.iterkeys(fill_cache=fill_cache) if keys_only else self.db.iteritems(fill_cache=fill_cache)
         it.seek(prefix)
+        return it
+
+    def get_prefix(self, prefix, packed=False, fill_cache=True):
+        it = self.prefix_iterator(prefix, fill_cache=fill_cache)
         for k, v in it:
             if not k.startswith(prefix):
                 return
             yield k, self.unpack(v, packed)
 
+    def case_years(self, jurisdiction_id):
+        """
+            Return the years with cases recorded for jurisdiction_id -- see case_key(). Seeks past each year's cases
+            rather than reading them.
+        """
+        prefix = self.digest_key_prefix + struct.pack('>I', jurisdiction_id)  # the jurisdiction part of case_key()
+        years = []
+        it = self.prefix_iterator(prefix, keys_only=True, fill_cache=False)
+        year = 0
+        while True:
+            it.seek(self.case_key(self.digest_key_prefix, jurisdiction_id, year))
+            k = next(it, None)
+            if k is None or not k.startswith(prefix):
+                return years
+            year = self.jurisdiction_year_struct.unpack_from(k, len(self.digest_key_prefix))[1]
+            years.append(year)
+            year += 1
+
+    def get_top_prefix(self, prefix, limit=10):
+        """
+            Return up to `limit` (key, value) gram pairs starting with prefix, ordered by descending total
+            instance count (and descending key for ties). Values are encoded as documented in NgramValue.
+
+            Candidates are ranked with a bounded heap over the small count keys, so full values are only fetched and
+            decoded for the winners. Databases written before count keys existed raise ValueError until
+            `fab ngram_write_counts` has been run on them.
+
+            Grams whose observations have all been subtracted by incremental updates are left with a count of zero,
+            and are skipped.
+        """
+        count_prefix_length = len(self.count_key_prefix)
+        counts = self.get_prefix(self.count_key(prefix), packed=True)
+        top = heapq.nlargest(limit, ((count, k[count_prefix_length:]) for k, count in counts if count > 0))
+        if not top:
+            # every writer adds a count key with each gram, so grams without any mean the database predates them
+            if next(self.get_prefix(prefix), None) and not next(self.get_prefix(self.count_key(prefix)), None):
+                raise ValueError("Ngram database has no count keys for %r. Run `fab ngram_write_counts`." % prefix)
+            return []
+        values = self.get_many(k for _, k in top)
+        return [(k, values[k]) for _, k in top if values[k] is not None]
+
 # using SimpleLazyObject lets our tests mock the wrapped object after import
-ngram_kv_store = SimpleLazyObject(lambda: NgramRocksDB())
-ngram_kv_store_ro = SimpleLazyObject(lambda: NgramRocksDB(read_only=True))
\ No newline at end of file
+ngram_kv_store = SimpleLazyObject(lambda: NgramRocksDB(prefix_seek=True))
+ngram_kv_store_ro = SimpleLazyObject(lambda: NgramRocksDB(read_only=True, prefix_seek=True))
\ No newline at end of file
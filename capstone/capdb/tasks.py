@@ -3,8 +3,9 @@ from time import sleep
 
 from celery import shared_task
 from celery.exceptions import Reject
+from django.conf import settings
 from django.db import connections
-from django.db.models import Prefetch
+from django.db.models import Prefetch, Sum
 from django.utils import timezone
 from elasticsearch import ElasticsearchException
 from elasticsearch.helpers import BulkIndexError
@@ -116,9 +117,10 @@ def sync_from_initial_metadata_for_vol(self, volume_id, force):
 
 
 @shared_task
-def sync_case_body_cache_for_vol(volume_id, rerender=True):
+def sync_case_body_cache_for_vol(volume_id, rerender=True, force=False, processes=None):
     """
-        call sync_case_body_cache on cases in given volume
+        call sync_case_body_cache on cases in given volume, saving all of them at once with bulk_sync_case_body_cache.
+        If processes is set, cases are rendered in a local pool of that many processes.
     """
     volume = VolumeMetadata.objects.get(pk=volume_id)
     pages = list(volume.page_structures.all())
@@ -129,9 +131,11 @@ def sync_case_body_cache_for_vol(volume_id, rerender=True):
     query = volume.case_metadatas\
         .select_related('structure', 'body_cache')\
         .defer('body_cache__html', 'body_cache__xml', 'body_cache__text', 'body_cache__json')
+    if rerender and settings.MAINTAIN_ELASTICSEARCH_INDEX:
+        # fetch everything CaseDocument needs, so indexing the volume doesn't query once per case
+        query = query.select_related('volume', 'reporter', 'court', 'jurisdiction').prefetch_related('citations')
 
-    for case_metadata in query:
-        case_metadata.sync_case_body_cache(blocks_by_id, fonts_by_id, labels_by_block_id, rerender=rerender)
+    CaseMetadata.bulk_sync_case_body_cache(query, blocks_by_id, fonts_by_id, labels_by_block_id, rerender=rerender, force=force, processes=processes)
 
 
 def create_case_metadata_from_all_vols(update_existing=False):
@@ -247,9 +251,8 @@ def get_case_count_for_jur(jurisdiction_id):
         print('Must provide jurisdiction id')
         return
 
-    with connections['capdb'].cursor() as cursor:
-        cursor.execute("select extract(year from decision_date)::integer as case_year, count(*) from capdb_casemetadata where duplicative=false and jurisdiction_id=%s group by case_year;" % jurisdiction_id)
-        db_results = cursor.fetchall()
+    db_results = CaseCountRollup.objects.filter(jurisdiction_id=jurisdiction_id, duplicative=False, case_count__gt=0)\
+        .values_list('year').annotate(count=Sum('case_count'))
 
     results = {
         'total': 0,
@@ -269,7 +272,7 @@ def get_case_count_for_jur(jurisdiction_id):
 
     for res in db_results:
         case_year, count = res
-        results['years'][case_year] = count
+        results['years'][case_year or None] = count
         results['total'] += count
 
     results['recorded'] = str(datetime.now())
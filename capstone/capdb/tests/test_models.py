@@ -4,7 +4,7 @@ import pytest
 from django.utils.encoding import force_bytes
 
 from capdb.models import VolumeMetadata, CaseMetadata, CaseImage, CaseBodyCache, CaseXML, fetch_relations, Jurisdiction, \
-    Reporter, Court, EditLog
+    Reporter, Court, EditLog, CaseCountRollup, CaseFont, PageStructure
 from capdb.tasks import retrieve_images_from_cases
 from scripts.helpers import nsmap, parse_xml, serialize_xml
 
@@ -181,6 +181,46 @@ def test_denormalized_fields(case):
     case.refresh_from_db()
     assert case.court_name == court.name
 
+@pytest.mark.django_db
+def test_case_count_rollup(three_cases, jurisdiction):
+    def rollup_counts():
+        return {(row.jurisdiction_id, row.year, row.in_scope): row.case_count
+                for row in CaseCountRollup.objects.filter(case_count__gt=0)}
+    def case_counts():
+        counts = {}
+        for case in CaseMetadata.objects.all():
+            key = (case.jurisdiction_id or 0, case.decision_date.year if case.decision_date else 0, case.in_scope)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    # rollups follow inserts, updates and deletes
+    assert rollup_counts() == case_counts()
+    three_cases[0].jurisdiction = jurisdiction
+    three_cases[0].save()
+    three_cases[1].jurisdiction = None
+    three_cases[1].save()
+    three_cases[2].delete()
+    assert rollup_counts() == case_counts()
+
+    # and can answer counts for simple case queries
+    assert CaseCountRollup.count_for_query(CaseMetadata.objects.in_scope().query) == CaseMetadata.objects.in_scope().count()
+    cases = CaseMetadata.objects.filter(jurisdiction_slug=jurisdiction.slug, in_scope=True)
+    assert CaseCountRollup.count_for_query(cases.query) == cases.count() == 1
+    assert CaseCountRollup.count_for_query(CaseMetadata.objects.filter(name_abbreviation='foo').query) is None
+    assert CaseCountRollup.count_for_query(CaseMetadata.objects.exclude(in_scope=True).query) is None
+
+
+@pytest.mark.django_db
+def test_cached_lookup_version(court):
+    assert Court.get_from_cache(slug=court.slug) == court
+
+    # changes that don't go through save() aren't seen until the lookup version changes
+    Court.objects.filter(pk=court.pk).update(name='New Name')
+    assert Court.get_from_cache(slug=court.slug).name == court.name
+    Court.bump_lookup_version()
+    assert Court.get_from_cache(slug=court.slug).name == 'New Name'
+
+
 @pytest.mark.django_db
 def test_withdraw_case(case_factory):
     withdrawn = case_factory()
@@ -192,6 +232,49 @@ def test_withdraw_case(case_factory):
     assert 'This case was withdrawn and replaced' in withdrawn.body_cache.xml
 
 
+@pytest.mark.django_db
+def test_sync_case_body_cache_json_and_text(case_factory, tar_file):
+    case = case_factory()
+    font = CaseFont.objects.create(family='Times', size='10', style='italics', type='serif', width='proportional')
+    italic = ['font', {'id': font.pk}]
+    pages = [
+        PageStructure.objects.create(volume=case.volume, order=1, label='5', width=100, height=100, ingest_source=tar_file, blocks=[
+            {'id': 'BL_1', 'class': 'parties', 'tokens': ['Foo ', italic, 'v.', ['/font'], ' Bar']},
+            {'id': 'BL_2', 'class': 'author', 'tokens': [italic, 'Smith', ['/font'], italic, ['footnotemark', {'ref': 'footnote_1'}], '1', ['/footnotemark'], ['/font']]},
+        ]),
+        PageStructure.objects.create(volume=case.volume, order=2, label='6', width=100, height=100, ingest_source=tar_file, blocks=[
+            {'id': 'BL_3', 'tokens': ['Opinion text', ['bracketnum'], '[1]', ['/bracketnum'], ' more']},
+            {'id': 'BL_4', 'tokens': ['1 A foot\xadnote.']},
+        ]),
+    ]
+    case.structure.pages.add(*pages)
+    case.structure.opinions = [
+        {'type': 'head', 'paragraphs': [{'id': 'b5-1', 'class': 'parties', 'block_ids': ['BL_1']}]},
+        {'type': 'majority', 'paragraphs': [
+            {'id': 'b5-2', 'class': 'author', 'block_ids': ['BL_2']},
+            {'id': 'b6-1', 'class': 'p', 'block_ids': ['BL_3']},
+        ], 'footnotes': [
+            {'id': 'footnote_1', 'label': '1', 'paragraphs': [{'id': 'b6-2', 'class': 'p', 'block_ids': ['BL_4']}]},
+        ]},
+    ]
+    case.structure.save()
+
+    # json and text are derived from the structure, and match what would be extracted from the html
+    case.sync_case_body_cache()
+    body_cache = CaseBodyCache.objects.get(metadata=case)
+    assert (body_cache.json, body_cache.text) == case.get_json_from_html(body_cache.html)
+    assert body_cache.text == "Foo v. Bar\nSmith\nOpinion text more\n1\nA footnote.\n"
+    assert body_cache.json['parties'] == ['Foo v. Bar']
+    assert body_cache.json['opinions'] == [{'type': 'majority', 'author': 'Smith', 'text': 'Smith\nOpinion text more\n1\nA footnote.'}]
+
+    # rerender=False regenerates just json and text
+    CaseBodyCache.objects.filter(pk=body_cache.pk).update(text='', json={}, html='<section></section>')
+    case = CaseMetadata.objects.select_related('body_cache').get(pk=case.pk)
+    case.sync_case_body_cache(rerender=False)
+    assert CaseBodyCache.objects.filter(pk=body_cache.pk).values_list('text', 'json', 'html').get() == \
+        (body_cache.text, body_cache.json, '<section></section>')
+
+
 ### Case Full Text Search ###
 @pytest.mark.django_db
 def test_fts_create_index(ingest_case_xml, django_assert_num_queries):
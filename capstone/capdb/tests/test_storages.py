@@ -1,5 +1,7 @@
 from io import BytesIO
 
+import pytest
+
 
 def test_iter_files_s3_storage(s3_storage):
     base_test_iter_files(s3_storage)
@@ -25,3 +27,80 @@ def base_test_iter_files(storage):
     assert set(file_names) == set(storage.iter_files_recursive())
     assert set(sub_dir) == set(storage.iter_files_recursive('d'))
 
+
+
+def test_ngram_value():
+    from capdb.storages import KVDB, NgramValue
+    record = NgramValue.record.pack
+
+    # merging keeps records sorted and totals up to date
+    value = NgramValue.merge(None, [record(2, 100, 3, 1), record(1, 101, 5, 2)])
+    value = NgramValue.merge(value, [record(1, 100, 1, 1), record(2, 100, 1, 1)])
+    assert NgramValue.totals(value) == [10, 5]
+    assert NgramValue.jurisdiction_ids(value) == [1, 2]
+    assert NgramValue.jurisdiction_years(value, 1) == [(100, 1, 1), (101, 5, 2)]
+    assert NgramValue.jurisdiction_years(value, 3) == []
+    assert NgramValue.year_totals(value) == [(100, 5, 3), (101, 5, 2)]
+
+    # count columns are widened as needed, and records are removed when counts reach zero
+    value = NgramValue.merge(value, [record(2, 100, 2 ** 20, 0), record(1, 101, -5, -2)])
+    assert NgramValue.to_dict(value) == {None: {None: [2 ** 20 + 5, 3], 100: [2 ** 20 + 5, 3]}, 1: [100, 1, 1], 2: [100, 2 ** 20 + 4, 2]}
+
+    # legacy msgpack values are readable and upgraded on merge
+    legacy = KVDB.pack({None: {None: [3, 2], 100: [3, 2]}, 1: [100, 3, 2]})
+    assert NgramValue.to_dict(legacy) == KVDB.unpack(legacy)
+    assert NgramValue.totals(NgramValue.merge(legacy, [record(1, 101, 1, 1)])) == [4, 3]
+
+
+def test_ngram_prefix_seek(tmpdir):
+    from capdb.storages import NgramRocksDB
+
+    # only multi-word gram and count keys are in the prefix extractor's domain
+    prefix = NgramRocksDB.GramPrefix()
+    assert [k for k in (b'\2two three', b'count\3one two three', b'\1one', b'totals\x93\1', b'count') if prefix.in_domain(k)] == [b'\2two three', b'count\3one two three']
+    assert prefix.transform(b'count\3one two three') == (0, len(b'count\3one '))
+
+    # write keys over several table files -- reopening a writable database flushes its log to one -- and compact them
+    # with the prefix extractor and merge operator in place
+    keys = [b'\1one', b'\2one two', b'\2two four', b'\2two three', b'\2twofold', b'\3two three four', b'totals']
+    for _ in range(4):
+        db = NgramRocksDB(path=str(tmpdir), prefix_seek=True)
+        for k in keys:
+            db.put(k, b'1')
+        db.merge(db.count_key(b'\2two three'), 1, packed=True)
+        del db
+    db = NgramRocksDB(path=str(tmpdir), prefix_seek=True)
+    assert db.db.get_property(b'rocksdb.num-files-at-level0') == b'4'
+    db.compact(poll_interval=.1)
+    assert db.db.get_property(b'rocksdb.num-files-at-level0') == b'0'
+    assert db.get(db.count_key(b'\2two three'), packed=True) == 4
+    del db
+
+    # prefix scans of the compacted tables, with their prefix bloom filters, see the same keys with and without
+    # prefix_seek
+    for prefix_seek in (False, True):
+        db = NgramRocksDB(path=str(tmpdir), read_only=True, prefix_seek=prefix_seek)
+        assert [k for k, v in db.get_prefix(b'\2two ')] == [b'\2two four', b'\2two three']
+        assert [k for k, v in db.get_prefix(b'\2', fill_cache=False)] == [b'\2one two', b'\2two four', b'\2two three', b'\2twofold']
+        assert list(db.get_prefix(b'\2three ')) == []
+        del db
+
+
+def test_ngram_top_prefix(tmpdir):
+    from capdb.storages import NgramRocksDB, NgramValue
+    db = NgramRocksDB(path=str(tmpdir))
+    values = {b'\2two four': NgramValue.encode([(1, 100, 3, 1)]), b'\2two three': NgramValue.encode([(1, 100, 5, 2)])}
+    for k, v in values.items():
+        db.put(k, v)
+
+    # grams without count keys aren't ranked by scanning full values -- the database needs `fab ngram_write_counts`
+    with pytest.raises(ValueError):
+        db.get_top_prefix(b'\2two ')
+    assert db.get_top_prefix(b'\2one ') == []
+
+    # once count keys are written, grams are ranked by them, and zero counts are skipped
+    db.put(db.count_key(b'\2two four'), 3, packed=True)
+    db.put(db.count_key(b'\2two three'), 5, packed=True)
+    db.put(db.count_key(b'\2two one'), 0, packed=True)
+    assert db.get_top_prefix(b'\2two ') == [(b'\2two three', values[b'\2two three']), (b'\2two four', values[b'\2two four'])]
+    assert db.get_top_prefix(b'\2two ', limit=1) == [(b'\2two three', values[b'\2two three'])]
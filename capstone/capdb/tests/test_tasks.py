@@ -5,12 +5,14 @@ import bagit
 import zipfile
 import os
 import gzip
+import billiard
 from django.db import connections, utils
 import json
 from datetime import datetime
 
-from capdb.models import CaseMetadata, Court, Reporter, Citation
-from capdb.tasks import create_case_metadata_from_all_vols, get_case_count_for_jur, get_court_count_for_jur, get_reporter_count_for_jur
+from capdb.models import CaseMetadata, Court, Reporter, Citation, CaseBodyCache
+from capdb.tasks import create_case_metadata_from_all_vols, get_case_count_for_jur, get_court_count_for_jur, \
+    get_reporter_count_for_jur, sync_case_body_cache_for_vol
 
 import fabfile
 
@@ -199,4 +201,56 @@ def test_update_case_frontend_url_bad_cite(case_metadata):
     citation.save()
     fabfile.update_case_frontend_url(update_existing=True)
     case_metadata.refresh_from_db()
-    assert case_metadata.frontend_url == "/%s/%s/%s/%s/" % (case_metadata.reporter.short_name_slug, case_metadata.volume.volume_number, case_metadata.first_page, citation.case_id)
\ No newline at end of file
+    assert case_metadata.frontend_url == "/%s/%s/%s/%s/" % (case_metadata.reporter.short_name_slug, case_metadata.volume.volume_number, case_metadata.first_page, citation.case_id)
+
+
+@pytest.mark.django_db
+def test_sync_case_body_cache_for_vol(case_factory, volume_metadata, django_assert_num_queries):
+    cases = [case_factory(volume=volume_metadata) for _ in range(3)]
+    CaseBodyCache(metadata=cases[0], text='old text').save()
+
+    # existing and new body caches are each written with a single query
+    with django_assert_num_queries(select=3, insert=1, update=1):
+        sync_case_body_cache_for_vol(volume_metadata.pk)
+
+    for case in cases:
+        body_cache = CaseBodyCache.objects.get(metadata=case)
+        assert 'data-case-id="%s"' % case.case_id in body_cache.html
+        assert body_cache.xml.startswith("<?xml version='1.0' encoding='utf-8'?>\n<casebody")
+        assert body_cache.text == "\n"
+        assert body_cache.json['opinions'] == []
+
+    # cases whose render inputs haven't changed are skipped, unless forced
+    with django_assert_num_queries(select=3):
+        sync_case_body_cache_for_vol(volume_metadata.pk)
+    cases[1].first_page = '2'
+    cases[1].save()
+    with django_assert_num_queries(select=3, update=1):
+        sync_case_body_cache_for_vol(volume_metadata.pk)
+    assert 'data-firstpage="2"' in CaseBodyCache.objects.get(metadata=cases[1]).html
+    with django_assert_num_queries(select=3, update=1):
+        sync_case_body_cache_for_vol(volume_metadata.pk, force=True)
+
+    # process pools close database connections before forking, so they can't run inside a transaction
+    with pytest.raises(ValueError):
+        sync_case_body_cache_for_vol(volume_metadata.pk, force=True, processes=2)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_case_body_cache_for_vol_process_pool(case_factory, volume_metadata):
+    cases = [case_factory(volume=volume_metadata) for _ in range(3)]
+    sync_case_body_cache_for_vol(volume_metadata.pk)
+    before = list(CaseBodyCache.objects.order_by('pk').values_list('html', 'xml', 'text', 'json', 'render_digest'))
+    CaseBodyCache.objects.update(html='', xml='')
+
+    # run the task in a daemonic process, like a celery prefork worker, which has to be able to start the pool
+    connections.close_all()
+    worker = billiard.Process(target=sync_case_body_cache_for_vol, args=(volume_metadata.pk,), kwargs={'force': True, 'processes': 2})
+    worker.daemon = True
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    # cases rendered in the pool are the same as cases rendered in this process
+    assert list(CaseBodyCache.objects.order_by('pk').values_list('html', 'xml', 'text', 'json', 'render_digest')) == before
+    assert CaseBodyCache.objects.count() == len(cases)
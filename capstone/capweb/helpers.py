@@ -2,6 +2,7 @@ import functools
 import json
 import re
 import socket
+import uuid
 from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 from functools import wraps
@@ -53,6 +54,23 @@ def cache_func(key, timeout=None, cache_name='default'):
         return decorated
     return decorator
 
+def cache_version(name, cache_name='default'):
+    """
+        Return the current version token for a group of cached values, like everything derived from one lookup table.
+        Include the token in those values' cache keys, and call bump_cache_version() to invalidate them all at once.
+    """
+    cache = caches[cache_name]
+    cache_key = 'cache-version:%s' % name
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, uuid.uuid4().hex, None)
+        version = cache.get(cache_key)
+    return version
+
+def bump_cache_version(name, cache_name='default'):
+    """ Start a new version for cache_version(name). A random token can't collide with a version from before eviction. """
+    caches[cache_name].set('cache-version:%s' % name, uuid.uuid4().hex, None)
+
 @cache_func(
     key=lambda section: 'get_data_from_lil_site:%s' % section,
     timeout=settings.CACHED_LIL_DATA_TIMEOUT
@@ -16,6 +16,7 @@ from django.utils.text import slugify
 from rest_framework.request import Request
 
 from capapi import serializers
+from capapi.allowance import CaseAllowanceBucket
 from capapi.authentication import SessionAuthentication
 from capapi.renderers import HTMLRenderer
 from capdb.models import Reporter, VolumeMetadata, Citation, CaseMetadata
@@ -51,6 +52,26 @@ def locked_session(request, using='default'):
             request.session.save()
 
 
+def take_session_case_allowance(request):
+    """ Use one case from a logged-out user's daily case allowance, returning False if it's used up. """
+    if settings.CASE_ALLOWANCE_BACKEND == 'redis':
+        # no session write needed -- see capapi.allowance
+        return CaseAllowanceBucket.for_session(request.session).take(1)[0] == 1
+
+    with locked_session(request) as session:
+        cases_remaining = session['case_allowance_remaining']
+
+        # handle daily quota reset
+        if session['case_allowance_last_updated'] < time.time() - 60*60*24:
+            cases_remaining = settings.API_CASE_DAILY_ALLOWANCE
+            session['case_allowance_last_updated'] = time.time()
+
+        if cases_remaining > 0:
+            session['case_allowance_remaining'] = cases_remaining - 1
+            return True
+        return False
+
+
 ### views ###
 
 def home(request):
@@ -146,22 +167,13 @@ def citation(request, series_slug, volume_number, page_number, case_id=None):
 
         # handle logged-out user with cookies set up already
         elif 'case_allowance_remaining' in request.session and request.COOKIES.get('not_a_bot', 'no') == 'yes':
-            with locked_session(request) as session:
-                cases_remaining = session['case_allowance_remaining']
-
-                # handle daily quota reset
-                if session['case_allowance_last_updated'] < time.time() - 60*60*24:
-                    cases_remaining = settings.API_CASE_DAILY_ALLOWANCE
-                    session['case_allowance_last_updated'] = time.time()
-
-                # if quota remaining, serialize without checking credentials
-                if cases_remaining > 0:
-                    session['case_allowance_remaining'] = cases_remaining - 1
-                    serializer = serializers.NoLoginCaseSerializer
-
-                # if quota used up, use regular serializer that checks credentials
-                else:
-                    serializer = serializers.CaseSerializerWithCasebody
+            # if quota remaining, serialize without checking credentials
+            if take_session_case_allowance(request):
+                serializer = serializers.NoLoginCaseSerializer
+
+            # if quota used up, use regular serializer that checks credentials
+            else:
+                serializer = serializers.CaseSerializerWithCasebody
 
         # handle google crawler
         elif helpers.is_google_bot(request):
@@ -432,6 +432,10 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'capapi.tasks.daily_site_limit_reset_and_report',
         'schedule': crontab(hour=0, minute=0),
     },
+    'write-back-case-allowances': {
+        'task': 'capapi.tasks.write_back_case_allowances',
+        'schedule': crontab(minute='*/5'),
+    },
 }
 CELERY_TIMEZONE = 'UTC'
 
@@ -439,6 +443,10 @@ CELERY_TIMEZONE = 'UTC'
 
 API_CASE_DAILY_ALLOWANCE = 500
 API_CASE_EXPIRE_HOURS = 24
+# 'db' to keep case allowances in CapUser rows and sessions, or 'redis' to keep them in redis token buckets and copy
+# users' allowances back to CapUser every few minutes -- see capapi.allowance
+CASE_ALLOWANCE_BACKEND = 'db'
+SITE_LIMITS_SHARD_COUNT = 16  # number of SiteLimitsShard rows to spread daily_downloads updates across
 API_BASE_URL_ROUTE = '/api'
 API_VERSION = 'v1'
 API_DOCS_CASE_ID = 2
@@ -448,7 +456,10 @@ API_CASE_FILE_TYPE = '.xml'
 # CACHES
 CACHED_COUNT_TIMEOUT = 60*60*24*7  # 'count' value in API responses is cached for up to 7 days
 CACHED_LIL_DATA_TIMEOUT = 60*60*24  # news and contributor data from LIL site is cached once a day
+CACHED_LOOKUP_TIMEOUT = 60*60*24*7  # filter choices and forms built from lookup tables -- keys include the tables' lookup_version()
+CASE_METADATA_CACHE_TIMEOUT = 60*60*24*7  # serialized case metadata is cached for up to 7 days -- see CaseSerializer
 LIVE_COUNT_TIME_LIMIT = 2  # number of seconds to try to generate a count while preparing an API response
+LIVE_COUNT_ESTIMATE_THRESHOLD = 100000  # above this many estimated rows, API responses use the estimate while the count is generated in background
 TASK_COUNT_TIME_LIMIT = 120  # number of seconds to try to generate a count in background task
 
 # DATA VISUALIZATION
@@ -565,6 +576,12 @@ LOGIN_URL = 'login'
 NLTK_PATH = [os.path.join(SERVICES_DIR, 'nltk')]
 
 NGRAM_THREAD_COUNT = 4
+NGRAM_TOKENIZER = 'nltk'  # backend from scripts.ngrams.tokenizers; runs can opt in to 'regex' with `fab ngram_jurisdictions:tokenizer=regex`
+NGRAM_RUN_DIR = None  # local directory for the sorted run files written while ngramming; None for system temp dir
+NGRAM_COUNTER_MAX_ENTRIES = 5000000  # distinct grams each ngram worker counts in memory before spilling to NGRAM_RUN_DIR
+# record each counted case's text digest and tokens, so `fab ngram_jurisdictions:incremental=true` can update the database.
+# This stores a copy of every case's tokens -- about the size of the case text itself, before lz4 compression.
+NGRAM_INCREMENTAL_UPDATES = False
 
 # feature flags
 FULL_TEXT_FEATURE = True
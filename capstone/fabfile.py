@@ -180,6 +180,14 @@ def initialize_denormalization_fields():
     """
     set_up_postgres.initialize_denormalization_fields()
 
+@task
+def rebuild_case_count_rollups():
+    """
+        Repopulate CaseCountRollup from CaseMetadata. The rollups are kept current by a trigger, so this is only needed
+        if they get out of sync, for example if the trigger was dropped.
+    """
+    set_up_postgres.rebuild_case_count_rollups()
+
 @task
 def update_volume_metadata():
     """ Update VolumeMetadata fields from VolumeXML. """
@@ -805,10 +813,78 @@ def count_chars_in_all_cases(path="/tmp/counts"):
 
 
 @task
-def ngram_jurisdictions(slug=None):
-    """ Generate ngrams for all jurisdictions, or for single jurisdiction if jurisdiction slug is provided. """
+def ngram_jurisdictions(slug=None, bulk='false', incremental='false', tokenizer=None):
+    """
+        Generate ngrams for all jurisdictions, or for single jurisdiction if jurisdiction slug is provided.
+        Set bulk to 'true' to load a new database from sorted run files instead of merging into rocksdb.
+        Set incremental to 'true' to update already-counted jurisdiction-years with cases added, edited or removed since.
+        This requires settings.NGRAM_INCREMENTAL_UPDATES, which must also have been set when they were first counted.
+        Set tokenizer to 'nltk' or 'regex' to override settings.NGRAM_TOKENIZER.
+    """
     from scripts.ngrams import ngram_jurisdictions
-    ngram_jurisdictions(slug)
+    ngram_jurisdictions(slug, bulk=bulk == 'true', incremental=incremental == 'true', tokenizer_backend=tokenizer)
+
+
+@task
+def ngram_write_counts():
+    """
+        Add the per-gram count keys used to rank wildcard searches to an ngram database that predates them.
+        This is a required deploy step for such databases: until it has run, wildcard ngram searches raise an error.
+    """
+    from scripts.ngrams import write_gram_counts
+    write_gram_counts()
+
+
+@task
+def ngram_migrate_values():
+    """
+        Rewrite ngram values stored in the legacy msgpack format in the current columnar format.
+        Run this while no ngram_jurisdictions task is writing to the database -- see migrate_values().
+    """
+    from scripts.ngrams import migrate_values
+    migrate_values()
+
+
+@task
+def ngram_benchmark_value_formats(repeat=20):
+    """ Compare size, merge and slice latency of legacy msgpack and columnar ngram values. """
+    from scripts.ngram_benchmarks import benchmark_value_formats
+    benchmark_value_formats(repeat=int(repeat))
+
+
+@task
+def ngram_benchmark_wildcard(gram_count=200000, prefix_count=50, repeat=5):
+    """ Compare full-value and count-key ranking of wildcard ngram searches on a synthetic database. """
+    from scripts.ngram_benchmarks import benchmark_wildcard
+    benchmark_wildcard(int(gram_count), int(prefix_count), int(repeat))
+
+
+@task
+def ngram_benchmark_reads(gram_count=200000, prefix_count=2000, lookup_count=2000, repeat=5):
+    """ Compare exact and prefix ngram lookups with and without prefix_seek on synthetic databases. """
+    from scripts.ngram_benchmarks import benchmark_reads
+    benchmark_reads(int(gram_count), int(prefix_count), int(lookup_count), int(repeat))
+
+
+@task
+def ngram_benchmark_bulk_load(slug=None):
+    """ Compare time and database size of merge-based and bulk ngram loading, using temporary databases. """
+    from scripts.ngram_benchmarks import benchmark_bulk_load
+    benchmark_bulk_load(slug)
+
+
+@task
+def ngram_benchmark_tokenizers(slug=None, case_count=1000, repeat=3):
+    """ Report tokens per second for each ngram tokenizer backend on cases from the database. """
+    from scripts.ngram_benchmarks import benchmark_tokenizers
+    benchmark_tokenizers(slug, int(case_count), int(repeat))
+
+
+@task
+def render_benchmark_json_and_text(volume_count=3, repeat=3):
+    """ Compare CaseBodyCache json/text extraction from rendered HTML and from case structure, on the largest volumes. """
+    from scripts.render_benchmarks import benchmark_json_and_text
+    benchmark_json_and_text(int(volume_count), int(repeat))
 
 
 @task
@@ -1080,13 +1156,20 @@ def load_token_streams(replace_existing=False):
         scripts.refactor_xml.write_to_db.delay(volume_barcode, str(path))
 
 @task
-def refresh_case_body_cache(last_run_before=None, rerender=True):
-    """ Recreate CaseBodyCache for all cases. Use `fab refresh_case_body_cache:rerender=false` to just regenerate text/json from html. """
+def refresh_case_body_cache(last_run_before=None, rerender=True, force=False, processes=None):
+    """
+        Recreate CaseBodyCache for all cases whose structure, pages or render_case.RENDER_VERSION have changed.
+        Use `fab refresh_case_body_cache:force=true` to rerender every case, or
+        `fab refresh_case_body_cache:rerender=false` to just regenerate text/json.
+        Use `fab refresh_case_body_cache:processes=4` to render each volume's cases in a pool of worker processes.
+    """
     tasks.run_task_for_volumes(
         tasks.sync_case_body_cache_for_vol,
         VolumeMetadata.objects.exclude(xml_metadata=None),
         last_run_before=last_run_before,
         rerender=rerender != 'false',
+        force=force == 'true',
+        processes=int(processes) if processes else None,
     )
 
 @task
@@ -173,6 +173,12 @@ class UserBehavior(TaskSet):
         parameters = {"jurisdiction": choice(["ark", "ill"]), "full_case": "true"}
         self.random_endpoint_page(api_host, "cases", 100, parameters)
 
+    @locust_task(2)
+    def scroll_through_full_case_text_pages(self):
+        # bulk-style pages of text casebodies; locust's average content size times requests/s gives bytes/s
+        parameters = {"jurisdiction": choice(["ark", "ill"]), "full_case": "true", "body_format": "text", "page_size": 100}
+        self.random_endpoint_page(api_host, "cases", 10, parameters)
+
     @locust_task(8)
     def scroll_through_full_text_search(self):
         parameters = {"search": choice(search_terms)}
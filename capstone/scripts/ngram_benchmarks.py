@@ -0,0 +1,207 @@
+"""
+    Benchmarks for ngram storage and lookups, run against synthetic databases in a temp directory.
+    These are run by the `fab ngram_benchmark_*` tasks.
+"""
+import bisect
+import os
+import random
+import statistics
+import tempfile
+import timeit
+
+from tqdm import tqdm
+
+from capdb.storages import NgramRocksDB, NgramValue, KVDB, ngram_kv_store, ngram_kv_store_ro
+
+
+def make_synthetic_db(path, gram_count=200000, prefix_count=50, jurisdiction_count=20, year_count=50, seed=0, prefix_seek=False):
+    """
+        Write a synthetic ngram database to path, with each gram's value and count key already merged, as a
+        compacted database written by scripts.ngrams.rocksdb_write_thread() has them.
+        Grams are bigrams like 'w3 x1234', so each of the `prefix_count` first words matches many grams, and each gram
+        is observed in a random set of jurisdiction-years.
+    """
+    rand = random.Random(seed)
+    db = NgramRocksDB(path=path, prefix_seek=prefix_seek)
+    batch_size = 1000
+    for start in tqdm(range(0, gram_count, batch_size), desc="Synthetic gram batches written", mininterval=.5):
+        with db.in_transaction() as batch:
+            for i in range(start, min(start + batch_size, gram_count)):
+                key = b'\2' + ('w%s x%s' % (i % prefix_count, i)).encode('utf8')
+                records = []
+                for _ in range(rand.randint(1, jurisdiction_count * year_count // 10)):
+                    instance_count = rand.randint(1, 1000)
+                    records.append((rand.randint(1, jurisdiction_count), rand.randint(0, year_count), instance_count, rand.randint(1, instance_count)))
+                value = NgramValue.encode(records)
+                db.put(key, value, batch=batch)
+                db.put(db.count_key(key), NgramValue.totals(value)[0], packed=True, batch=batch)
+    db.compact()
+    return db
+
+
+def time_call(func, repeat):
+    """ Return median seconds for a single call to func. """
+    return statistics.median(timeit.repeat(func, number=1, repeat=repeat))
+
+
+## wildcard queries
+
+def full_value_top_prefix(db, prefix, limit=10):
+    """ Wildcard ranking as NgramViewSet did it before count keys: read every candidate's full value. """
+    top_pairs = []
+    for gram, data in db.get_prefix(prefix):
+        bisect.insort_right(top_pairs, (NgramValue.totals(data)[0], gram, data))
+        top_pairs = top_pairs[-limit:]
+    return [(gram, data) for _, gram, data in reversed(top_pairs)]
+
+def benchmark_wildcard(gram_count=200000, prefix_count=50, repeat=5):
+    """ Compare full-value and count-key ranking of wildcard queries. """
+    with tempfile.TemporaryDirectory() as path:
+        db = make_synthetic_db(path, gram_count=gram_count, prefix_count=prefix_count)
+        prefixes = [b'\2w%d ' % i for i in range(0, prefix_count, max(1, prefix_count // 5))]
+        print("%s grams, %s candidates per prefix, median of %s runs:" % (gram_count, gram_count // prefix_count, repeat))
+        for prefix in prefixes:
+            assert full_value_top_prefix(db, prefix) == db.get_top_prefix(prefix)
+            full_value_time = time_call(lambda: full_value_top_prefix(db, prefix), repeat)
+            count_key_time = time_call(lambda: db.get_top_prefix(prefix), repeat)
+            print(" - %r: full values %.4fs, count keys %.4fs (%.1fx)" % (
+                prefix, full_value_time, count_key_time, full_value_time / count_key_time))
+
+
+## read options
+
+def benchmark_reads(gram_count=200000, prefix_count=2000, lookup_count=2000, repeat=5):
+    """
+        Compare exact and prefix lookups against read-only databases opened with and without prefix_seek, each
+        written in the same mode. Lookups are for grams and prefixes that exist, and for ones that don't -- a wildcard
+        search for a first word that isn't in the corpus is where prefix bloom filters help most.
+    """
+    rand = random.Random(0)
+    found_keys = [b'\2' + ('w%s x%s' % (i % prefix_count, i)).encode('utf8') for i in rand.sample(range(gram_count), lookup_count)]
+    missing_keys = [b'\2' + ('w%s y%s' % (i % prefix_count, i)).encode('utf8') for i in range(lookup_count)]
+    found_prefixes = [b'\2w%d ' % i for i in rand.sample(range(prefix_count), min(prefix_count, lookup_count // 10))]
+    missing_prefixes = [b'\2v%d ' % i for i in range(lookup_count)]
+    lookups = [
+        ("get, found", lambda db: [db.get(k) for k in found_keys]),
+        ("get, missing", lambda db: [db.get(k) for k in missing_keys]),
+        ("get_many, found", lambda db: db.get_many(found_keys)),
+        ("get_top_prefix, found", lambda db: [db.get_top_prefix(p) for p in found_prefixes]),
+        ("get_top_prefix, missing", lambda db: [db.get_top_prefix(p) for p in missing_prefixes]),
+        ("get_prefix, uncached", lambda db: [list(db.get_prefix(p, fill_cache=False)) for p in found_prefixes]),
+    ]
+
+    timings = {}
+    for prefix_seek in (False, True):
+        with tempfile.TemporaryDirectory() as path:
+            make_synthetic_db(path, gram_count=gram_count, prefix_count=prefix_count, prefix_seek=prefix_seek)
+            db = NgramRocksDB(path=path, read_only=True, prefix_seek=prefix_seek)
+            for name, lookup in lookups:
+                lookup(db)  # warm the block cache
+                timings[(name, prefix_seek)] = time_call(lambda: lookup(db), repeat)
+            del db
+
+    print("%s grams, %s lookups per test, median of %s runs:" % (gram_count, lookup_count, repeat))
+    for name, _ in lookups:
+        default_time, prefix_seek_time = timings[(name, False)], timings[(name, True)]
+        print(" - %s: default %.4fs, prefix_seek %.4fs (%.1fx)" % (name, default_time, prefix_seek_time, default_time / prefix_seek_time))
+
+
+## value encoding
+
+def legacy_merge(existing_value, records):
+    """ Merge records into a msgpack value the way NgramRocksDB.NgramMergeOperator did before NgramValue. """
+    value = KVDB.unpack(existing_value) if existing_value else {None: {None: [0, 0]}}
+    for jurisdiction_id, storage_year, instance_count, document_count in records:
+        value.setdefault(jurisdiction_id, []).extend((storage_year, instance_count, document_count))
+        totals = value[None]
+        totals_year = totals.setdefault(storage_year, [0, 0])
+        totals_year[0] += instance_count
+        totals_year[1] += document_count
+        totals[None][0] += instance_count
+        totals[None][1] += document_count
+    return KVDB.pack(value)
+
+def legacy_jurisdiction_years(value, jurisdiction_id):
+    years = KVDB.unpack(value).get(jurisdiction_id, [])
+    return [tuple(years[i:i+3]) for i in range(0, len(years), 3)]
+
+def benchmark_value_formats(record_counts=(10, 100, 1000, 10000), jurisdiction_count=60, repeat=20, seed=0):
+    """
+        Compare legacy msgpack and NgramValue encodings for gram values observed in `record_counts` jurisdiction-years:
+        encoded size, time to merge one more observation, and time to slice out one jurisdiction.
+    """
+    rand = random.Random(seed)
+    print("records | size: msgpack, columnar | merge one: msgpack, columnar | slice one jurisdiction: msgpack, columnar")
+    for record_count in record_counts:
+        keys = rand.sample([(j, y) for j in range(1, jurisdiction_count + 1) for y in range(-260, 125)], record_count + 1)
+        records = []
+        for jurisdiction_id, storage_year in keys:
+            instance_count = int(rand.paretovariate(1))
+            records.append((jurisdiction_id, storage_year, instance_count, rand.randint(1, instance_count)))
+        new_record = records.pop()
+        legacy_value = legacy_merge(None, records)
+        value = NgramValue.encode(records)
+        jurisdiction_id = records[0][0]
+        assert sorted(legacy_jurisdiction_years(legacy_value, jurisdiction_id)) == NgramValue.jurisdiction_years(value, jurisdiction_id)
+
+        print("%7s | %8s, %8s | %.6fs, %.6fs | %.6fs, %.6fs" % (
+            record_count, len(legacy_value), len(value),
+            time_call(lambda: legacy_merge(legacy_value, [new_record]), repeat),
+            time_call(lambda: NgramValue.merge(value, [NgramValue.record.pack(*new_record)]), repeat),
+            time_call(lambda: legacy_jurisdiction_years(legacy_value, jurisdiction_id), repeat),
+            time_call(lambda: NgramValue.jurisdiction_years(value, jurisdiction_id), repeat),
+        ))
+
+
+## bulk loading
+
+def benchmark_bulk_load(slug=None):
+    """
+        Run ngram_jurisdictions() with and without bulk=True, each into a fresh temporary database, and compare time and
+        database size. Runs against the real case text in the configured database, so pass a jurisdiction slug to
+        keep this quick.
+    """
+    from scripts.ngrams import ngram_jurisdictions
+
+    store_wrapped, store_ro_wrapped = ngram_kv_store._wrapped, ngram_kv_store_ro._wrapped
+    results = []
+    try:
+        for bulk in (False, True):
+            with tempfile.TemporaryDirectory() as path:
+                ngram_kv_store._wrapped = NgramRocksDB(path=path)
+                ngram_kv_store_ro._wrapped = NgramRocksDB(path=path, read_only=True)
+                start_time = timeit.default_timer()
+                ngram_jurisdictions(slug, bulk=bulk)
+                results.append((bulk, timeit.default_timer() - start_time, ngram_kv_store.db_size(), len(os.listdir(ngram_kv_store.db_path()))))
+    finally:
+        ngram_kv_store._wrapped, ngram_kv_store_ro._wrapped = store_wrapped, store_ro_wrapped
+
+    for bulk, seconds, size, file_count in results:
+        print("%s: %.1fs, %s bytes in %s files" % ("bulk" if bulk else "merge", seconds, size, file_count))
+
+
+## tokenizers
+
+def benchmark_tokenizers(slug=None, case_count=1000, repeat=3):
+    """
+        Report tokens per second for each backend in scripts.ngrams.tokenizers, on up to case_count cases from the
+        configured database, and check that all backends agree.
+    """
+    from capdb.models import CaseBodyCache
+    from scripts.ngrams import tokenizers
+
+    cases = CaseBodyCache.objects.filter(metadata__duplicative=False).order_by('id')
+    if slug:
+        cases = cases.filter(metadata__jurisdiction_slug=slug)
+    texts = list(cases.values_list('text', flat=True)[:case_count])
+    print("%s cases, %s characters, median of %s runs:" % (len(texts), sum(len(text) for text in texts), repeat))
+
+    expected = None
+    for name, tokenize in sorted(tokenizers.items()):
+        tokens = [list(tokenize(text)) for text in texts]
+        if expected is None:
+            expected = tokens
+        assert tokens == expected, "%s tokenizer disagrees with the others" % name
+        token_count = sum(len(case_tokens) for case_tokens in tokens)
+        seconds = time_call(lambda: [list(tokenize(text)) for text in texts], repeat)
+        print(" - %s: %s tokens in %.2fs (%.0f tokens/s)" % (name, token_count, seconds, token_count / seconds))
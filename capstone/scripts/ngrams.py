@@ -1,24 +1,45 @@
 import copy
+import hashlib
+import heapq
+import itertools
+import os
 import random
+import re
+import resource
+import shutil
+import tempfile
+import time
+from operator import itemgetter
+from pathlib import Path
 from queue import Queue
 from threading import Thread
+import msgpack
 import rocksdb
 import traceback
-from collections import Counter
+from collections import Counter, namedtuple
+from functools import lru_cache
 from multiprocessing import Process, Manager
 from multiprocessing.pool import Pool
 import nltk
 from tqdm import tqdm
 
 from django.conf import settings
+from django.db.models import CharField, Func, Value
+from django.db.models.functions import Coalesce
 
 from capdb.models import Jurisdiction, CaseMetadata, CaseBodyCache
-from capdb.storages import ngram_kv_store, KVDB, ngram_kv_store_ro
+from capdb.storages import ngram_kv_store, KVDB, ngram_kv_store_ro, NgramRocksDB, NgramValue
 from scripts.helpers import ordered_query_iterator
 
 nltk.data.path = settings.NLTK_PATH
 unicode_translate_table = dict((ord(a), ord(b)) for a, b in zip(u'\u201c\u201d\u2018\u2019', u'""\'\''))
 
+## tokenizers
+#
+# tokenize() runs one of the backends in `tokenizers`, chosen per run by ngram_jurisdictions(tokenizer_backend=...)
+# and defaulting to settings.NGRAM_TOKENIZER. Backends must produce identical token streams -- see
+# test_tokenize_backends.
+
 # custom tokenizer to disable separating contractions and possessives into separate words
 tokenizer = copy.copy(nltk.tokenize._treebank_word_tokenizer)
 tokenizer.CONTRACTIONS2 = tokenizer.CONTRACTIONS3 = []
@@ -28,18 +49,60 @@ strip_chars = """`~!@#$%^&*()-_=+[{]}\|;:'",<>/?¡°¿‡†—•■"""
 strip_right_chars = strip_chars + "£$©"
 strip_left_chars = strip_chars + ".®"
 
-def tokenize(text):
+def clean_text(text):
     # clean up input
-    text = text.translate(unicode_translate_table)\
+    return text.translate(unicode_translate_table)\
         .replace(u"\u2014", u" \u2014 ")  # add spaces around m-dashes
 
+def nltk_tokenize(text):
     # yield each valid token
-    for sentence in nltk.sent_tokenize(text):
+    for sentence in nltk.sent_tokenize(clean_text(text)):
         for token in tokenizer.tokenize(sentence):
             token = token.lower().rstrip(strip_right_chars).lstrip(strip_left_chars)
             if token:
                 yield token
 
+# regex_tokenize() reproduces nltk_tokenize() with one split per sentence instead of the twenty-odd substitutions
+# `tokenizer` makes. That includes the "improved" quote and final period rules that nltk.tokenize adds to the
+# Treebank rule lists on import. Splitting only matters where it separates characters that survive stripping,
+# so rules that just split off trailing punctuation are left out.
+treebank_split_re = re.compile(r"""
+    ([«»„])|                            # quotes that aren't stripped, so are kept as tokens
+    \s+|[;@#$%&?!\[\](){}<>"]|`+|--|\.\.\.|''|
+    [:,](?!\d)|                         # but not 3,000 or 10:30
+    '(?!re|ve|ll|m|t|s|d)(?=\w\b)       # opening single quote before a one-letter word
+""", re.IGNORECASE | re.VERBOSE)
+
+# The last period of a sentence, if it doesn't follow another period and is followed only by closing brackets and
+# quotes. Treebank turns a double quote after a space into an opening quote first, so that doesn't count.
+final_period_re = re.compile(r"""(?<=[^.])\.(?=(?:[\]\)}>"'»”’]| (?!"|''))*\s*$)""")
+
+@lru_cache()
+def sentence_tokenizer():
+    """
+        Copy of the punkt tokenizer used by nltk.sent_tokenize(). Punkt checks each possible sentence break by
+        annotating a short context string like "Co. of", which repeats often in case text, so cache the answers.
+    """
+    punkt = copy.copy(nltk.data.load('tokenizers/punkt/english.pickle'))
+    punkt.text_contains_sentbreak = lru_cache(maxsize=2**16)(punkt.text_contains_sentbreak)
+    return punkt
+
+def regex_tokenize(text):
+    for sentence in sentence_tokenizer().tokenize(clean_text(text)):
+        for token in treebank_split_re.split(final_period_re.sub(' ', sentence, 1)):
+            if token:
+                token = token.lower().rstrip(strip_right_chars).lstrip(strip_left_chars)
+                if token:
+                    yield token
+
+tokenizers = {
+    'nltk': nltk_tokenize,
+    'regex': regex_tokenize,
+}
+
+def tokenize(text, backend=None):
+    return tokenizers[backend or settings.NGRAM_TOKENIZER](text)
+
 def ngrams(words, n, padding=False):
     """
         Yield generator of all n-tuples from list of words.
@@ -53,16 +116,36 @@ def ngrams(words, n, padding=False):
     return zip(*word_lists)
 
 def get_totals_key(jurisdiction_id, year, n):
-    return b"totals" + KVDB.pack((jurisdiction_id, year, n))
+    return NgramRocksDB.totals_key_prefix + KVDB.pack((jurisdiction_id, year, n))
 
-def ngram_jurisdictions(slug=None, max_n=3):
+def ngram_jurisdictions(slug=None, max_n=3, bulk=False, incremental=False, tokenizer_backend=None):
     """
         Add jurisdiction specified by slug to rocksdb, or all jurisdictions if name not provided.
 
         This is the primary ngrams entrypoint. It spawns NGRAM_THREAD_COUNT worker processes to
         ngram each jurisdiction-year, plus a rocksdb worker process that pulls their work off of
         the queue and writes it to the database.
+
+        If bulk is True, workers instead write sorted runs to local files, which are merged and loaded
+        into a new database by bulk_load_runs().
+
+        Normally jurisdiction-years that have already been counted are skipped. If incremental is True, they are
+        instead updated with just the cases that have been added, edited or removed since -- see ngram_update_worker().
+        This requires settings.NGRAM_INCREMENTAL_UPDATES, for the database to have been written with case records.
+
+        tokenizer_backend picks one of `tokenizers`, defaulting to settings.NGRAM_TOKENIZER.
     """
+    start_time = time.time()
+    if bulk and incremental:
+        raise ValueError("Bulk mode loads a new database, so can't be combined with incremental updates.")
+    if incremental and not settings.NGRAM_INCREMENTAL_UPDATES:
+        raise ValueError("Incremental updates require settings.NGRAM_INCREMENTAL_UPDATES.")
+    if bulk:
+        # bulk loading writes complete values, so can't add to existing ones
+        if Path(ngram_kv_store.db_path()).exists():
+            raise ValueError("Bulk mode can only load a new database, but %s exists." % ngram_kv_store.db_path())
+        run_dir = tempfile.mkdtemp(dir=settings.NGRAM_RUN_DIR)
+
     # process pool of workers to ngram each jurisdiction-year and return keys
     ngram_workers = Pool(settings.NGRAM_THREAD_COUNT, maxtasksperchild=1)
 
@@ -73,32 +156,47 @@ def ngram_jurisdictions(slug=None, max_n=3):
     ngram_worker_lock = m.Lock()
 
     # process to write keys to rocksdb
-    rocksdb_loaded = m.Condition()
-    rocksdb_worker = Process(target=rocksdb_writer, args=(queue, rocksdb_loaded))
-    rocksdb_worker.start()
-    with rocksdb_loaded:
-        rocksdb_loaded.wait()
+    if not bulk:
+        rocksdb_loaded = m.Condition()
+        rocksdb_worker = Process(target=rocksdb_writer, args=(queue, rocksdb_loaded))
+        rocksdb_worker.start()
+        with rocksdb_loaded:
+            rocksdb_loaded.wait()
 
     # queue each jurisdiction-year for processing
     jurisdictions = Jurisdiction.objects.all()
     if slug:
         jurisdictions = jurisdictions.filter(slug=slug)
     ngram_worker_results = []
+    if incremental:
+        # a separate read-only handle, so worker processes forked later don't inherit an open one
+        case_store = NgramRocksDB(path=ngram_kv_store.path, read_only=True)
     for jurisdiction in jurisdictions:
+        years = set()
 
-        # skip empty jurisdictions
-        if not jurisdiction.case_metadatas.exists():
-            continue
+        # get year range, skipping empty jurisdictions
+        if jurisdiction.case_metadatas.exists():
+            case_query = CaseMetadata.objects.in_scope().filter(jurisdiction_slug=jurisdiction.slug)
+            first_year = case_query.order_by('decision_date', 'id').first().decision_date.year
+            last_year = case_query.order_by('-decision_date', '-id').first().decision_date.year
+            years.update(range(first_year, last_year + 1))
 
-        # get year range
-        case_query = CaseMetadata.objects.in_scope().filter(jurisdiction_slug=jurisdiction.slug)
-        first_year = case_query.order_by('decision_date', 'id').first().decision_date.year
-        last_year = case_query.order_by('-decision_date', '-id').first().decision_date.year
+        # when updating, also revisit years with counted cases, which may since have been removed or moved
+        if incremental:
+            years.update(case_store.case_years(jurisdiction.id))
 
         # ngram each year
-        for year in range(first_year, last_year + 1):
+        for year in sorted(years):
             # ngram_worker(queue, jurisdiction_id, year, max_n)
-            ngram_worker_results.append((jurisdiction.slug, year, ngram_workers.apply_async(ngram_worker, (ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction.id, jurisdiction.slug, year, max_n))))
+            if bulk:
+                result = ngram_workers.apply_async(ngram_run_worker, (ngram_worker_offsets, ngram_worker_lock, run_dir, jurisdiction.id, jurisdiction.slug, year, max_n, tokenizer_backend))
+            elif incremental:
+                result = ngram_workers.apply_async(ngram_update_worker, (ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction.id, jurisdiction.slug, year, max_n, tokenizer_backend))
+            else:
+                result = ngram_workers.apply_async(ngram_worker, (ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction.id, jurisdiction.slug, year, max_n, tokenizer_backend))
+            ngram_worker_results.append((jurisdiction.slug, year, result))
+    if incremental:
+        del case_store
 
     # wait for all ngram workers to finish
     ngram_workers.close()
@@ -111,11 +209,227 @@ def ngram_jurisdictions(slug=None, max_n=3):
             print("%s-%s failed:" % (jurisdiction_slug, year))
             traceback.print_exception(etype=type(exc), value=exc, tb=exc.__traceback__)
 
-    # tell rocksdb worker to exit, and wait for it to finish
-    queue.put('STOP')
-    rocksdb_worker.join()
+    if bulk:
+        results = [result._value for _, _, result in ngram_worker_results if result._success]
+        bulk_load_runs(run_dir, [pair for totals, _ in results for pair in totals], [cases for _, cases in results])
+    else:
+        # tell rocksdb worker to exit, and wait for it to finish
+        queue.put('STOP')
+        rocksdb_worker.join()
+
+    # writes are loaded with automatic compaction off -- see NgramRocksDB.options()
+    ngram_kv_store.compact()
+
+    # let API processes know to reload their cached totals
+    ngram_kv_store.bump_generation()
+
+    print("Ngrams finished in %.1f seconds. Database size: %s bytes." % (time.time() - start_time, ngram_kv_store.db_size()))
+
+def claim_line_offset(ngram_worker_offsets, ngram_worker_lock):
+    """ Pick a free tqdm line for this worker -- see ngram_worker(). """
+    with ngram_worker_lock:
+        line_offset = next((i for i in range(settings.NGRAM_THREAD_COUNT) if i not in ngram_worker_offsets), None)
+        if line_offset is None:
+            line_offset = random.shuffle(ngram_worker_offsets.keys())[0]
+        ngram_worker_offsets[line_offset] = True
+    return line_offset
+
+## run files
+#
+# Run files are msgpack streams of key-sorted tuples, starting with the key. They're used to spill counts to disk in
+# NgramCounter, to pass observations from ngram_worker() to rocksdb_write_thread(), and for bulk loading.
+
+def write_run(path, records):
+    """ Write an iterable of key-sorted record tuples to path. """
+    packer = msgpack.Packer(use_bin_type=True)
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write(packer.pack(record))
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        yield from msgpack.Unpacker(f, use_list=False, raw=False)
+
+def temp_run_path(run_dir=None):
+    """ Return the path of a new, empty run file in run_dir (settings.NGRAM_RUN_DIR by default), for the caller to remove. """
+    fd, path = tempfile.mkstemp(suffix='.run', dir=run_dir or settings.NGRAM_RUN_DIR)
+    os.close(fd)
+    return path
+
+def merge_runs(paths, run_dir, fan_in=256):
+    """
+        Return an iterator of records from all run files in paths, in key order.
+        Runs are first merged in groups of fan_in, so we never have too many files open at once.
+    """
+    paths = list(paths)
+    while len(paths) > fan_in:
+        merged_paths = []
+        for i in range(0, len(paths), fan_in):
+            merged_path = temp_run_path(run_dir)
+            write_run(merged_path, heapq.merge(*(read_run(path) for path in paths[i:i+fan_in])))
+            for path in paths[i:i+fan_in]:
+                os.remove(path)
+            merged_paths.append(merged_path)
+        paths = merged_paths
+    return heapq.merge(*(read_run(path) for path in paths))
+
+def peak_rss():
+    """ Peak resident set size of this process, in bytes. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class NgramCounter:
+    """
+        Count ngrams up to max_n words long across documents, holding at most about `max_entries` distinct grams in
+        memory (settings.NGRAM_COUNTER_MAX_ENTRIES by default).
+
+        Words are interned as integer ids, and each gram is counted under a single int that packs its word ids into
+        `id_bits`-bit fields, which takes much less memory than counting gram strings. When max_entries is reached,
+        counts are spilled to sorted run files in run_dir and cleared from memory, along with the word ids.
+        observations() merges the spilled runs back together.
+    """
+    id_bits = 32
+
+    def __init__(self, max_n, run_dir, max_entries=None):
+        self.max_n = max_n
+        self.run_dir = run_dir
+        self.max_entries = max_entries or settings.NGRAM_COUNTER_MAX_ENTRIES
+        self.totals = {n: [0, 0] for n in range(1, max_n + 1)}  # [total tokens, total documents]
+        self.run_paths = {n: [] for n in range(1, max_n + 1)}
+        self.spill_count = 0
+        self.reset()
+
+    def reset(self):
+        self.word_ids = {}
+        self.instances = {n: Counter() for n in range(1, self.max_n + 1)}
+        self.documents = {n: Counter() for n in range(1, self.max_n + 1)}
+
+    def entry_count(self):
+        return sum(len(counter) for counter in self.instances.values())
+
+    def add(self, tokens):
+        """ Count the grams in a single document, spilling to disk if we're over max_entries. """
+        word_ids = self.word_ids
+        keys = ids = [word_ids.setdefault(token, len(word_ids)) for token in tokens]
+        for n in range(1, self.max_n + 1):
+            if n > 1:
+                # extend each (n-1)-gram key with the id of the following word
+                keys = [(key << self.id_bits) | i for key, i in zip(keys, ids[n-1:])]
+            self.totals[n][0] += len(keys)
+            self.totals[n][1] += 1
+            self.instances[n].update(keys)
+            self.documents[n].update(set(keys))
+        if self.entry_count() >= self.max_entries:
+            self.spill()
+
+    def sorted_counts(self, n, words):
+        """
+            Return in-memory counts for grams of length n, sorted by key, in the form:
+               [
+                 (b'<n><gram>', <instance count>, <document count>), ...
+               ]
+            `words` is the list of words indexed by id.
+        """
+        key_prefix = bytes([n])
+        shifts = [self.id_bits * i for i in reversed(range(n))]
+        mask = (1 << self.id_bits) - 1
+        documents = self.documents[n]
+        return sorted(
+            (key_prefix + ' '.join(words[(key >> shift) & mask] for shift in shifts).encode('utf8'), instance_count, documents[key])
+            for key, instance_count in self.instances[n].items())
+
+    def words(self):
+        words = [None] * len(self.word_ids)
+        for word, i in self.word_ids.items():
+            words[i] = word
+        return words
+
+    def spill(self):
+        """ Write current counts to a sorted run file for each n, and clear them from memory. """
+        words = self.words()
+        for n in range(1, self.max_n + 1):
+            path = temp_run_path(self.run_dir)
+            write_run(path, self.sorted_counts(n, words))
+            self.run_paths[n].append(path)
+            # free each n's counts as we go, so we never hold two copies of everything
+            self.instances[n] = self.documents[n] = None
+        self.spill_count += 1
+        self.reset()
+
+    def observations(self, n):
+        """
+            Return an iterator of all grams of length n and their counts, sorted by key, in the form:
+               (b'<n><gram>', <instance count>, <document count>)
+            Call this after all documents have been added.
+        """
+        if not self.spill_count:
+            return iter(self.sorted_counts(n, self.words()))
+        if self.entry_count():
+            self.spill()
+        return sum_counts(merge_runs(self.run_paths[n], self.run_dir))
+
+def sum_counts(records):
+    """ Combine counts for consecutive (<key>, <instance count>, <document count>) records with the same key. """
+    for k, group in itertools.groupby(records, key=itemgetter(0)):
+        instance_count = document_count = 0
+        for _, group_instance_count, group_document_count in group:
+            instance_count += group_instance_count
+            document_count += group_document_count
+        yield k, instance_count, document_count
+
+def observation_records(jurisdiction_id, year, counter, subtracted=None):
+    """
+        Yield (<key>, <jurisdiction_id>, <year - 1900>, <instance count>, <document count>) records for every gram in
+        counter, in key order -- the format of the run files read by rocksdb_write_thread() and bulk_load_runs().
+        If subtracted is another NgramCounter, yield the differences between the two instead, skipping grams whose
+        counts didn't change.
+    """
+    storage_year = year - 1900
+    # n is the first byte of each key, so records for increasing n stay sorted by key
+    for n in range(1, counter.max_n + 1):
+        observations = counter.observations(n)
+        if subtracted:
+            negated = ((k, -instance_count, -document_count) for k, instance_count, document_count in subtracted.observations(n))
+            observations = (o for o in sum_counts(heapq.merge(observations, negated)) if o[1] or o[2])
+        for k, instance_count, document_count in observations:
+            yield k, jurisdiction_id, storage_year, instance_count, document_count
+
+def case_queryset(jurisdiction_slug, year):
+    """ Return the CaseBodyCache objects to count for the given jurisdiction-year. """
+    return CaseBodyCache.objects.filter(
+        metadata__duplicative=False, metadata__jurisdiction__isnull=False, metadata__court__isnull=False,
+        metadata__decision_date__year=year, metadata__jurisdiction_slug=jurisdiction_slug
+    ).order_by('metadata_id')
+
+def count_cases(counter, queryset, desc, pos, tokenizer_backend=None):
+    """
+        Add the tokens of each case in queryset to counter. Yields a (<case_id>, <text md5>, <space-separated tokens>)
+        record for each case, to be stored by record_cases().
+    """
+    progress = tqdm(ordered_query_iterator(queryset.only('metadata_id', 'text')), desc=desc, position=pos, mininterval=.5)
+    for case_text in progress:
+        tokens = list(tokenize(case_text.text, tokenizer_backend))
+        counter.add(tokens)
+        progress.set_postfix(spills=counter.spill_count, peak_rss="%dMB" % (peak_rss() // 2**20), refresh=False)
+        yield case_text.metadata_id, hashlib.md5(case_text.text.encode('utf8')).hexdigest(), ' '.join(tokens)
+
+def record_cases(records, jurisdiction_id, year, batch=None):
+    """
+        Store the records yielded by count_cases() -- see NgramRocksDB.case_key(). Records are only needed for
+        incremental updates, and hold a copy of every case's tokens, so are skipped unless
+        settings.NGRAM_INCREMENTAL_UPDATES is set.
+    """
+    if not settings.NGRAM_INCREMENTAL_UPDATES:
+        return
+    for case_id, digest, tokens in records:
+        ngram_kv_store.put(NgramRocksDB.case_key(NgramRocksDB.digest_key_prefix, jurisdiction_id, year, case_id), digest.encode('ascii'), batch=batch)
+        ngram_kv_store.put(NgramRocksDB.case_key(NgramRocksDB.tokens_key_prefix, jurisdiction_id, year, case_id), tokens.encode('utf8'), batch=batch)
 
-def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id, jurisdiction_slug, year, max_n):
+# A jurisdiction-year's worth of work for rocksdb_write_thread(). merges_path is a run file of observation_records(),
+# cases_path a run file of count_cases() records, and totals is {<n>: [<gram count>, <document count>]} to add to
+# the totals keys. If incremental is False, the job is skipped if the jurisdiction-year already has totals.
+NgramWriteJob = namedtuple('NgramWriteJob', 'jurisdiction_id year totals merges_path cases_path removed_case_ids incremental')
+
+def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id, jurisdiction_slug, year, max_n, tokenizer_backend=None):
     """
         Worker process to generate all ngrams for the given jurisdiction-year and add them to the queue.
     """
@@ -124,54 +438,180 @@ def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id
         return
 
     # tqdm setup -- add an offset based on current process index, plus space for rocksdb worker
-    desc = "%s-%s" % (jurisdiction_slug, year)
-    with ngram_worker_lock:
-        line_offset = next((i for i in range(settings.NGRAM_THREAD_COUNT) if i not in ngram_worker_offsets), None)
-        if line_offset is None:
-            line_offset = random.shuffle(ngram_worker_offsets.keys())[0]
-        ngram_worker_offsets[line_offset] = True
+    line_offset = claim_line_offset(ngram_worker_offsets, ngram_worker_lock)
     pos = 2 + settings.NGRAM_THREAD_COUNT + line_offset
 
-    # count words for each case
-    counters = {n: {'total_tokens':0, 'total_documents':0, 'instances': Counter(), 'documents': Counter()} for n in range(1, max_n + 1)}
-    queryset = CaseBodyCache.objects.filter(
-        metadata__duplicative=False, metadata__jurisdiction__isnull=False, metadata__court__isnull=False,
-        metadata__decision_date__year=year, metadata__jurisdiction_slug=jurisdiction_slug
-    ).only('text').order_by('id')
-    for case_text in tqdm(ordered_query_iterator(queryset), desc="Ngram %s" % desc, position=pos, mininterval=.5):
-        tokens = list(tokenize(case_text.text))
-        for n in range(1, max_n + 1):
-            grams = list(' '.join(gram) for gram in ngrams(tokens, n))
-            counters[n]['total_tokens'] = counters[n].setdefault('total_tokens', 0) + len(grams)
-            counters[n]['total_documents'] = counters[n].setdefault('total_documents', 0) + 1
-            counters[n]['instances'].update(grams)
-            counters[n]['documents'].update(set(grams))
-
-    # enqueue data for rocksdb
-    storage_year = year - 1900
-    for n, counts in counters.items():
-
-        # skip storing jurisdiction-year combinations that already have ngrams
-        totals_key = get_totals_key(jurisdiction_id, year, n)
-        if ngram_kv_store_ro.get(totals_key):
-            print(" - Length %s already in totals" % n)
-            continue
-
-        # set up values for use by rocksdb_write_thread()
-        totals = (totals_key, [counts['total_tokens'], counts['total_documents']])
-        merge_value_prefix = (jurisdiction_id, storage_year)
-
-        # prepare list of all ngram observations to be merged into rocksdb, in the form:
-        #   merges = [
-        #     (b'<n><gram>': (<instance count>, <document count>)), ...
-        #   ]
-        key_prefix = bytes([int(n)])
-        count_pairs = zip(sorted(counts['instances'].items()), sorted(counts['documents'].items()))
-        merges = [(key_prefix+gram.encode('utf8'), (instance_count, document_count)) for (gram, instance_count), (_, document_count) in count_pairs]
-        queue.put((totals, merge_value_prefix, merges))
+    run_dir = tempfile.mkdtemp(dir=settings.NGRAM_RUN_DIR)
+    try:
+        # count words for each case, keeping a record of each case counted
+        counter = NgramCounter(max_n, run_dir)
+        cases_path = temp_run_path()
+        write_run(cases_path, count_cases(counter, case_queryset(jurisdiction_slug, year), "Ngram %s-%s" % (jurisdiction_slug, year), pos, tokenizer_backend))
+
+        # enqueue data for rocksdb_write_thread(). Observations are passed as a run file rather than a list, so we don't
+        # have to hold them all in memory or pickle them through the queue.
+        merges_path = temp_run_path()
+        write_run(merges_path, observation_records(jurisdiction_id, year, counter))
+        queue.put(NgramWriteJob(jurisdiction_id, year, counter.totals, merges_path, cases_path, [], False))
+    finally:
+        shutil.rmtree(run_dir)
+
+    del ngram_worker_offsets[line_offset]
+
+def ngram_update_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id, jurisdiction_slug, year, max_n, tokenizer_backend=None):
+    """
+        Worker process for ngram_jurisdictions(incremental=True). Compares an md5 of each case's current text to the
+        one recorded when the jurisdiction-year was last counted, and queues only the differences: counts for added
+        and edited cases, less the recorded tokens of removed cases and of the old versions of edited cases.
+    """
+    counted = {
+        NgramRocksDB.case_key_id(k): v.decode('ascii')
+        for k, v in ngram_kv_store_ro.get_prefix(NgramRocksDB.case_key(NgramRocksDB.digest_key_prefix, jurisdiction_id, year))}
+    totals = ngram_kv_store_ro.get(get_totals_key(jurisdiction_id, year, max_n), packed=True)
+    if totals and totals[1] and not counted:
+        print("%s-%s was counted without case records, so can't be updated. Rebuild the database to include it." % (jurisdiction_slug, year))
+        return
+
+    # digest in the database, so we only fetch the text of cases that changed
+    cases = case_queryset(jurisdiction_slug, year)
+    current = dict(cases.annotate(
+        digest=Func(Coalesce('text', Value('')), function='MD5', output_field=CharField())
+    ).values_list('metadata_id', 'digest'))
+    added_or_edited = [case_id for case_id, digest in current.items() if counted.get(case_id) != digest]
+    removed_or_edited = sorted(case_id for case_id, digest in counted.items() if current.get(case_id) != digest)
+    if not added_or_edited and not removed_or_edited:
+        return
+
+    # tqdm setup -- see ngram_worker()
+    line_offset = claim_line_offset(ngram_worker_offsets, ngram_worker_lock)
+    pos = 2 + settings.NGRAM_THREAD_COUNT + line_offset
+
+    run_dir = tempfile.mkdtemp(dir=settings.NGRAM_RUN_DIR)
+    try:
+        # count added and edited cases, keeping a record of each case counted
+        counter = NgramCounter(max_n, run_dir)
+        cases_path = temp_run_path()
+        changed_cases = cases.filter(metadata_id__in=added_or_edited) if counted else cases
+        write_run(cases_path, count_cases(counter, changed_cases, "Update %s-%s" % (jurisdiction_slug, year), pos, tokenizer_backend))
+
+        # count what was recorded for removed cases and the old versions of edited cases
+        subtracted = NgramCounter(max_n, run_dir)
+        for case_id in removed_or_edited:
+            tokens = ngram_kv_store_ro.get(NgramRocksDB.case_key(NgramRocksDB.tokens_key_prefix, jurisdiction_id, year, case_id))
+            subtracted.add(tokens.decode('utf8').split())
+
+        # enqueue the differences for rocksdb_write_thread()
+        merges_path = temp_run_path()
+        write_run(merges_path, observation_records(jurisdiction_id, year, counter, subtracted))
+        totals = {
+            n: [added - removed for added, removed in zip(counter.totals[n], subtracted.totals[n])]
+            for n in range(1, max_n + 1)}
+        removed_case_ids = sorted(set(counted) - set(current))
+        queue.put(NgramWriteJob(jurisdiction_id, year, totals, merges_path, cases_path, removed_case_ids, True))
+    finally:
+        shutil.rmtree(run_dir)
 
     del ngram_worker_offsets[line_offset]
 
+## bulk loading
+
+def ngram_run_worker(ngram_worker_offsets, ngram_worker_lock, run_dir, jurisdiction_id, jurisdiction_slug, year, max_n, tokenizer_backend=None):
+    """
+        Worker process for ngram_jurisdictions(bulk=True). Writes all ngrams for the given jurisdiction-year to a
+        sorted run file in run_dir, and a record of the cases counted to a second file. Returns
+        ([(<totals key>, <totals value>), ...], (<jurisdiction_id>, <year>, <cases path>)).
+    """
+    line_offset = claim_line_offset(ngram_worker_offsets, ngram_worker_lock)
+    spill_dir = tempfile.mkdtemp(dir=settings.NGRAM_RUN_DIR)
+    try:
+        counter = NgramCounter(max_n, spill_dir)
+        cases_path = os.path.join(run_dir, "%s-%s.cases" % (jurisdiction_id, year))
+        write_run(cases_path, count_cases(counter, case_queryset(jurisdiction_slug, year), "Ngram %s-%s" % (jurisdiction_slug, year), 2 + line_offset, tokenizer_backend))
+        write_run(os.path.join(run_dir, "%s-%s.run" % (jurisdiction_id, year)), observation_records(jurisdiction_id, year, counter))
+    finally:
+        shutil.rmtree(spill_dir)
+
+    del ngram_worker_offsets[line_offset]
+    totals = [(get_totals_key(jurisdiction_id, year, n), counter.totals[n]) for n in range(1, max_n + 1)]
+    return totals, (jurisdiction_id, year, cases_path)
+
+def bulk_load_runs(run_dir, totals, case_runs=(), batch_size=100000):
+    """
+        Merge the sorted runs written by ngram_run_worker(), combine the observations for each gram into a single
+        value, and load the results into a new database without using the merge operator.
+
+        This is a sorted WriteBatch loader: values are written in key order in batches of batch_size, which produces
+        non-overlapping files and so leaves little for compaction to do. It isn't faster overall than the merge writer
+        (see benchmark_bulk_load()); what it saves is the merge operator work at read and compaction time.
+
+        ngram_jurisdictions() compacts the database afterward with NgramRocksDB.compact().
+
+        case_runs is a list of (<jurisdiction_id>, <year>, <path>) for the case records written by ngram_run_worker().
+    """
+    paths = [os.path.join(run_dir, name) for name in os.listdir(run_dir) if name.endswith('.run')]
+    records = merge_runs(paths, run_dir)
+    values = (
+        (k, NgramValue.encode(record[1:] for record in group))
+        for k, group in itertools.groupby(records, key=itemgetter(0)))
+
+    batch = rocksdb.WriteBatch()
+    for k, value in tqdm(values, desc="Grams written", mininterval=.5):
+        ngram_kv_store.put(k, value, batch=batch)
+        ngram_kv_store.put(NgramRocksDB.count_key(k), NgramValue.totals(value)[0], packed=True, batch=batch)
+        if batch.count() >= batch_size:
+            ngram_kv_store.db.write(batch)
+            batch = rocksdb.WriteBatch()
+    ngram_kv_store.db.write(batch)
+
+    # write totals and case records
+    with ngram_kv_store.in_transaction():
+        for k, v in totals:
+            ngram_kv_store.put(k, v, packed=True)
+    for jurisdiction_id, year, cases_path in tqdm(case_runs, desc="Jurisdiction-year cases recorded", mininterval=.5):
+        batch = rocksdb.WriteBatch()
+        record_cases(read_run(cases_path), jurisdiction_id, year, batch=batch)
+        ngram_kv_store.db.write(batch)
+
+    shutil.rmtree(run_dir)
+
+def write_gram_counts(batch_size=100000):
+    """
+        Populate the b'count<n><gram>' keys for a database written before they were maintained by
+        rocksdb_write_thread(). Safe to re-run, as existing count keys are overwritten.
+    """
+    batch = rocksdb.WriteBatch()
+    for n in range(1, 4):
+        for k, v in tqdm(ngram_kv_store.get_prefix(bytes([n])), desc="Length %s counts written" % n, mininterval=.5):
+            ngram_kv_store.put(NgramRocksDB.count_key(k), NgramValue.totals(v)[0], packed=True, batch=batch)
+            if batch.count() >= batch_size:
+                ngram_kv_store.db.write(batch)
+                batch = rocksdb.WriteBatch()
+    ngram_kv_store.db.write(batch)
+    ngram_kv_store.bump_generation()
+
+def migrate_values(batch_size=100000):
+    """
+        Rewrite b'<n><gram>' values stored in the legacy msgpack format in the current NgramValue format.
+
+        Readers and the merge operator accept either format, so the API can keep reading the database while this
+        runs, but nothing else may write to it: each value is read and then put back, so a merge written in between
+        would be lost. Don't run this alongside ngram_jurisdictions().
+    """
+    batch = rocksdb.WriteBatch()
+    migrated = 0
+    for n in range(1, 4):
+        for k, v in tqdm(ngram_kv_store.get_prefix(bytes([n])), desc="Length %s values checked" % n, mininterval=.5):
+            if NgramValue.is_legacy(v):
+                ngram_kv_store.put(k, NgramValue.upgrade(v), batch=batch)
+                migrated += 1
+            if batch.count() >= batch_size:
+                ngram_kv_store.db.write(batch)
+                batch = rocksdb.WriteBatch()
+    ngram_kv_store.db.write(batch)
+    ngram_kv_store.compact()  # see ngram_jurisdictions()
+    ngram_kv_store.bump_generation()
+    print("Migrated %s values." % migrated)
+
 def rocksdb_writer(queue, rocksdb_loaded):
     """
         Worker process to pull ngrams off of the queue and add them to a second internal queue for writing to rocksdb.
@@ -216,25 +656,38 @@ def rocksdb_write_thread(queue):
             item = queue.get()
             if item is None:
                 break
-            totals, merge_value_prefix, merges = item
-
-            # skip storing jurisdiction-year combinations that already have ngrams
-            if ngram_kv_store.get(totals[0]):
-                continue
-
-            # write in a batch so writes succeed or fail as a group
-            batch = rocksdb.WriteBatch()
-
-            # write each ngram, in the form (b'<n><gram>', pack(<jurisdiction_id>, <year>, <instance_count>, <document_count>))
-            # see ngram_kv_store.NgramMergeOperator for how this value is merged into the existing b'<n><gram>' key
-            for k, v in tqdm(merges, desc="Current write job", mininterval=.5):
-                ngram_kv_store.merge(k, merge_value_prefix+v, packed=True, batch=batch)
-
-            # write totals value
-            ngram_kv_store.put(totals[0], totals[1], packed=True, batch=batch)
-
-            # write batch
-            ngram_kv_store.db.write(batch)
+            job = item
+
+            try:
+                # skip storing jurisdiction-year combinations that already have ngrams, unless we're updating them
+                if not job.incremental and ngram_kv_store.get(get_totals_key(job.jurisdiction_id, job.year, max(job.totals))):
+                    continue
+
+                # write in a batch so writes succeed or fail as a group
+                batch = rocksdb.WriteBatch()
+
+                # write each ngram, in the form (b'<n><gram>', NgramValue.record.pack(<jurisdiction_id>, <year>, <instance_count>, <document_count>))
+                # see ngram_kv_store.NgramMergeOperator for how this value is merged into the existing b'<n><gram>' key
+                # also add the instance count to the gram's b'count<n><gram>' key, used to rank wildcard searches
+                for k, jurisdiction_id, storage_year, instance_count, document_count in tqdm(read_run(job.merges_path), desc="Current write job", mininterval=.5):
+                    ngram_kv_store.merge(k, NgramValue.record.pack(jurisdiction_id, storage_year, instance_count, document_count), batch=batch)
+                    ngram_kv_store.merge(NgramRocksDB.count_key(k), instance_count, packed=True, batch=batch)
+
+                # add to totals values
+                for n, totals in job.totals.items():
+                    ngram_kv_store.merge(get_totals_key(job.jurisdiction_id, job.year, n), totals, packed=True, batch=batch)
+
+                # record the cases counted, and forget removed ones
+                record_cases(read_run(job.cases_path), job.jurisdiction_id, job.year, batch=batch)
+                for case_id in job.removed_case_ids:
+                    for key_prefix in (NgramRocksDB.digest_key_prefix, NgramRocksDB.tokens_key_prefix):
+                        ngram_kv_store.delete(NgramRocksDB.case_key(key_prefix, job.jurisdiction_id, job.year, case_id), batch=batch)
+
+                # write batch
+                ngram_kv_store.db.write(batch)
+            finally:
+                os.remove(job.merges_path)
+                os.remove(job.cases_path)
         finally:
             # let internal_queue.join() know not to wait for this job to complete
             queue.task_done()
@@ -0,0 +1,63 @@
+"""
+    Benchmarks for case rendering, run against volumes in the configured database.
+    These are run by the `fab render_benchmark_*` tasks.
+"""
+import statistics
+import timeit
+
+from django.db.models import Count
+
+from capdb.models import VolumeMetadata, PageStructure, CaseFont
+from scripts.render_case import VolumeRenderer
+
+
+def time_call(func, repeat):
+    """ Return median seconds for a single call to func. """
+    return statistics.median(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def largest_volumes(volume_count):
+    return VolumeMetadata.objects.annotate(case_count=Count('case_metadatas')).order_by('-case_count')[:volume_count]
+
+
+def volume_renderer(volume):
+    pages = list(volume.page_structures.all())
+    blocks_by_id = PageStructure.blocks_by_id(pages)
+    return VolumeRenderer(blocks_by_id, CaseFont.fonts_by_id(blocks_by_id), PageStructure.labels_by_block_id(pages))
+
+
+## json and text
+
+def benchmark_json_and_text(volume_count=3, repeat=3):
+    """
+        Compare json and text extraction by re-parsing rendered HTML with CaseMetadata.get_json_from_html(), and from
+        the unserialized HTML tree with VolumeRenderer.json_and_text_from_html_el(), on the volumes with the most cases.
+        Also compares the full rerender, as sync_case_body_cache() did it before and does it now. Checks that json and
+        text agree for every case.
+    """
+    print("median of %s runs:" % repeat)
+    for volume in largest_volumes(volume_count):
+        renderer = volume_renderer(volume)
+        cases = [case for case in volume.case_metadatas.select_related('structure') if hasattr(case, 'structure')]
+        html_els = [renderer.render_markup(case, ('html',))[0] for case in cases]
+        htmls = [renderer.finish_html(renderer.serialize(html_el)) for html_el in html_els]
+        for case, html_el, html in zip(cases, html_els, htmls):
+            assert case.get_json_from_html(html) == renderer.json_and_text_from_html_el(html_el), \
+                "json and text differ for %s" % case.case_id
+
+        def separate_passes():
+            for case in cases:
+                html = renderer.render_html(case)
+                renderer.render_xml(case)
+                case.get_json_from_html(html)
+
+        print(" - %s: %s cases, %s characters of html" % (volume.barcode, len(cases), sum(len(html) for html in htmls)))
+        print("   - json and text: from html %.3fs, from tree %.3fs, from structure %.3fs" % (
+            time_call(lambda: [case.get_json_from_html(html) for case, html in zip(cases, htmls)], repeat),
+            time_call(lambda: [renderer.json_and_text_from_html_el(html_el) for html_el in html_els], repeat),
+            time_call(lambda: [renderer.render_json_and_text(case) for case in cases], repeat),
+        ))
+        print("   - rerender: separate passes %.3fs, render_all %.3fs" % (
+            time_call(separate_passes, repeat),
+            time_call(lambda: [renderer.render_all(case) for case in cases], repeat),
+        ))
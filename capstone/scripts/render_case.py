@@ -1,9 +1,17 @@
+import hashlib
+import json
+import re
 from contextlib import contextmanager
 from copy import deepcopy
 
 from lxml import etree, sax
 
 
+# increment when changes to rendering should cause every CaseBodyCache to be regenerated -- see
+# VolumeRenderer.input_digest()
+RENDER_VERSION = 1
+
+
 ### HELPERS ###
 from pyquery import PyQuery
 
@@ -76,6 +84,78 @@ def remove_empty_tags(tree, ignore_tags=set()):
             el = parent
 
 
+# the following match pyquery's .text(), so text and json extracted from an HTML tree built by VolumeRenderer are the
+# same as CaseMetadata.get_json_from_html() gets from the serialized HTML
+inline_tags = {
+    'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'br', 'button', 'cite', 'code', 'dfn', 'em', 'i', 'img', 'input', 'kbd',
+    'label', 'map', 'object', 'q', 'samp', 'script', 'select', 'small', 'span', 'strong', 'sub', 'sup', 'textarea', 'time',
+    'tt', 'var'
+}
+html_whitespace_re = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+
+# page numbers and references are left out of text and json
+text_skipped_classes = {'page-label', 'footnotemark', 'bracketnum'}
+
+def is_text_skipped(el):
+    return bool(text_skipped_classes.intersection((el.get('class') or '').split()))
+
+def extract_text_parts(el, parts, pretty_print=True):
+    """
+        Append the text of an lxml element to parts, as pyquery would see it after the element was serialized with
+        etree.tostring(pretty_print=pretty_print), stripped of soft hyphens, and parsed again. None marks the start and
+        end of block elements. Example:
+            >>> parts = []
+            >>> extract_text_parts(etree.XML('<p><em>a</em><a class="page-label">*1</a><em>b</em></p>'), parts)
+            >>> parts
+            [None, '\\n', 'a', '\\n', '\\n', 'b', '\\n', None]
+    """
+    if is_text_skipped(el):
+        return
+    is_block = el.tag not in inline_tags
+    if is_block:
+        parts.append(None)
+    # pretty_print indents the children of elements that have no text of their own, and nothing inside an element that
+    # does have text
+    if pretty_print and el.text is None and all(child.tail is None for child in el):
+        for child in el:
+            parts.append('\n')
+            extract_text_parts(child, parts, True)
+        if len(el):
+            parts.append('\n')
+    else:
+        if el.text is not None:
+            parts.append(el.text.replace('\xad', ''))
+        for child in el:
+            extract_text_parts(child, parts, False)
+            if child.tail is not None:
+                # get_json_from_html() drops skipped elements with pyquery's .remove(), which puts a space before the tail
+                if child.tail and is_text_skipped(child):
+                    parts.append(' ')
+                parts.append(child.tail.replace('\xad', ''))
+    if is_block:
+        parts.append(None)
+
+def text_from_parts(parts):
+    """
+        Join parts from extract_text_parts() the way pyquery's .text() does: squash whitespace within each run of text,
+        and put a newline between non-empty runs. Example:
+            >>> text_from_parts([None, 'a ', ' b', None, '\\n', None, 'c', None])
+            'a b\\nc'
+    """
+    runs = []
+    run = []
+    for part in parts + [None]:
+        if part is None:
+            if run:
+                text = html_whitespace_re.sub(' ', ''.join(run)).strip()
+                if text:
+                    runs.append(text)
+                run = []
+        else:
+            run.append(part)
+    return '\n'.join(runs)
+
+
 class VolumeRenderer:
     """
         Class to render:
@@ -269,25 +349,126 @@ class VolumeRenderer:
         """
             Render <casebody> as HTML
         """
-        self.format = 'html'
-        return self.render_markup(case).replace('\xad', '')
+        return self.finish_html(self.serialize(self.render_markup(case, ('html',))[0]))
 
     def render_xml(self, case):
         """
             Render <casebody> as XML, with <em> and <page-number>
         """
-        self.format = 'xml'
         self.original_xml = False
-
-        return "<?xml version='1.0' encoding='utf-8'?>\n{}".format(self.render_markup(case).replace('\xad', ''))
+        return self.finish_xml(self.serialize(self.render_markup(case, ('xml',))[0]))
 
     def render_orig_xml(self, case):
         """
             Render <casebody> as XML, matching original format from Innodata
         """
-        self.format = 'xml'
         self.original_xml = True
-        return "<?xml version='1.0' encoding='utf-8'?>\n{}".format(self.render_markup(case))
+        return "<?xml version='1.0' encoding='utf-8'?>\n{}".format(self.serialize(self.render_markup(case, ('xml',))[0]))
+
+    def render_json_and_text(self, case):
+        """
+            Render (json, text) for CaseBodyCache, without serializing any markup
+        """
+        self.original_xml = False
+        return self.json_and_text_from_html_el(self.render_markup(case, ('html',))[0])
+
+    def render_all(self, case):
+        """
+            Render everything stored in CaseBodyCache -- HTML, XML, json and text -- in a single pass over the case's
+            tokens. Returns a dict of the same values render_html(), render_xml() and render_json_and_text() return.
+        """
+        self.original_xml = False
+        html_el, xml_el = self.render_markup(case, ('html', 'xml'))
+        json, text = self.json_and_text_from_html_el(html_el)
+        return {
+            'html': self.finish_html(self.serialize(html_el)),
+            'xml': self.finish_xml(self.serialize(xml_el)),
+            'json': json,
+            'text': text,
+        }
+
+    def serialize(self, el):
+        return etree.tostring(el, encoding=str, pretty_print=self.pretty_print)
+
+    @staticmethod
+    def finish_html(html):
+        return html.replace('\xad', '')
+
+    @staticmethod
+    def finish_xml(xml):
+        return "<?xml version='1.0' encoding='utf-8'?>\n{}".format(xml.replace('\xad', ''))
+
+    def json_and_text_from_html_el(self, casebody_el):
+        """
+            Extract (json, text) from a <section class='casebody'> element built by render_markup(). This returns the
+            same values as CaseMetadata.get_json_from_html() does for the serialized HTML.
+        """
+        els_by_class = {'head-matter': [], 'judges': [], 'attorneys': [], 'parties': [], 'corrections': []}
+        opinions = []
+
+        # collect elements in document order, along with whether pretty_print will indent their contents
+        def collect(el, indented, opinion):
+            classes = (el.get('class') or '').split()
+            if text_skipped_classes.intersection(classes):
+                return
+            if 'opinion' in classes:
+                opinion = {'el': (el, indented), 'authors': []}
+                opinions.append(opinion)
+            if 'author' in classes and opinion:
+                opinion['authors'].append((el, indented))
+            for class_name in classes:
+                if class_name in els_by_class:
+                    els_by_class[class_name].append((el, indented))
+            indented = indented and el.text is None and all(child.tail is None for child in el)
+            for child in el:
+                collect(child, indented, opinion)
+        collect(casebody_el, self.pretty_print, None)
+
+        def get_text(els):
+            texts = []
+            for el, indented in els:
+                parts = []
+                extract_text_parts(el, parts, indented)
+                texts.append(text_from_parts(parts))
+            return ' '.join(texts)
+
+        json = {
+            'head_matter': get_text(els_by_class['head-matter']),
+            'judges': [get_text([el]) for el in els_by_class['judges']],
+            'attorneys': [get_text([el]) for el in els_by_class['attorneys']],
+            'parties': [get_text([el]) for el in els_by_class['parties']],
+            'opinions': [{
+                'type': opinion['el'][0].get('data-type'),
+                'author': get_text(opinion['authors']) or None,
+                'text': get_text([opinion['el']]),
+            } for opinion in opinions],
+            'corrections': get_text(els_by_class['corrections']),
+        }
+        text = "\n".join([json['head_matter']] + [o['text'] for o in json['opinions']] + [json['corrections']])
+        return json, text
+
+    def input_digest(self, case):
+        """
+            Return a hash of everything render_all() output depends on for this case, including RENDER_VERSION. If the
+            digest hasn't changed since the case was last rendered, neither has the output.
+        """
+        opinions = case.structure.opinions
+        block_ids = [block_id for par in iter_pars(opinions) for block_id in par['block_ids']]
+        blocks = [self.blocks_by_id[block_id] for block_id in block_ids]
+        font_ids = {token[1]['id'] for block in blocks for token in block.get('tokens', []) if type(token) != str and token[0] == 'font'}
+        replaced_by = case.replaced_by if case.withdrawn else None
+        inputs = [
+            RENDER_VERSION,
+            self.redacted,
+            self.pretty_print,
+            [case.case_id, case.first_page, case.last_page, case.duplicative, case.withdrawn],
+            [replaced_by.frontend_url, replaced_by.full_cite()] if replaced_by else None,
+            opinions,
+            blocks,
+            [self.labels_by_block_id[block_id] for block_id in block_ids],
+            sorted((font_id, self.fonts_by_id[font_id].style) for font_id in font_ids),
+        ]
+        return hashlib.md5(json.dumps(inputs, sort_keys=True).encode('utf8')).hexdigest()
 
     def hydrate_opinions(self, opinions, blocks_by_id):
         """
@@ -298,56 +479,61 @@ class VolumeRenderer:
             par['blocks'] = [blocks_by_id[id] for id in par['block_ids']]
         return opinions
 
-    def render_markup(self, case):
+    def render_markup(self, case, formats):
         """
-            Core renderer.
+            Core renderer. Builds a tree for each of `formats` ('html' or 'xml') while walking the case once, and
+            returns a list of the root elements in the same order.
         """
         case_structure = case.structure
         self.opinions = case_structure.opinions
         self.duplicative = case.duplicative
 
         # <section class='case'>, or <casebody>
-        case_el = self.make_case_el(case)
+        case_els = {format: self.make_case_el(case, format) for format in formats}
 
         # handle withdrawn cases
         if case.withdrawn:
             if case.replaced_by:
-                PyQuery(case_el).html('<p>This case was withdrawn and replaced by <a href="%s">%s</a>.</p>' % (case.replaced_by.frontend_url, case.replaced_by.full_cite()))
+                withdrawn_html = '<p>This case was withdrawn and replaced by <a href="%s">%s</a>.</p>' % (case.replaced_by.frontend_url, case.replaced_by.full_cite())
             else:
-                PyQuery(case_el).html('<p>This case was withdrawn by the court.</p>')
+                withdrawn_html = '<p>This case was withdrawn by the court.</p>'
+            for case_el in case_els.values():
+                PyQuery(case_el).html(withdrawn_html)
 
         else:
             last_page_label = None
             for opinion in self.opinions:
 
                 # <section class='opinion'>, or <opinion>
-                opinion_el = self.make_opinion_el(opinion)
+                opinion_els = {format: self.make_opinion_el(opinion, format) for format in formats}
 
                 # main paragraphs of opinion
                 if opinion.get('paragraphs'):
-                    last_page_label = self.make_pars(opinion['paragraphs'], opinion_el, last_page_label=last_page_label, include_block_label=opinion['type']=='unprocessed')
+                    last_page_label = self.make_pars(opinion['paragraphs'], opinion_els, last_page_label=last_page_label, include_block_label=opinion['type']=='unprocessed')
 
                 # <aside class='footnote'>, or <footnote>
                 for footnote in opinion.get('footnotes', []):
-                    footnote_el = self.make_footnote_el(footnote)
-                    if footnote_el is None:
+                    footnote_els = {format: self.make_footnote_el(footnote, format) for format in formats}
+                    if None in footnote_els.values():  # redacted footnotes are skipped in every format
                         continue
                     left_strip_text = None if self.original_xml else footnote.get('label', None)  # used for stripping footnote labels from text
-                    self.make_pars(footnote['paragraphs'], footnote_el, left_strip_text=left_strip_text)
-                    opinion_el.append(footnote_el)
+                    self.make_pars(footnote['paragraphs'], footnote_els, left_strip_text=left_strip_text)
+                    for format, footnote_el in footnote_els.items():
+                        opinion_els[format].append(footnote_el)
 
                 # special handling -- for xml, head matter goes directly under <case>
-                if self.format == 'xml' and opinion['type'] in ('head', 'unprocessed', 'corrections'):
-                    for el in opinion_el:
-                        case_el.append(el)
-                else:
-                    case_el.append(opinion_el)
+                for format, opinion_el in opinion_els.items():
+                    if format == 'xml' and opinion['type'] in ('head', 'unprocessed', 'corrections'):
+                        for el in opinion_el:
+                            case_els[format].append(el)
+                    else:
+                        case_els[format].append(opinion_el)
 
-        return etree.tostring(case_el, encoding=str, pretty_print=self.pretty_print)
+        return [case_els[format] for format in formats]
 
-    def make_case_el(self, case):
+    def make_case_el(self, case, format):
         """ Make <section class='case'>, or <casebody> """
-        if self.format == 'xml':
+        if format == 'xml':
             return etree.Element('casebody', {
                 'firstpage': case.first_page or '',
                 'lastpage': case.last_page or '',
@@ -361,9 +547,9 @@ class VolumeRenderer:
                 'data-lastpage': case.last_page or '',
             })
 
-    def make_opinion_el(self, opinion):
+    def make_opinion_el(self, opinion, format):
         """ Make <section class='opinion'>, or <opinion> """
-        if self.format == 'xml':
+        if format == 'xml':
             return etree.Element('opinion', {'type': opinion['type']})
         else:
             if opinion['type'] == 'head':
@@ -373,9 +559,9 @@ class VolumeRenderer:
             else:
                 return etree.Element('article', {'class': 'opinion', 'data-type': opinion['type']})
 
-    def make_footnote_el(self, footnote):
+    def make_footnote_el(self, footnote, format):
         """ Make <aside class='footnote'>, or <footnote> """
-        if self.format == 'xml':
+        if format == 'xml':
             footnote_attrs = {k: footnote[k] for k in ('label', 'orphan') if k in footnote}
             if footnote.get('redacted'):
                 if self.redacted:
@@ -393,34 +579,39 @@ class VolumeRenderer:
                 etree.SubElement(footnote_el, 'a', {'href': '#ref_'+footnote['id']}).text = footnote['label']
             return footnote_el
 
-    def make_pars(self, pars, parent_el, left_strip_text=None, last_page_label=None, include_block_label=False):
-        """ Make each <p class='label'> or <label> element. """
+    def make_pars(self, pars, parent_els, left_strip_text=None, last_page_label=None, include_block_label=False):
+        """
+            Make each <p class='label'> or <label> element. parent_els maps each format being rendered to the element
+            its paragraphs are appended to. Tokens are filtered and interpreted once, and the resulting commands are
+            added to a separate tag stack for each format.
+        """
         for par in pars:
             if self.redacted and par.get('redacted'):
                 continue
-            handler = sax.ElementTreeContentHandler()
-            tag_stack = []
+            outputs = []  # (format, handler, tag_stack) for each format
             open_tags = set()
 
             # opening tag
-            if self.format == 'xml':
-                par_attrs = {'id': par['id']}
-
-                # special handling for duplicative files -- alto block label gets applied as casemets paragraph label attr
-                if include_block_label and par['block_ids']:
-                    first_block = self.blocks_by_id[par['block_ids'][0]]
-                    if 'class' in first_block and first_block['class'] != 'p':
-                        par_attrs['label'] = first_block['class']
-
-                tag_stack.append((handler.startElement, (par['class'], par_attrs,)))
-            else:
-                if par['class'] == 'p':
-                    tag = ('p', {'id': par['id']},)
-                elif par['class'] == 'blockquote':
-                    tag = ('blockquote', {'id': par['id']},)
+            for format in parent_els:
+                handler = sax.ElementTreeContentHandler()
+                if format == 'xml':
+                    par_attrs = {'id': par['id']}
+
+                    # special handling for duplicative files -- alto block label gets applied as casemets paragraph label attr
+                    if include_block_label and par['block_ids']:
+                        first_block = self.blocks_by_id[par['block_ids'][0]]
+                        if 'class' in first_block and first_block['class'] != 'p':
+                            par_attrs['label'] = first_block['class']
+
+                    tag = (par['class'], par_attrs,)
                 else:
-                    tag = (par_class_to_tag.get(par['class'], 'p'), {'class': par['class'], 'id': par['id']},)
-                tag_stack.append((handler.startElement, tag))
+                    if par['class'] == 'p':
+                        tag = ('p', {'id': par['id']},)
+                    elif par['class'] == 'blockquote':
+                        tag = ('blockquote', {'id': par['id']},)
+                    else:
+                        tag = (par_class_to_tag.get(par['class'], 'p'), {'class': par['class'], 'id': par['id']},)
+                outputs.append((format, handler, [(handler.startElement, tag)]))
 
             # write each block in the paragraph
             for block_id in par['block_ids']:
@@ -431,23 +622,25 @@ class VolumeRenderer:
                     page_label = self.labels_by_block_id[block_id]
                     if page_label != last_page_label:
                         if last_page_label is not None:
-                            if self.format == 'xml':
-                                tag_stack.append((handler.startElement, ('page-number', {'label': page_label, 'citation-index': '1'},)))
-                                tag_stack.append((handler.characters, ('*'+page_label,)))
-                                tag_stack.append((handler.endElement, ('page-number',)))
-                            else:
-                                tag_stack.append((handler.startElement, ('a', {'id':'p'+page_label, 'href':'#p'+page_label, 'data-label':page_label, 'data-citation-index':'1', 'class':'page-label'},)))
-                                tag_stack.append((handler.characters, ('*'+page_label,)))
-                                tag_stack.append((handler.endElement, ('a',)))
+                            for format, handler, tag_stack in outputs:
+                                if format == 'xml':
+                                    tag_stack.append((handler.startElement, ('page-number', {'label': page_label, 'citation-index': '1'},)))
+                                    tag_stack.append((handler.characters, ('*'+page_label,)))
+                                    tag_stack.append((handler.endElement, ('page-number',)))
+                                else:
+                                    tag_stack.append((handler.startElement, ('a', {'id':'p'+page_label, 'href':'#p'+page_label, 'data-label':page_label, 'data-citation-index':'1', 'class':'page-label'},)))
+                                    tag_stack.append((handler.characters, ('*'+page_label,)))
+                                    tag_stack.append((handler.endElement, ('a',)))
                         last_page_label = page_label
 
                 # write <img>
                 if block.get('format') == 'image' and not (self.redacted and block.get('redacted')):
-                    if self.format == 'xml':
-                        tag_stack.append((handler.characters, ('[[Image here]]',)))
-                    else:
-                        tag_stack.append((handler.startElement, ('img', {'src': 'data:'+block['data'], 'class': block['class'], 'width': str(round(block['rect'][2])), 'height': str(round(block['rect'][3]))},)))
-                        tag_stack.append((handler.endElement, ('img',)))
+                    for format, handler, tag_stack in outputs:
+                        if format == 'xml':
+                            tag_stack.append((handler.characters, ('[[Image here]]',)))
+                        else:
+                            tag_stack.append((handler.startElement, ('img', {'src': 'data:'+block['data'], 'class': block['class'], 'width': str(round(block['rect'][2])), 'height': str(round(block['rect'][3]))},)))
+                            tag_stack.append((handler.endElement, ('img',)))
 
                 # write tokens
                 else:
@@ -463,7 +656,8 @@ class VolumeRenderer:
                                         token = token[1:]
                                     else:
                                         left_strip_text = None
-                            tag_stack.append((handler.characters, (token,)))
+                            for format, handler, tag_stack in outputs:
+                                tag_stack.append((handler.characters, (token,)))
                             continue
 
                         token_name, token_attrs = (token + [{}])[:2]
@@ -474,48 +668,53 @@ class VolumeRenderer:
                                 continue
                             font_obj = self.fonts_by_id[token_attrs['id']]
                             open_font_tags = [tag for tag, font_string in self.font_style_map if font_string in font_obj.style]
-                            self.open_font_tags(handler, tag_stack, open_font_tags)
+                            for format, handler, tag_stack in outputs:
+                                self.open_font_tags(handler, tag_stack, open_font_tags)
                         elif token_name == '/font':
                             if self.original_xml:
                                 continue
-                            self.close_font_tags(handler, tag_stack, open_font_tags)
+                            for format, handler, tag_stack in outputs:
+                                self.close_font_tags(handler, tag_stack, open_font_tags)
                             open_font_tags = []
 
                         # handle footnotemark and bracketnum
                         elif token_name == 'footnotemark' or token_name == 'bracketnum':
-                            if self.original_xml:
-                                tag_stack.append((handler.startElement, (token_name,)))
-                            elif self.format == 'xml':
-                                with self.wrap_font_tags(handler, tag_stack, open_font_tags):
+                            for format, handler, tag_stack in outputs:
+                                if self.original_xml:
                                     tag_stack.append((handler.startElement, (token_name,)))
-                            else:
-                                attrs = {'class': token_name}
-                                ref = token_attrs.get('ref')
-                                if ref:
-                                    attrs['href'] = '#' + ref
-                                    attrs['id'] = 'ref_' + ref
-                                with self.wrap_font_tags(handler, tag_stack, open_font_tags):
-                                    tag_stack.append((handler.startElement, ('a', attrs,)))
+                                elif format == 'xml':
+                                    with self.wrap_font_tags(handler, tag_stack, open_font_tags):
+                                        tag_stack.append((handler.startElement, (token_name,)))
+                                else:
+                                    attrs = {'class': token_name}
+                                    ref = token_attrs.get('ref')
+                                    if ref:
+                                        attrs['href'] = '#' + ref
+                                        attrs['id'] = 'ref_' + ref
+                                    with self.wrap_font_tags(handler, tag_stack, open_font_tags):
+                                        tag_stack.append((handler.startElement, ('a', attrs,)))
                             open_tags.add(token_name)
                         elif token_name == '/footnotemark' or token_name == '/bracketnum':
                             # we could hit a close tag without an open tag, if the open tag was in a previous redacted block
                             tag_name = token_name[1:]
                             if tag_name in open_tags:
-                                with self.wrap_font_tags(handler, tag_stack, open_font_tags):
-                                    tag_stack.append((handler.endElement, (token_name[1:] if self.format == 'xml' else 'a',)))
+                                for format, handler, tag_stack in outputs:
+                                    with self.wrap_font_tags(handler, tag_stack, open_font_tags):
+                                        tag_stack.append((handler.endElement, (tag_name if format == 'xml' else 'a',)))
                                 open_tags.remove(tag_name)
 
-            # run all of our commands, like "handler.startElement(*args)", to actually build the xml tree
-            for method, args in tag_stack:
-                method(*args)
+            for format, handler, tag_stack in outputs:
+                # run all of our commands, like "handler.startElement(*args)", to actually build the xml tree
+                for method, args in tag_stack:
+                    method(*args)
 
-            # remove empty tags, which would typically be created by redacted spans
-            par_el = handler._root
-            remove_empty_tags(par_el, ignore_tags={'img'})
+                # remove empty tags, which would typically be created by redacted spans
+                par_el = handler._root
+                remove_empty_tags(par_el, ignore_tags={'img'})
 
-            # append element if not empty (contents not redacted)
-            if par_el.text or len(par_el):
-                parent_el.append(par_el)
+                # append element if not empty (contents not redacted)
+                if par_el.text or len(par_el):
+                    parent_els[format].append(par_el)
 
         return last_page_label
 
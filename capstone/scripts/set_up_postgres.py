@@ -7,7 +7,7 @@ from simple_history.manager import HistoryManager
 
 import django.apps
 from django.conf import settings
-from django.db import connections
+from django.db import connections, transaction
 
 from .helpers import nsmap
 
@@ -48,6 +48,9 @@ def update_postgres_env(db='capdb'):
 
         ### Full text search ###
         set_case_search_trigger()
+
+        ### Case count rollups ###
+        set_case_count_rollup_trigger()
         # install rum for full text indexing
         if not extension_installed(cursor, 'rum'):
             if extension_available(cursor, 'rum'):
@@ -245,4 +248,46 @@ def set_case_search_trigger():
             CREATE TRIGGER case_search_update_trigger
             BEFORE INSERT OR UPDATE ON capdb_casetext
             FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger('tsv', 'pg_catalog.english', 'text');
-        """)
\ No newline at end of file
+        """)
+
+def set_case_count_rollup_trigger(*args, **kwargs):
+    """
+        Install the trigger that keeps capdb_casecountrollup in sync with capdb_casemetadata.
+        This function takes *args, **kwargs so it can be called from RunPython in a migration.
+    """
+    with connections['capdb'].cursor() as cursor:
+        run_sql_file(cursor, "case_count_rollup.sql")
+        cursor.execute("""
+            DROP TRIGGER IF EXISTS case_count_rollup_trigger ON capdb_casemetadata;
+            CREATE TRIGGER case_count_rollup_trigger
+            AFTER INSERT OR UPDATE OR DELETE ON capdb_casemetadata
+            FOR EACH ROW EXECUTE PROCEDURE case_count_rollup();
+        """)
+
+
+def rebuild_case_count_rollups(*args, **kwargs):
+    """
+        Repopulate capdb_casecountrollup from capdb_casemetadata. The trigger installed by set_case_count_rollup_trigger
+        keeps the rollups current after this, so it should only need to be run once, when the table is created.
+        Writes to capdb_casemetadata are blocked while this runs.
+        This function takes *args, **kwargs so it can be called from RunPython in a migration.
+    """
+    with transaction.atomic(using='capdb'), connections['capdb'].cursor() as cursor:
+        cursor.execute(r"""
+            LOCK TABLE capdb_casemetadata IN SHARE MODE;
+            DELETE FROM capdb_casecountrollup;
+            INSERT INTO capdb_casecountrollup
+                (jurisdiction_id, court_id, reporter_id, volume_id, year, in_scope, duplicative, case_count, page_count)
+            SELECT
+                coalesce(jurisdiction_id, 0),
+                coalesce(court_id, 0),
+                coalesce(reporter_id, 0),
+                coalesce(volume_id, ''),
+                coalesce(extract(year from decision_date)::integer, 0) AS year,
+                in_scope,
+                duplicative,
+                COUNT(*),
+                SUM(CASE WHEN (first_page||last_page)~E'^\\d+$' THEN last_page::integer-first_page::integer+1 ELSE 1 END)
+            FROM capdb_casemetadata
+            GROUP BY 1, 2, 3, 4, 5, 6, 7;
+        """)
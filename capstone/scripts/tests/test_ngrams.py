@@ -1,13 +1,19 @@
+from pathlib import Path
+
 import pytest
 from flaky import flaky
 
+from django.conf import settings
+
 from capapi.views.api_views import NgramViewSet
+from scripts.helpers import parse_xml
+from scripts.ngrams import nltk_tokenize, regex_tokenize, NgramCounter
 
 
 @flaky(max_runs=10)  # ngrammed_cases call to ngram_jurisdictions doesn't reliably work because it uses multiprocessing within pytest environment
 @pytest.mark.django_db
 def test_ngrams(ngrammed_cases):
-    from capdb.storages import ngram_kv_store_ro  # import here so pytest won't inspect and un-lazy it during test collection
+    from capdb.storages import ngram_kv_store_ro, NgramRocksDB, NgramValue  # import here so pytest won't inspect and un-lazy it during test collection
 
     # check totals
     totals = NgramViewSet.load_totals()
@@ -18,7 +24,138 @@ def test_ngrams(ngrammed_cases):
 
     # check trigram values
     trigrams = {"one two three", "three don't don't", "two three don't", "two three four"}
-    stored = {k.decode('utf8')[1:]: v for k, v in ngram_kv_store_ro.get_prefix(b'\3', packed=True)}
+    stored = {k.decode('utf8')[1:]: NgramValue.to_dict(v) for k, v in ngram_kv_store_ro.get_prefix(b'\3')}
     assert trigrams == set(stored.keys())
     assert stored["one two three"] == {None: {None: [2, 2], 100: [2, 2]}, ngrammed_cases[0].jurisdiction_id: [100, 1, 1], ngrammed_cases[1].jurisdiction_id: [100, 1, 1]}
 
+    # check count keys used to rank wildcard searches
+    assert ngram_kv_store_ro.get(NgramRocksDB.count_key(b"\3one two three"), packed=True) == 2
+    assert [k for k, v in ngram_kv_store_ro.get_top_prefix(b"\3two three ")] == [b"\3two three don't", b"\3two three four"]
+
+
+@flaky(max_runs=10)  # see test_ngrams
+@pytest.mark.django_db
+def test_ngrams_incremental(ngrammed_cases):
+    from capdb.storages import ngram_kv_store_ro, NgramValue  # see test_ngrams
+    from scripts.ngrams import ngram_jurisdictions
+
+    # remove the first case and edit the third
+    ngrammed_cases[0].body_cache.delete()
+    ngrammed_cases[2].body_cache.text = "(Two, three, four)"
+    ngrammed_cases[2].body_cache.save()
+    ngram_jurisdictions(incremental=True)
+
+    totals = NgramViewSet.load_totals()
+    assert totals[(None, None, 3)] == [3, 2]
+    assert totals[(ngrammed_cases[0].jurisdiction_id, 2000, 3)] == [0, 0]
+    assert totals[(ngrammed_cases[1].jurisdiction_id, 2000, 3)] == [3, 2]
+
+    # grams that are no longer observed are left with zero counts
+    stored = {k.decode('utf8')[1:]: NgramValue.to_dict(v) for k, v in ngram_kv_store_ro.get_prefix(b'\3') if NgramValue.totals(v)[0]}
+    assert set(stored.keys()) == {"one two three", "two three don't", "two three four"}
+    assert stored["one two three"] == {None: {None: [1, 1], 100: [1, 1]}, ngrammed_cases[1].jurisdiction_id: [100, 1, 1]}
+
+    # a second run has nothing to update
+    ngram_jurisdictions(incremental=True)
+    assert NgramViewSet.load_totals()[(None, None, 3)] == [3, 2]
+
+
+def ngram_store_contents(store):
+    """ Every key in store, with gram values decoded, so databases written in different ways can be compared. """
+    from capdb.storages import KVDB, NgramRocksDB, NgramValue  # see test_ngrams
+    it = store.db.iteritems()
+    it.seek_to_first()
+    contents = {}
+    for k, v in it:
+        if k[0] in (1, 2, 3):
+            v = NgramValue.to_dict(v)
+        elif k.startswith((NgramRocksDB.count_key_prefix, NgramRocksDB.totals_key_prefix)):
+            v = KVDB.unpack(v)
+        contents[k] = v
+    return contents
+
+
+@flaky(max_runs=10)  # see test_ngrams
+@pytest.mark.django_db
+def test_ngrams_bulk(ngrammed_cases, tmpdir, monkeypatch):
+    from capdb.storages import ngram_kv_store, ngram_kv_store_ro, NgramRocksDB  # see test_ngrams
+    from scripts.ngrams import ngram_jurisdictions, get_totals_key
+
+    # load the same cases into a new database with bulk=True and compare with what the merge writer stored
+    merged = ngram_store_contents(ngram_kv_store_ro)
+    monkeypatch.setattr(ngram_kv_store, '_wrapped', NgramRocksDB(path=str(tmpdir.mkdir('bulk'))))
+    ngram_jurisdictions(bulk=True)
+    loaded = ngram_store_contents(ngram_kv_store)
+    assert loaded == merged
+
+    # values, count keys, totals and case records were all written
+    jurisdiction_id = ngrammed_cases[1].jurisdiction_id
+    assert loaded[b"\3one two three"] == {None: {None: [2, 2], 100: [2, 2]}, ngrammed_cases[0].jurisdiction_id: [100, 1, 1], jurisdiction_id: [100, 1, 1]}
+    assert loaded[NgramRocksDB.count_key(b"\3one two three")] == 2
+    assert loaded[get_totals_key(jurisdiction_id, 2000, 3)] == [4, 2]
+    assert len([k for k in loaded if k.startswith(NgramRocksDB.digest_key_prefix)]) == len(ngrammed_cases)
+
+    # bulk mode only loads new databases
+    with pytest.raises(ValueError):
+        ngram_jurisdictions(bulk=True)
+
+
+@flaky(max_runs=10)  # see test_ngrams
+@pytest.mark.django_db
+def test_ngrams_without_case_records(ngrammed_cases, tmpdir, monkeypatch, settings):
+    from capdb.storages import ngram_kv_store, ngram_kv_store_ro, NgramRocksDB  # see test_ngrams
+    from scripts.ngrams import ngram_jurisdictions
+
+    # without NGRAM_INCREMENTAL_UPDATES, the same grams are stored but cases aren't recorded
+    settings.NGRAM_INCREMENTAL_UPDATES = False
+    monkeypatch.setattr(ngram_kv_store, '_wrapped', NgramRocksDB(path=str(tmpdir.mkdir('unrecorded'))))
+    ngram_jurisdictions()
+    recorded = ngram_store_contents(ngram_kv_store_ro)
+    unrecorded = ngram_store_contents(ngram_kv_store)
+    case_prefixes = (NgramRocksDB.digest_key_prefix, NgramRocksDB.tokens_key_prefix)
+    assert unrecorded == {k: v for k, v in recorded.items() if not k.startswith(case_prefixes)}
+    assert len(recorded) - len(unrecorded) == 2 * len(ngrammed_cases)
+
+    # and the database can't be updated
+    with pytest.raises(ValueError):
+        ngram_jurisdictions(incremental=True)
+
+
+@pytest.mark.parametrize("text", [
+    '"One? two three." Four!',
+    "One 'two three' don't.",
+    "Mr. Smith v. Jones Co., 3,000 U.S. 10:30, a,b a:b.",
+    "The end.) Not the end. ) The end.'' Not the end. '' Or. \"this",
+    "See id. at 5... and so on.... (1) [2] {3} <4> a--b a-b x;y x@y x#y x$y x%y x&y",
+    "\u201cQuoted,\u201d he said\u2014 \u2018twice.\u2019 ``Really'' 'a' 'tis 'twas don't «foo» \u201ebar",
+    "ALL CAPS. \u0130stanbul's \u00a9 2000 \u00ae \u00a31.",
+])
+def test_tokenize_backends(text):
+    assert list(regex_tokenize(text)) == list(nltk_tokenize(text))
+
+
+def test_tokenize_backends_casemets():
+    for path in Path(settings.BASE_DIR, 'test_data/from_vendor').glob('*/casemets/*.xml'):
+        text = parse_xml(path.read_text())('casebody|casebody').text()
+        assert list(regex_tokenize(text)) == list(nltk_tokenize(text)), path
+
+
+@pytest.mark.parametrize("max_entries", [1000000, 10, 3])
+def test_ngram_counter(tmpdir, max_entries):
+    documents = [
+        "one two three don't".split(),
+        "two three one two three".split(),
+        [],
+        ["three"],
+    ]
+    counter = NgramCounter(3, str(tmpdir), max_entries=max_entries)
+    for tokens in documents:
+        counter.add(tokens)
+    assert (counter.spill_count > 0) == (max_entries < 1000000)
+
+    assert counter.totals == {1: [10, 4], 2: [7, 4], 3: [5, 4]}
+    assert list(counter.observations(1)) == [(b"\1don't", 1, 1), (b"\1one", 2, 2), (b"\1three", 4, 3), (b"\1two", 3, 2)]
+    assert list(counter.observations(2)) == [
+        (b"\2one two", 2, 2), (b"\2three don't", 1, 1), (b"\2three one", 1, 1), (b"\2two three", 3, 2)]
+    assert list(counter.observations(3)) == [
+        (b"\3one two three", 2, 2), (b"\3three one two", 1, 1), (b"\3two three don't", 1, 1), (b"\3two three one", 1, 1)]
@@ -0,0 +1,79 @@
+import pytest
+
+from capdb.models import CaseMetadata, CaseStructure, CaseFont
+from scripts.render_case import VolumeRenderer
+
+
+### helpers ###
+
+italic = ['font', {'id': 1}]
+blocks_by_id = {block['id']: block for block in [
+    {'id': 'BL_1', 'class': 'parties', 'tokens': ['Foo ', italic, 'v.', ['/font'], ' Bar']},
+    {'id': 'BL_2', 'class': 'author', 'tokens': [italic, 'Smith', ['/font'], italic, ['footnotemark', {'ref': 'footnote_1'}], '1', ['/footnotemark'], ['/font']]},
+    {'id': 'BL_3', 'tokens': ['Opinion ', ['redact'], 'secret ', italic, 'text', ['/font'], ['/redact'], 'text', ['bracketnum'], '[1]', ['/bracketnum'], ' more']},
+    {'id': 'BL_4', 'tokens': [['redact'], 'Redacted ', ['bracketnum'], '[2', ['/redact'], ']', ['/bracketnum'], ' span']},
+    {'id': 'BL_5', 'redacted': True, 'tokens': ['Redacted block']},
+    {'id': 'BL_6', 'format': 'image', 'class': 'image', 'data': 'image/png;base64,AAAA', 'rect': [0, 0, 10.4, 20.6]},
+    {'id': 'BL_7', 'format': 'image', 'class': 'image', 'data': 'image/png;base64,BBBB', 'rect': [0, 0, 5, 5], 'redacted': True},
+    {'id': 'BL_8', 'tokens': ['1 A foot\xadnote.']},
+    {'id': 'BL_9', 'tokens': ['2 A redacted footnote.']},
+    {'id': 'BL_10', 'class': 'p', 'tokens': ['Corrected.']},
+    {'id': 'BL_11', 'class': 'summary', 'tokens': ['Unprocessed ', italic, 'text', ['/font']]},
+]}
+labels_by_block_id = {'BL_1': '5', 'BL_2': '5', 'BL_3': '5', 'BL_4': '6', 'BL_5': '6', 'BL_6': '6', 'BL_7': '7',
+                      'BL_8': '7', 'BL_9': '7', 'BL_10': '7', 'BL_11': '8'}
+fonts_by_id = {1: CaseFont(pk=1, family='Times', size='10', style='italics', type='serif', width='proportional')}
+
+
+def make_case(opinions, **kwargs):
+    case = CaseMetadata(case_id='00000001', first_page='5', last_page='8', **kwargs)
+    CaseStructure(metadata=case, opinions=opinions)
+    return case
+
+
+@pytest.fixture
+def render_cases():
+    """ Unsaved cases covering redacted spans, blocks, paragraphs, images and footnotes, and the special cases. """
+    opinions = [
+        {'type': 'head', 'paragraphs': [{'id': 'b5-1', 'class': 'parties', 'block_ids': ['BL_1']}]},
+        {'type': 'majority', 'paragraphs': [
+            {'id': 'b5-2', 'class': 'author', 'block_ids': ['BL_2']},
+            {'id': 'b5-3', 'class': 'p', 'block_ids': ['BL_3', 'BL_4']},
+            {'id': 'b6-1', 'class': 'blockquote', 'block_ids': ['BL_5', 'BL_6']},
+            {'id': 'b7-1', 'class': 'p', 'block_ids': ['BL_7'], 'redacted': True},
+        ], 'footnotes': [
+            {'id': 'footnote_1', 'label': '1', 'paragraphs': [{'id': 'b7-2', 'class': 'p', 'block_ids': ['BL_8']}]},
+            {'id': 'footnote_2', 'label': '2', 'redacted': True, 'paragraphs': [{'id': 'b7-3', 'class': 'p', 'block_ids': ['BL_9']}]},
+        ]},
+        {'type': 'corrections', 'paragraphs': [{'id': 'b7-4', 'class': 'p', 'block_ids': ['BL_10']}]},
+    ]
+    unprocessed = [{'type': 'unprocessed', 'paragraphs': [{'id': 'b8-1', 'class': 'p', 'block_ids': ['BL_11']}]}]
+    return [
+        make_case(opinions),
+        make_case(unprocessed, duplicative=True),
+        make_case(opinions, withdrawn=True),
+    ]
+
+
+### tests ###
+
+@pytest.mark.parametrize("redacted", [True, False])
+@pytest.mark.parametrize("pretty_print", [True, False])
+def test_render_all_matches_single_format_renders(render_cases, redacted, pretty_print):
+    renderer = VolumeRenderer(blocks_by_id, fonts_by_id, labels_by_block_id, redacted=redacted, pretty_print=pretty_print)
+    for case in render_cases:
+        # the combined pass returns exactly what rendering each format separately does
+        json, text = renderer.render_json_and_text(case)
+        separate = {'html': renderer.render_html(case), 'xml': renderer.render_xml(case), 'json': json, 'text': text}
+        assert renderer.render_all(case) == separate
+        assert (json, text) == case.get_json_from_html(separate['html'])
+
+        # and rendering the original xml in between doesn't change either
+        renderer.render_orig_xml(case)
+        assert renderer.render_all(case) == separate
+
+    # redaction is applied to every format
+    html, xml = renderer.render_html(render_cases[0]), renderer.render_xml(render_cases[0])
+    for hidden in ('secret', 'Redacted', 'redacted footnote'):
+        assert (hidden in html) == (hidden in xml) == (not redacted)
+    assert ('BBBB' in html) == (not redacted)
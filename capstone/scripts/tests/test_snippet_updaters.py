@@ -1,7 +1,7 @@
 import pytest
 import json
 from scripts import update_snippets
-from capdb.models import Snippet
+from capdb.models import Snippet, CaseCountRollup, Jurisdiction
 
 @pytest.mark.django_db
 def test_map_numbers(ingest_case_xml):
@@ -14,6 +14,15 @@ def test_map_numbers(ingest_case_xml):
     assert parsed['US-IL']['volume_count'] == 2
     assert parsed['US-IL']['page_count'] == 8
 
+    # rollup rows for cases without a volume or reporter don't count as another volume or reporter
+    reporter_count = parsed['US-IL']['reporter_count']
+    CaseCountRollup.objects.create(jurisdiction_id=Jurisdiction.objects.get(slug='ill').pk, year=1900, case_count=1)
+    update_snippets.update_map_numbers()
+    parsed = json.loads(Snippet.objects.get(label="map_numbers").contents)
+    assert parsed['US-IL']['case_count'] == 3
+    assert parsed['US-IL']['volume_count'] == 2
+    assert parsed['US-IL']['reporter_count'] == reporter_count
+
 @pytest.mark.django_db
 def test_cases_by_decision_date(ingest_case_xml):
     update_snippets.cases_by_decision_date_tsv()
@@ -1,9 +1,8 @@
 import io
 import csv
 
-from django.db import connections
-from django.db.models import Count, Case, When, IntegerField
-from capdb.models import Reporter, Jurisdiction, CaseMetadata, Snippet, Court
+from django.db.models import Count, Sum, Q
+from capdb.models import Reporter, Jurisdiction, CaseMetadata, Snippet, Court, CaseCountRollup
 import json
 from capweb.templatetags.api_url import api_url
 from tqdm import tqdm
@@ -51,14 +50,16 @@ def cases_by_jurisdiction_tsv():
     snippet_format="text/tab-separated-values"
     output = io.StringIO()
     writer = csv.writer(output, delimiter='\t',quoting=csv.QUOTE_NONNUMERIC)
-    for jurisdiction in tqdm(Jurisdiction.objects.annotate(case_count=Count('case_metadatas'))):
-        if jurisdiction.case_count == 0:
+    case_counts = rollup_case_counts('jurisdiction_id')
+    for jurisdiction in tqdm(Jurisdiction.objects.all()):
+        case_count = case_counts.get(jurisdiction.pk)
+        if not case_count:
             continue
         writer.writerow(
             [
                 jurisdiction.name,
                 jurisdiction.name_long,
-                jurisdiction.case_count,
+                case_count,
                 "{}?jurisdiction={}".format(api_url('cases-list'), jurisdiction.slug),
                 "{}{}".format(api_url('jurisdiction-list'), jurisdiction.pk)
             ]
@@ -75,15 +76,16 @@ def cases_by_reporter_tsv():
     snippet_format="text/tab-separated-values"
     output = io.StringIO()
     writer = csv.writer(output, delimiter='\t',quoting=csv.QUOTE_NONNUMERIC)
-    for reporter in tqdm(Reporter.objects.annotate(case_count=Count(
-            Case(When(case_metadatas__duplicative=False, then=1), output_field=IntegerField())))):
-        if reporter.case_count == 0:
+    case_counts = rollup_case_counts('reporter_id', duplicative=False)
+    for reporter in tqdm(Reporter.objects.all()):
+        case_count = case_counts.get(reporter.pk)
+        if not case_count:
             continue
         writer.writerow(
             [
                 reporter.short_name,
                 reporter.full_name,
-                reporter.case_count,
+                case_count,
                 "{}?reporter={}".format(api_url('cases-list'), reporter.pk),
                 "{}{}".format(api_url('reporter-list'), reporter.pk)
             ]
@@ -91,6 +93,11 @@ def cases_by_reporter_tsv():
 
     write_update(label, snippet_format, output.getvalue())
 
+def rollup_case_counts(group_by, **filters):
+    """ Return {<group_by value>: case count} from CaseCountRollup, rather than counting CaseMetadata rows. """
+    return dict(CaseCountRollup.objects.filter(case_count__gt=0, **filters)
+                .values_list(group_by).annotate(case_count=Sum('case_count')).order_by())
+
 def update_map_numbers():
     """ Write map_numbers snippet. """
     label = "map_numbers"
@@ -107,24 +114,18 @@ def update_map_numbers():
         "neb":"US-NE", "conn":"US-CT", "me":"US-ME", "iowa":"US-IA", "tex":"US-TX", "del":"US-DE", "mo":"US-MO",
         "haw":"US-HI", "nm":"US-NM", "wash":"US-WA", "va":"US-VA"
     }
-    cursor = connections['capdb'].cursor()
-    cursor.execute(r"""
-        SELECT 
-          j.slug,
-          COUNT(c.id) AS case_count,
-          COUNT(DISTINCT c.volume_id) AS volume_count,
-          COUNT(DISTINCT c.reporter_id) AS reporter_count,
-          SUM(CASE WHEN (c.first_page||c.last_page)~E'^\\d+$' THEN c.last_page::integer-c.first_page::integer+1 ELSE 1 END) AS page_count
-        FROM capdb_jurisdiction j 
-          LEFT JOIN capdb_casemetadata c ON j.id=c.jurisdiction_id 
-        WHERE
-          c.duplicative IS FALSE
-        GROUP BY j.id;
-    """)
-    # get column names from sql query
-    cols = [col[0] for col in cursor.description]
-    # create output where each key is a jurisdiction and each value is a dict of values from the sql query
-    output = {jurisdiction_translate[row[0]]: dict(zip(cols[1:], row[1:])) for row in cursor.fetchall()}
+    slugs = dict(Jurisdiction.objects.values_list('id', 'slug'))
+    rows = CaseCountRollup.objects.filter(duplicative=False, case_count__gt=0).values('jurisdiction_id').annotate(
+        case_count=Sum('case_count'),
+        volume_count=Count('volume_id', distinct=True, filter=~Q(volume_id='')),
+        reporter_count=Count('reporter_id', distinct=True, filter=~Q(reporter_id=0)),
+        page_count=Sum('page_count'),
+    ).order_by()
+    # create output where each key is a jurisdiction and each value is a dict of counts
+    output = {
+        jurisdiction_translate[slugs[row.pop('jurisdiction_id')]]: row
+        for row in rows if row['jurisdiction_id'] in slugs
+    }
     write_update(label, snippet_format, json.dumps(output))
 
 def search_jurisdiction_list():
@@ -204,9 +204,12 @@ def mock_ngram_storage(tmpdir):
 
 
 @pytest.fixture
-def ngrammed_cases(mock_ngram_storage, three_cases, jurisdiction):
+def ngrammed_cases(mock_ngram_storage, three_cases, jurisdiction, settings):
     import scripts.ngrams
 
+    # record counted cases, so tests can run incremental updates
+    settings.NGRAM_INCREMENTAL_UPDATES = True
+
     # set up two jurisdictions
     jur0 = jurisdiction
     jur0.slug = 'jur0'
@@ -0,0 +1,47 @@
+CREATE OR REPLACE FUNCTION case_count_rollup_add(c capdb_casemetadata, sign integer) RETURNS void AS $$
+BEGIN
+  -- add (or with sign=-1, remove) one case to its row in capdb_casecountrollup. Missing values are stored as 0 or ''
+  -- so the unique constraint on the grouping columns can be used for the upsert.
+  INSERT INTO capdb_casecountrollup
+    (jurisdiction_id, court_id, reporter_id, volume_id, year, in_scope, duplicative, case_count, page_count)
+  VALUES (
+    coalesce(c.jurisdiction_id, 0),
+    coalesce(c.court_id, 0),
+    coalesce(c.reporter_id, 0),
+    coalesce(c.volume_id, ''),
+    coalesce(extract(year from c.decision_date)::integer, 0),
+    c.in_scope,
+    c.duplicative,
+    sign,
+    sign * (CASE WHEN (c.first_page||c.last_page)~E'^\\d+$' THEN c.last_page::integer-c.first_page::integer+1 ELSE 1 END)
+  )
+  ON CONFLICT (jurisdiction_id, court_id, reporter_id, volume_id, year, in_scope, duplicative) DO UPDATE SET
+    case_count = capdb_casecountrollup.case_count + EXCLUDED.case_count,
+    page_count = capdb_casecountrollup.page_count + EXCLUDED.page_count;
+END
+$$ LANGUAGE plpgSQL;
+
+CREATE OR REPLACE FUNCTION case_count_rollup() RETURNS trigger AS $$
+BEGIN
+  /*
+    Keep capdb_casecountrollup in sync with capdb_casemetadata. Example use:
+
+      CREATE TRIGGER case_count_rollup_trigger
+          AFTER INSERT OR UPDATE OR DELETE
+          ON capdb_casemetadata FOR EACH ROW
+          EXECUTE PROCEDURE case_count_rollup();
+  */
+  IF TG_OP = 'UPDATE' AND
+      (OLD.jurisdiction_id, OLD.court_id, OLD.reporter_id, OLD.volume_id, OLD.decision_date, OLD.in_scope, OLD.duplicative, OLD.first_page, OLD.last_page) IS NOT DISTINCT FROM
+      (NEW.jurisdiction_id, NEW.court_id, NEW.reporter_id, NEW.volume_id, NEW.decision_date, NEW.in_scope, NEW.duplicative, NEW.first_page, NEW.last_page) THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+    PERFORM case_count_rollup_add(OLD, -1);
+  END IF;
+  IF TG_OP = 'UPDATE' OR TG_OP = 'INSERT' THEN
+    PERFORM case_count_rollup_add(NEW, 1);
+  END IF;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgSQL;